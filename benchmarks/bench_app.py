@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+'''
+Benchmark the web app offline, against an in-memory Elasticsearch stand-in
+(fakees.py) loaded with a synthetic archive.
+
+    python benchmarks/bench_app.py -n 5000
+    python benchmarks/bench_app.py --latency 5
+    python benchmarks/bench_app.py --check    # fail on extra ES round trips
+    python benchmarks/bench_app.py --record   # accept the current counts
+
+Micro-benchmarks time the per-tweet helpers of rendering. Request benchmarks
+go through app.test_client(), with and without precomputed views, and report
+latency percentiles and Elasticsearch calls per request. The fake answers in
+microseconds, so latencies are those of ash itself: real deployments add
+network and cluster time per call, which is why the calls are counted. Use
+--latency to add that time back, e.g. for a cluster in another zone.
+
+A load test then requests the same tweet pages from --concurrency threads at
+once, to measure how many ES calls single-flight saves. It needs --latency
+for the calls to overlap as they would in production.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import functools
+import statistics
+from pathlib import Path
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+os.environ.setdefault('TESTING', 'True')
+
+import flask  # noqa: E402
+from elasticsearch import Elasticsearch  # noqa: E402
+
+import ash  # noqa: E402
+from ash.ingest import reindex_views  # noqa: E402
+from fakees import FakeNode  # noqa: E402
+from fakees import FakeCluster  # noqa: E402
+from synth import WORDS  # noqa: E402
+from synth import USERS  # noqa: E402
+from synth import make_toot  # noqa: E402
+from synth import make_tweet  # noqa: E402
+from synth import measure  # noqa: E402
+from synth import percentiles  # noqa: E402
+
+HERE = Path(__file__).parent
+BUDGET_FILE = HERE / 'es_calls.json'
+
+
+def make_archive(cluster: FakeCluster, n: int, seed: int = 0) -> list[dict]:
+    '''Load n statuses (one in ten a toot) into the fake cluster, and return
+    them as they were before indexing'''
+    rng = random.Random(seed)
+    start = datetime(2009, 1, 1, tzinfo=timezone.utc)
+    statuses = []
+    for i in range(n):
+        ts = start + timedelta(hours=i)
+        if i % 10 == 9:
+            status = make_toot(rng, i, ts)
+            index = ts.strftime('toots-%Y')
+        else:
+            status = make_tweet(rng, i, ts)
+            index = ts.strftime('tweets-%Y')
+        cluster.add(index, status['id'], json.loads(json.dumps(status)))
+        statuses.append(status)
+    return statuses
+
+
+def run_micro(statuses: list[dict], repeat: int) -> None:
+    print(f'{"micro-benchmark":<32} {"p50":>10} {"p95":>10} {"p99":>10}')
+    tweets = [s for s in statuses if 'user' in s]
+    toots = [s for s in statuses if 'account' in s]
+    rng = random.Random(1)
+    pick = functools.partial(rng.choice, tweets)
+    app = ash.app
+    app.config['T_USER_DICTS'] = {USERS[0]: {'name': 'Alice A.'}}
+    app.config['T_MEDIA_MIRRORS'] = {
+        'pbs.twimg.com': 'mirror.example.com/pbs.twimg.com',
+        'video.twimg.com': 'mirror.example.com/video.twimg.com',
+    }
+
+    def media_url():
+        return f'https://pbs.twimg.com/media/{rng.randrange(10 ** 6)}.jpg'
+
+    # A page shows few distinct timestamps many times over: time hits of the
+    # cache on a set of them that fits in it
+    timestamps = [pick()['created_at'] for _ in range(64)]
+    for timestamp in timestamps:
+        ash.format_created_at(timestamp, '%Y-%m-%d')
+
+    with app.test_request_context('/tweet/'):
+        flask.g.local_links = {}
+        benchmarks = {
+            'render_entities': lambda: ash.render_entities(pick()),
+            'format_tweet_text (cached)': lambda: ash.format_tweet_text({**pick(), '@index': 'i'}),
+            'toot_to_tweet': lambda: ash.toot_to_tweet(dict(rng.choice(toots))),
+            'make_view': lambda: ash.make_view(pick()),
+            'format_created_at (uncached)': lambda: ash.format_created_at.__wrapped__(
+                pick()['created_at'], '%Y-%m-%d'),
+            'format_created_at (cached)': lambda: ash.format_created_at(rng.choice(timestamps), '%Y-%m-%d'),
+            'inject_user_dict': lambda: ash.inject_user_dict({'user': dict(pick()['user'])}),
+        }
+        for media_from in ('direct', 'mirror', 'filesystem'):
+            benchmarks[f'replace_media_url ({media_from})'] = functools.partial(
+                lambda media_from: (
+                    app.config.__setitem__('T_MEDIA_FROM', media_from),
+                    ash.replace_media_url(media_url()),
+                ),
+                media_from,
+            )
+        for name, fn in benchmarks.items():
+            p50, p95, p99 = percentiles(measure(fn, repeat))
+            print(f'  {name:<30} {p50 * 1e6:8.1f}µs {p95 * 1e6:8.1f}µs {p99 * 1e6:8.1f}µs')
+    app.config['T_MEDIA_FROM'] = 'direct'
+
+
+def run_requests(cluster: FakeCluster, statuses: list[dict], repeat: int, label: str) -> dict[str, int]:
+    '''Time requests, and return the most ES calls each kind of request made'''
+    print(f'{"request (" + label + ")":<32} {"p50":>10} {"p95":>10} {"p99":>10} {"ES calls":>9}')
+    client = ash.app.test_client()
+    rng = random.Random(2)
+    ids = [s['id'] for s in statuses]
+
+    def tweet_page_cold():
+        # Rendered pages are cached, so drop them to time the rendering
+        ash._tweet_response_cache.clear()
+        return f'/tweet/{rng.choice(ids)}.html'
+
+    def search_cold_facets():
+        ash.facets_cache.invalidate()
+        return f'/tweet/search.html?q={rng.choice(WORDS)}'
+
+    requests = {
+        '/tweet/': lambda: '/tweet/',
+        '/tweet/<id>.html': tweet_page_cold,
+        '/tweet/<id>.html (cached)': lambda: f'/tweet/{ids[0]}.html',
+        '/tweet/<id>.json': lambda: f'/tweet/{rng.choice(ids)}.json',
+        'search.html': lambda: f'/tweet/search.html?q={rng.choice(WORDS)}',
+        'search.html (cold facets)': search_cold_facets,
+        'search.json': lambda: f'/tweet/search.json?q={rng.choice(WORDS)}',
+    }
+    max_calls = {}
+    for name, make_url in requests.items():
+        calls = []
+
+        def request():
+            url = make_url()
+            # Which tweets the ID -> index cache already knows depends on
+            # the archive size and the requests before, so start every
+            # request without it: the calls counted are then the most each
+            # kind of request can make, whatever -n and -r
+            ash._id_index_cache.clear()
+            before = len(cluster.calls)
+            resp = client.get(url)
+            assert resp.status_code == 200, (url, resp.status_code)
+            calls.append(len(cluster.calls) - before)
+
+        samples = measure(request, repeat)
+        p50, p95, p99 = percentiles(samples)
+        calls = calls[1:]  # not the warm-up
+        max_calls[name] = max(calls)
+        print(f'  {name:<30} {p50 * 1e3:8.2f}ms {p95 * 1e3:8.2f}ms {p99 * 1e3:8.2f}ms '
+              f'{statistics.mean(calls):5.1f} ({max(calls)})')
+    return max_calls
+
+
+def run_load(cluster: FakeCluster, statuses: list[dict], concurrency: int, rounds: int) -> None:
+    '''Request the same uncached tweet page from many threads at once, as
+    when a link is shared widely, with and without single-flight'''
+    print(f'{"load (" + str(concurrency) + " at once)":<32} {"p50":>10} {"p95":>10} {"p99":>10} {"ES calls":>9}')
+    rng = random.Random(3)
+    hot = [s['id'] for s in rng.sample(statuses, 4)]
+    for single_flight in (False, True):
+        ash.app.config['T_SINGLE_FLIGHT'] = single_flight
+        samples = []
+        calls = 0
+        for _ in range(rounds):
+            ash._tweet_response_cache.clear()
+            url = f'/tweet/{rng.choice(hot)}.html'
+            barrier = threading.Barrier(concurrency)
+
+            def request():
+                client = ash.app.test_client()
+                barrier.wait()
+                start = time.perf_counter()
+                assert client.get(url).status_code == 200
+                samples.append(time.perf_counter() - start)
+
+            threads = [threading.Thread(target=request) for _ in range(concurrency)]
+            before = len(cluster.calls)
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            calls += len(cluster.calls) - before
+        p50, p95, p99 = percentiles(samples)
+        name = 'single-flight' if single_flight else 'no single-flight'
+        print(f'  {name:<30} {p50 * 1e3:8.2f}ms {p95 * 1e3:8.2f}ms {p99 * 1e3:8.2f}ms '
+              f'{calls / len(samples):5.2f}')
+    ash.app.config['T_SINGLE_FLIGHT'] = True
+
+
+def check(max_calls: dict[str, int]) -> bool:
+    budget = json.loads(BUDGET_FILE.read_text())
+    ok = True
+    for name, calls in max_calls.items():
+        if name in budget and calls > budget[name]:
+            print(f'FAIL: {name} made {calls} ES calls, {budget[name]} allowed', file=sys.stderr)
+            ok = False
+    return ok
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', type=int, default=2000, help='number of tweets and toots')
+    ap.add_argument('-r', '--repeat', type=int, default=50, help='iterations of each benchmark')
+    ap.add_argument('--latency', type=float, default=0, help='milliseconds added to every ES call')
+    ap.add_argument('-c', '--concurrency', type=int, default=32, help='requests at once in the load test')
+    ap.add_argument('--check', action='store_true', help=f'fail if any request makes more ES calls than {BUDGET_FILE.name} allows')
+    ap.add_argument('--record', action='store_true', help=f'write ES calls per request to {BUDGET_FILE.name}')
+    args = ap.parse_args()
+
+    # Every client ash makes talks to the fake
+    cluster = FakeNode.cluster = FakeCluster()
+    cluster.latency = args.latency / 1000
+    ash.Elasticsearch = functools.partial(Elasticsearch, node_class=FakeNode)
+    ash.app.config.update({
+        'TESTING': True,
+        'T_ES_HOST': 'http://fake:9200',
+        'T_ES_INDEX': 'tweets-*,toots-*',
+        'T_SEARCH_PAGE_SIZE': 100,
+    })
+    ash.app.config.pop('T_SEARCH_BASIC_AUTH', None)
+
+    start = time.perf_counter()
+    statuses = make_archive(cluster, args.n)
+    print(f'Loaded {args.n} statuses in {time.perf_counter() - start:.1f}s\n')
+
+    run_micro(statuses, args.repeat * 10)
+    print()
+    max_calls = {
+        f'{name} (source)': calls
+        for name, calls in run_requests(cluster, statuses, args.repeat, 'source').items()
+    }
+    print()
+    reindex_views(Elasticsearch('http://fake:9200', node_class=FakeNode), 'tweets-*,toots-*', log=lambda _: None)
+    ash.app.config['T_ES_VIEWS'] = True
+    max_calls.update({
+        f'{name} (views)': calls
+        for name, calls in run_requests(cluster, statuses, args.repeat, 'views').items()
+    })
+
+    print()
+    run_load(cluster, statuses, args.concurrency, max(args.repeat // 10, 5))
+
+    if args.record:
+        BUDGET_FILE.write_text(json.dumps(max_calls, indent=2) + '\n')
+    if args.check and not check(max_calls):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
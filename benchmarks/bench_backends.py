@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+'''
+Compare the SQLite backend with Elasticsearch on the same synthetic archive.
+
+    python benchmarks/bench_backends.py -n 200000
+    python benchmarks/bench_backends.py -n 200000 --es-host http://localhost:9200
+
+Without --es-host, only the SQLite backend is measured. The Elasticsearch
+index created for the benchmark is deleted afterwards.
+'''
+
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+
+os.environ.setdefault('TESTING', 'True')
+
+from ash import TweetsDatabase  # noqa: E402
+from ash.sqlite import load  # noqa: E402
+from ash.sqlite import SQLiteTweetsDatabase  # noqa: E402
+from synth import WORDS  # noqa: E402
+from synth import USERS  # noqa: E402
+from synth import make_tweets  # noqa: E402
+from synth import measure  # noqa: E402
+from synth import percentiles  # noqa: E402
+
+
+def report(name: str, fn, repeat: int) -> None:
+    p50, p95, p99 = (seconds * 1000 for seconds in percentiles(measure(fn, repeat)))
+    print(f'  {name:<24} p50 {p50:8.3f} ms   p95 {p95:8.3f} ms   p99 {p99:8.3f} ms')
+
+
+def run(tdb, n: int, repeat: int) -> None:
+    rng = random.Random(1)
+    report('get by id', lambda: tdb[10 ** 17 + rng.randrange(n)], repeat)
+    report('existing_ids (100)', lambda: tdb.existing_ids(10 ** 17 + rng.randrange(n) for _ in range(100)), repeat)
+    report('latest(10)', lambda: tdb.latest(10), repeat)
+    report('search one word', lambda: list(tdb.search(keyword=rng.choice(WORDS))), repeat)
+    report('search two words + user', lambda: list(tdb.search(
+        keyword=' '.join(rng.sample(WORDS, 2)), user_screen_name=rng.choice(USERS),
+    )), repeat)
+    report('users facet', lambda: list(tdb.get_users()), max(repeat // 10, 2))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', type=int, default=100000, help='number of tweets')
+    ap.add_argument('-r', '--repeat', type=int, default=200, help='iterations of each operation')
+    ap.add_argument('--es-host', help='also benchmark Elasticsearch at this URL')
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tweets.sqlite3')
+        start = time.perf_counter()
+        lines = (json.dumps(t) for t in make_tweets(args.n))
+        load(path, lines, index='tweets-bench')
+        print(f'SQLite: loaded {args.n} tweets in {time.perf_counter() - start:.1f}s, '
+              f'{os.path.getsize(path) / 2 ** 20:.1f} MiB')
+        run(SQLiteTweetsDatabase(path), args.n, args.repeat)
+
+    if args.es_host:
+        from elasticsearch import Elasticsearch
+        from elasticsearch.helpers import bulk
+        es = Elasticsearch(args.es_host)
+        index = f'tweets-bench-{int(time.time())}'
+        try:
+            start = time.perf_counter()
+            bulk(es, ({'_index': index, '_id': t['id'], '_source': t} for t in make_tweets(args.n)))
+            es.indices.refresh(index=index)
+            print(f'Elasticsearch: loaded {args.n} tweets in {time.perf_counter() - start:.1f}s')
+            run(TweetsDatabase(es, index), args.n, args.repeat)
+        finally:
+            es.indices.delete(index=index)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+'''
+An in-memory stand-in for an Elasticsearch node, for benchmarks that run
+offline.
+
+Plug it into a real client with Elasticsearch('http://fake:9200',
+node_class=FakeNode): everything above the HTTP layer (serialization, product
+check, retries) is the real client code. Every request is recorded in
+FakeCluster.calls, so round trips can be counted.
+
+It answers the queries ash makes, with the semantics ash relies on, and
+nothing more: no analysis (keywords are matched as lowercase substrings),
+scoring or mappings.
+'''
+
+from __future__ import annotations
+
+import json
+import time
+import fnmatch
+import itertools
+from urllib.parse import unquote
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from elastic_transport import BaseNode
+from elastic_transport import HttpHeaders
+from elastic_transport import ApiResponseMeta
+# Not exported, but what every node class returns
+from elastic_transport._node._base import NodeApiResponse
+
+
+class FakeCluster:
+    '''Indices, settings and open point-in-times of the fake node'''
+
+    def __init__(self):
+        self.indices: dict[str, dict[str, dict]] = {}
+        self.settings: dict[str, dict] = {}
+        self.calls: list[tuple[str, str]] = []
+        # Seconds added to every call, like a cluster in another zone
+        self.latency = 0.0
+        self.pits: dict[str, list[str]] = {}
+        self._pit_seq = itertools.count()
+        # _shard_doc of each document: unique, and numeric as in Elasticsearch
+        self.shard_docs: dict[tuple[str, str], int] = {}
+        self._doc_seq = itertools.count()
+
+    def add(self, index: str, doc_id, doc: dict) -> None:
+        self.indices.setdefault(index, {})[str(doc_id)] = doc
+        self.shard_docs.setdefault((index, str(doc_id)), next(self._doc_seq))
+        self.settings.setdefault(index, {})
+
+    def resolve(self, expr: str | None) -> list[str]:
+        if not expr or expr in ('_all', '*'):
+            return sorted(self.indices)
+        names = []
+        for pat in expr.split(','):
+            for name in sorted(self.indices):
+                if fnmatch.fnmatchcase(name, pat) and name not in names:
+                    names.append(name)
+        return names
+
+    def docs(self, indices):
+        for index in indices:
+            for doc_id, doc in self.indices[index].items():
+                yield index, doc_id, doc
+
+
+def _field(doc: dict, path: str, index: str, doc_id: str):
+    if path == '_id':
+        return doc_id
+    if path == '_index':
+        return index
+    if path.endswith('.keyword'):
+        path = path[:-len('.keyword')]
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part)
+        elif isinstance(value, list):
+            value = [v.get(part) if isinstance(v, dict) else None for v in value]
+        else:
+            return None
+    return value
+
+
+def _values(value):
+    if isinstance(value, list):
+        return [str(v) for v in value if v is not None]
+    if value is None:
+        return []
+    return [str(value)]
+
+
+def _match(query: dict | None, index: str, doc_id: str, doc: dict) -> bool:
+    if not query:
+        return True
+    (kind, spec), = query.items()
+    if kind == 'match_all':
+        return True
+    if kind == 'ids':
+        return doc_id in {str(v) for v in spec['values']}
+    if kind == 'term':
+        (field, value), = spec.items()
+        if isinstance(value, dict):
+            value = value['value']
+        return str(value) in _values(_field(doc, field, index, doc_id))
+    if kind == 'terms':
+        (field, values), = spec.items()
+        wanted = {str(v) for v in values}
+        return bool(wanted & set(_values(_field(doc, field, index, doc_id))))
+    if kind == 'range':
+        (field, cond), = spec.items()
+        value = _field(doc, field, index, doc_id)
+        if value is None:
+            return False
+        ok = True
+        for op, bound in cond.items():
+            if op == 'gte':
+                ok &= value >= bound
+            elif op == 'gt':
+                ok &= value > bound
+            elif op == 'lte':
+                ok &= value <= bound
+            elif op == 'lt':
+                ok &= value < bound
+        return ok
+    if kind == 'bool':
+        def _as_list(v):
+            return v if isinstance(v, list) else [v] if v else []
+        for q in _as_list(spec.get('must')) + _as_list(spec.get('filter')):
+            if not _match(q, index, doc_id, doc):
+                return False
+        for q in _as_list(spec.get('must_not')):
+            if _match(q, index, doc_id, doc):
+                return False
+        should = _as_list(spec.get('should'))
+        if should and not any(_match(q, index, doc_id, doc) for q in should):
+            return False
+        return True
+    if kind == 'simple_query_string':
+        terms = spec['query'].split()
+        if terms == ['*']:
+            return True
+        text = ' '.join(
+            ' '.join(_values(_field(doc, f, index, doc_id)))
+            for f in spec.get('fields', [])
+        ).lower()
+        return all(t.strip('"*').lower() in text for t in terms)
+    raise NotImplementedError(f'query type {kind}')
+
+
+def _sort_key(sort, index, doc_id, doc, cluster=None):
+    key = []
+    for s in sort:
+        if isinstance(s, str):
+            field, order = s, 'asc'
+        else:
+            (field, opts), = s.items()
+            order = opts.get('order', 'asc') if isinstance(opts, dict) else opts
+        if field == '_shard_doc':
+            value = (cluster or FakeNode.cluster).shard_docs.get((index, doc_id), 0)
+        else:
+            value = _field(doc, field, index, doc_id)
+        key.append((value, order))
+    return key
+
+
+class FakeNode(BaseNode):
+    '''Answers Elasticsearch REST calls from a FakeCluster'''
+
+    cluster = FakeCluster()
+
+    def perform_request(self, method, target, body=None, headers=None, request_timeout=None):
+        start = time.perf_counter()
+        parts = urlsplit(target)
+        path = unquote(parts.path)
+        params = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        self.cluster.calls.append((method, path))
+        if self.cluster.latency:
+            time.sleep(self.cluster.latency)
+        if body and path.endswith('/_msearch') or path.endswith('/_bulk'):
+            payload = [json.loads(line) for line in body.decode().splitlines() if line.strip()]
+        else:
+            payload = json.loads(body) if body else {}
+        status, data = self._dispatch(method, path, params, payload)
+        raw = json.dumps(data).encode()
+        meta = ApiResponseMeta(
+            status=status,
+            http_version='1.1',
+            headers=HttpHeaders({
+                'content-type': 'application/json',
+                'x-elastic-product': 'Elasticsearch',
+            }),
+            duration=time.perf_counter() - start,
+            node=self.config,
+        )
+        return NodeApiResponse(meta, raw)
+
+    def close(self):
+        pass
+
+    # Dispatch
+
+    def _dispatch(self, method, path, params, body):
+        c = self.cluster
+        segs = [s for s in path.split('/') if s]
+        if segs == ['_msearch'] or segs[-1:] == ['_msearch']:
+            default_index = segs[0] if len(segs) == 2 else None
+            responses = []
+            for header, query in zip(body[::2], body[1::2]):
+                status, resp = self._search(header.get('index', default_index), query)
+                resp['status'] = status
+                responses.append(resp)
+            return 200, {'took': 0, 'responses': responses}
+        if segs[-1] == '_search':
+            index = segs[0] if len(segs) == 2 else None
+            return self._search(index, body, params)
+        if segs[-1] == '_count':
+            index = segs[0] if len(segs) == 2 else None
+            query = body.get('query')
+            n = sum(1 for i, d, doc in c.docs(c.resolve(index)) if _match(query, i, d, doc))
+            return 200, {'count': n}
+        if segs[-1] == '_pit' and method == 'POST':
+            pit_id = f'pit-{next(c._pit_seq)}'
+            c.pits[pit_id] = c.resolve(segs[0])
+            return 200, {'id': pit_id}
+        if segs == ['_pit'] and method == 'DELETE':
+            c.pits.pop(body.get('id'), None)
+            return 200, {'succeeded': True, 'num_freed': 1}
+        if segs[-1] == '_mget':
+            default_index = segs[0] if len(segs) == 2 else None
+            docs = []
+            for spec in body.get('docs') or [{'_id': i} for i in body['ids']]:
+                docs.append(self._get(spec.get('_index', default_index), str(spec['_id']), spec.get('_source', True)))
+            return 200, {'docs': docs}
+        if len(segs) == 3 and segs[1] == '_doc':
+            index, doc_id = segs[0], segs[2]
+            if method == 'GET':
+                source = params.get('_source', 'true') != 'false'
+                doc = self._get(index, doc_id, source)
+                return (200 if doc['found'] else 404), doc
+            if method in ('PUT', 'POST'):
+                c.add(index, doc_id, body)
+                return 201, {'_index': index, '_id': doc_id, 'result': 'created'}
+        if segs[-1] == '_mapping' and method == 'PUT':
+            return 200, {'acknowledged': True}
+        if len(segs) == 1 and method == 'HEAD':
+            return (200 if segs[0] in c.indices else 404), {}
+        if segs[-1] == '_settings':
+            names = c.resolve(segs[0] if len(segs) == 2 else None)
+            if method == 'PUT':
+                for name in names:
+                    for k, v in body.items():
+                        if v is None:
+                            c.settings.setdefault(name, {}).pop(k, None)
+                        else:
+                            c.settings.setdefault(name, {})[k] = v
+                return 200, {'acknowledged': True}
+            if not names:
+                return 404, {'error': {'type': 'index_not_found_exception'}, 'status': 404}
+            return 200, {n: {'settings': dict(c.settings.get(n, {}))} for n in names}
+        if '_stats' in segs:
+            names = c.resolve(segs[0] if segs[0] != '_stats' else None)
+            return 200, {'indices': {
+                n: {'primaries': {'docs': {'count': len(c.indices[n])}, 'indexing': {'index_total': len(c.indices[n])}}}
+                for n in names
+            }}
+        if segs[-1] == '_bulk':
+            items = []
+            lines = iter(body)
+            for action in lines:
+                (op, meta), = action.items()
+                index = meta.get('_index', segs[0] if len(segs) == 2 else None)
+                doc_id = str(meta['_id'])
+                if op == 'delete':
+                    c.indices.get(index, {}).pop(doc_id, None)
+                    items.append({op: {'_index': index, '_id': doc_id, 'status': 200}})
+                    continue
+                source = next(lines)
+                if op == 'update':
+                    existing = c.indices.get(index, {}).get(doc_id)
+                    if existing is None:
+                        items.append({op: {'_index': index, '_id': doc_id, 'status': 404, 'error': {'type': 'document_missing_exception'}}})
+                        continue
+
+                    def merge(into, doc):
+                        for k, v in doc.items():
+                            if isinstance(v, dict) and isinstance(into.get(k), dict):
+                                merge(into[k], v)
+                            else:
+                                into[k] = v
+                    merge(existing, source['doc'])
+                else:
+                    c.add(index, doc_id, source)
+                items.append({op: {'_index': index, '_id': doc_id, 'status': 200}})
+            return 200, {'took': 0, 'errors': any(i[next(iter(i))]['status'] >= 300 for i in items), 'items': items}
+        if len(segs) == 1 and method == 'DELETE':
+            for name in c.resolve(segs[0]):
+                c.indices.pop(name, None)
+                c.settings.pop(name, None)
+            return 200, {'acknowledged': True}
+        if len(segs) == 1 and method == 'PUT':
+            c.indices.setdefault(segs[0], {})
+            c.settings.setdefault(segs[0], {}).update(body.get('settings', {}))
+            return 200, {'acknowledged': True}
+        if len(segs) == 2 and segs[1] == '_refresh':
+            return 200, {}
+        return 404, {'error': {'type': 'unsupported', 'reason': f'{method} {path}'}, 'status': 404}
+
+    def _get(self, index, doc_id, source=True):
+        c = self.cluster
+        for name in c.resolve(index):
+            if (doc := c.indices[name].get(doc_id)) is not None:
+                hit = {'_index': name, '_id': doc_id, 'found': True}
+                if source:
+                    src = json.loads(json.dumps(doc))
+                    if isinstance(source, list):
+                        src = {k: v for k, v in src.items() if k in source}
+                    hit['_source'] = src
+                return hit
+        return {'_index': index, '_id': doc_id, 'found': False}
+
+    def _search(self, index, body, params=None):
+        c = self.cluster
+        body = dict(body or {})
+        if pit := body.get('pit'):
+            if pit['id'] not in c.pits:
+                return 404, {'error': {'type': 'search_context_missing_exception'}, 'status': 404}
+            indices = c.pits[pit['id']]
+        else:
+            indices = c.resolve(index)
+        query = body.get('query')
+        matched = [(i, d, doc) for i, d, doc in c.docs(indices) if _match(query, i, d, doc)]
+        if sort := body.get('sort'):
+            def key(item, _sort=sort):
+                return _sort_key(_sort, *item)
+
+            def sort_value(item, pos):
+                value = key(item)[pos][0]
+                return value is None, 0 if value is None else value
+            for pos in reversed(range(len(sort))):
+                matched.sort(
+                    key=lambda item, p=pos: sort_value(item, p),
+                    reverse=key(matched[0])[pos][1] == 'desc' if matched else False,
+                )
+        if after := body.get('search_after'):
+            def past(item):
+                for (value, order), a in zip(_sort_key(sort, *item), after):
+                    if value == a:
+                        continue
+                    return value > a if order == 'asc' else value < a
+                return False
+            matched = [m for m in matched if past(m)]
+        total = len(matched)
+        size = body.get('size', 10)
+        start = body.get('from', 0)
+        page = matched[start:start + size]
+        source = body.get('_source', True)
+        hits = []
+        for i, d, doc in page:
+            hit = {'_index': i, '_id': d, '_score': 1.0}
+            if source is not False:
+                src = json.loads(json.dumps(doc))
+                if isinstance(source, (list, dict)):
+                    includes = source if isinstance(source, list) else source.get('includes', [])
+                    src = {k: v for k, v in src.items() if any(fnmatch.fnmatchcase(k, inc.split('.')[0]) for inc in includes)}
+                hit['_source'] = src
+            if sort:
+                hit['sort'] = [v for v, _ in _sort_key(sort, i, d, doc)]
+            hits.append(hit)
+        resp = {
+            'took': 0,
+            'timed_out': False,
+            'hits': {'total': {'value': total, 'relation': 'eq'}, 'hits': hits},
+        }
+        if body.get('pit'):
+            resp['pit_id'] = body['pit']['id']
+        if aggs := body.get('aggs'):
+            resp['aggregations'] = {}
+            for name, agg in aggs.items():
+                if 'max' in agg:
+                    field = agg['max']['field']
+                    values = [v for i, d, doc in matched for v in _values(_field(doc, field, i, d))]
+                    resp['aggregations'][name] = {'value': max(values) if values else None}
+                    continue
+                field = agg['terms']['field']
+                counts: dict[str, int] = {}
+                for i, d, doc in matched:
+                    for v in _values(_field(doc, field, i, d)):
+                        counts[v] = counts.get(v, 0) + 1
+                buckets = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))[:agg['terms'].get('size', 10)]
+                resp['aggregations'][name] = {'buckets': [{'key': k, 'doc_count': n} for k, n in buckets]}
+        return 200, resp
@@ -0,0 +1,118 @@
+'''
+A synthetic archive and timing helpers shared by the benchmarks.
+'''
+
+import time
+import random
+import statistics
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from collections.abc import Iterator
+
+WORDS = (
+    'archive tweet keyboard dog coffee python search elastic server cat '
+    'morning rain train music book code night weekend photo video'
+).split()
+USERS = ('alice', 'bob', 'carol', 'dave')
+
+
+def make_tweet(rng: random.Random, i: int, ts: datetime) -> dict:
+    '''A tweet with a hashtag, a mention, a link and sometimes media'''
+    tweet_id = 10 ** 17 + i
+    screen_name = rng.choice(USERS)
+    words = rng.choices(WORDS, k=8)
+    text = f'#{words[0]} @{rng.choice(USERS)} ' + ' '.join(words[1:]) + ' https://t.co/abcdefgh'
+    mention_end = text.index(' ', len(words[0]) + 2)
+    tweet = {
+        'id': tweet_id,
+        'id_str': str(tweet_id),
+        'full_text': text,
+        'created_at': ts.strftime('%a %b %d %H:%M:%S %z %Y'),
+        '@timestamp': ts.isoformat(),
+        'source': '<a href="https://twitter.com">Twitter Web App</a>',
+        'user': {
+            'screen_name': screen_name,
+            'name': screen_name.title(),
+            'profile_image_url_https': f'https://pbs.twimg.com/profile_images/{screen_name}.jpg',
+        },
+        'entities': {
+            'hashtags': [{'text': words[0], 'indices': [0, len(words[0]) + 1]}],
+            'user_mentions': [{
+                'screen_name': text[len(words[0]) + 3:mention_end],
+                'name': 'Someone',
+                'indices': [len(words[0]) + 2, mention_end],
+            }],
+            'urls': [{
+                'url': 'https://t.co/abcdefgh',
+                'expanded_url': 'https://example.com/a/b',
+                'display_url': 'example.com/a/b',
+                'indices': [len(text) - 21, len(text)],
+            }],
+        },
+    }
+    if i % 5 == 0:
+        tweet['extended_entities'] = {'media': [{
+            'type': 'photo',
+            'media_url_https': f'https://pbs.twimg.com/media/{tweet_id}.jpg',
+        }]}
+    elif i % 17 == 0:
+        tweet['extended_entities'] = {'media': [{
+            'type': 'video',
+            'media_url_https': f'https://pbs.twimg.com/ext_tw_video_thumb/{tweet_id}.jpg',
+            'video_info': {'variants': [
+                {'bitrate': 832000, 'url': f'https://video.twimg.com/ext_tw_video/{tweet_id}/480x270.mp4'},
+                {'bitrate': 2176000, 'url': f'https://video.twimg.com/ext_tw_video/{tweet_id}/1280x720.mp4'},
+                {'content_type': 'application/x-mpegURL', 'url': f'https://video.twimg.com/ext_tw_video/{tweet_id}/pl.m3u8'},
+            ]},
+        }]}
+    if i % 7 == 0 and i:
+        tweet['in_reply_to_status_id'] = tweet_id - 1
+        tweet['in_reply_to_screen_name'] = screen_name
+    return tweet
+
+
+def make_toot(rng: random.Random, i: int, ts: datetime) -> dict:
+    content = ' '.join(rng.choices(WORDS, k=10))
+    return {
+        'id': str(10 ** 17 + i),
+        'url': f'https://example.social/@me/{10 ** 17 + i}',
+        'created_at': ts.isoformat(),
+        '@timestamp': ts.isoformat(),
+        'content': f'<p>{content}</p>',
+        'content_text': content,
+        'spoiler_text': '',
+        'account': {
+            'id': '1',
+            'url': 'https://example.social/@me',
+            'fqn': 'me@example.social',
+            'display_name': 'Me',
+            'avatar': 'https://example.social/avatar.png',
+        },
+        'media_attachments': [],
+        'in_reply_to_id': None,
+        'in_reply_to_account_id': None,
+    }
+
+
+def make_tweets(n: int, seed: int = 0, interval: timedelta = timedelta(minutes=10)) -> Iterator[dict]:
+    '''n tweets, interval apart from the start of 2009'''
+    rng = random.Random(seed)
+    start = datetime(2009, 1, 1, tzinfo=timezone.utc)
+    for i in range(n):
+        yield make_tweet(rng, i, start + i * interval)
+
+
+def percentiles(samples: list[float]) -> tuple[float, float, float]:
+    q = statistics.quantiles(samples, n=100)
+    return q[49], q[94], q[98]
+
+
+def measure(fn, repeat: int) -> list[float]:
+    fn()  # warm up
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
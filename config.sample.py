@@ -1,14 +1,67 @@
 
 class Config:
 
+    # Where tweets are stored: 'elasticsearch', or 'sqlite' for a database
+    # made with `python -m ash.sqlite load` (see src/ash/sqlite.py)
+    T_BACKEND = 'elasticsearch'
+    T_SQLITE_PATH = 'tweets.sqlite3'
+
     # Elasticsearch
     T_ES_HOST = 'http://localhost:9200'
     T_ES_INDEX = 'tweets-*,toots-*'
 
+    # Each worker process keeps one long-lived Elasticsearch client. These
+    # control its connection pool size, request timeout (seconds) and retries.
+    # With threaded workers, make the pool as large as the number of threads.
+    T_ES_POOL_CONNECTIONS = 10
+    T_ES_POOL_TIMEOUT = 10
+    T_ES_POOL_RETRIES = 3
+
+    # Independent queries of a page (e.g. the search and its facets) run
+    # concurrently on this many threads per worker. 0 runs them in turn.
+    T_FAN_OUT_THREADS = 8
+
+    # Identical lookups (a tweet, a search) made by concurrent requests of a
+    # worker are sent to Elasticsearch once, and their result is shared.
+    T_SINGLE_FLIGHT = True
+
+    # How many tweet ID -> index mappings to remember, so that repeated
+    # lookups of the same tweet are served by a single-shard GET
+    T_ES_ID_CACHE_SIZE = 65536
+
+    # Render pages from the @view stored with each document (see `ash
+    # reindex-views`), fetching nothing else
+    T_ES_VIEWS = False
+
+    # How many tweets to keep rendered text (linkified URLs, hashtags and
+    # mentions) of
+    T_TEXT_CACHE_SIZE = 4096
+
+    # Tweet pages are cached after first render, and served with an ETag and
+    # a Cache-Control max-age (seconds). They are rendered again once tweets
+    # are ingested, which is checked every T_FACETS_TTL seconds with one
+    # small search. Tweets fetched from Twitter are not cached, and
+    # revalidated on every use.
+    T_TWEET_CACHE_SIZE = 1024
+    T_TWEET_CACHE_MAX_AGE = 86400
+
+    # Each worker caches tweet pages and search facets in its own memory. With
+    # 'sqlite', they are also kept in a file shared by all workers on the
+    # host, which survives reloads. Its values are bounded to about
+    # T_CACHE_MAX_BYTES, least recently used first out. Bump T_CACHE_VERSION
+    # to invalidate everything in it. T_CACHE_BACKEND may also be a callable
+    # taking a namespace and returning a cache like ash.cache.SQLiteCache.
+    T_CACHE_BACKEND = 'memory'
+    T_CACHE_PATH = 'ash-cache.sqlite3'
+    T_CACHE_MAX_BYTES = 256 * 2**20
+    T_CACHE_VERSION = 1
+
     # Where to load media files
     # direct: Media files are hotlinked from Twitter
     # mirror: Media files are served from T_MEDIA_MIRRORS
     # filesystem: Media files are served from T_MEDIA_FS_PATH
+    # It can also be a chain of them, e.g. ('filesystem', 'mirror', 'direct'):
+    # each media file is then served from the first one that has it
     T_MEDIA_FROM = 'direct'
 
     # You can also use mirror domains in case your Twitter account no longer
@@ -18,9 +71,53 @@ class Config:
         'video.twimg.com': 'd1111111111.cloudfront.net/video.twimg.com',
     }
 
-    # Directory path if loading images from filesystem
+    # Directory path if loading images from filesystem. A relative path is
+    # relative to the ash package (src/ash), not to the working directory
     T_MEDIA_FS_PATH = './media'
 
+    # In a chain, which files are in T_MEDIA_FS_PATH is indexed in memory,
+    # and checked for changes every T_MEDIA_RESCAN_INTERVAL seconds. The index
+    # is saved to T_MEDIA_MANIFEST (if set), so that it is not rebuilt from
+    # scratch by every worker. Prebuild it with `ash media-index`. Like
+    # T_MEDIA_FS_PATH, a relative path is relative to src/ash.
+    T_MEDIA_MANIFEST = 'media-manifest.json'
+    T_MEDIA_RESCAN_INTERVAL = 60
+
+    # A file listing URLs on the mirror, one per line (relative to src/ash,
+    # like T_MEDIA_MANIFEST). Without it, all media is assumed to be on the
+    # mirror.
+    T_MEDIA_MIRROR_MANIFEST = None
+
+    # Show resized WebP images and video posters (made on first request, or
+    # ahead of time with `ash derivatives`) of media served from the
+    # filesystem, and keep them in T_MEDIA_CACHE_PATH (relative to src/ash,
+    # like T_MEDIA_FS_PATH). Needs Pillow for images and ffmpeg for videos.
+    T_MEDIA_DERIVATIVES = False
+    T_MEDIA_CACHE_PATH = './media-cache'
+
+    # Media files are served with an immutable Cache-Control of this many
+    # seconds
+    T_MEDIA_MAX_AGE = 365 * 86400
+
+    # Have the front proxy send media files instead of Python workers:
+    # x-accel-redirect: nginx, with internal locations aliasing
+    #   T_MEDIA_ACCEL_PREFIX to T_MEDIA_FS_PATH and
+    #   T_MEDIA_CACHE_ACCEL_PREFIX to T_MEDIA_CACHE_PATH
+    # x-sendfile: Apache mod_xsendfile, lighttpd, etc.
+    T_MEDIA_OFFLOAD = None
+    T_MEDIA_ACCEL_PREFIX = '/_media/'
+    T_MEDIA_CACHE_ACCEL_PREFIX = '/_media-cache/'
+
+    # Users and indexes listed on the search page are cached for this many
+    # seconds. After that, they are refreshed in the background, and the
+    # aggregations only re-run if the indexes have changed.
+    T_FACETS_TTL = 300
+
+    # Search results are paged through an Elasticsearch point-in-time, which
+    # is kept open for T_SEARCH_PIT_KEEP_ALIVE between two page views.
+    T_SEARCH_PAGE_SIZE = 100
+    T_SEARCH_PIT_KEEP_ALIVE = '5m'
+
     # Uncomment to enable basic auth on search page
     #T_SEARCH_BASIC_AUTH = {'username': 'foo', 'password': 'bar'}
 
@@ -30,6 +127,25 @@ class Config:
     #T_TWITTER_KEY = 'consumer key'
     #T_TWITTER_SECRET = 'consumer secret'
 
+    # Fetched Tweets, and Tweets Twitter does not have, are cached on disk and
+    # shared by all workers. TTLs are in seconds.
+    T_EXTERNAL_TWEETS_TIMEOUT = 10
+    T_EXTERNAL_TWEETS_CACHE = 'external_tweets.sqlite3'
+    T_EXTERNAL_TWEETS_TTL = 30 * 86400
+    T_EXTERNAL_TWEETS_NEGATIVE_TTL = 86400
+
+    # Uncomment to send a Server-Timing header with every response, showing
+    # time spent in Elasticsearch (and how many calls), rendering tweet text
+    # and templates. Browser developer tools display it.
+    #T_SERVER_TIMING = True
+
+    # Uncomment to serve the same, as Prometheus histograms labelled by view,
+    # at /metrics. Not protected by basic auth. With T_CACHE_BACKEND =
+    # 'sqlite', workers add theirs up through the cache file, so any of them
+    # answers for all. Otherwise each serves its own, labelled by pid: sum
+    # them, e.g. sum without (pid) (rate(ash_request_duration_seconds_count[5m])).
+    #T_METRICS = True
+
     # Default user to show on index
     #T_DEFAULT_USER = 'jack'
 
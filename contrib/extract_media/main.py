@@ -3,68 +3,106 @@
 '''
 The script extracts pbs.twimg.com URLs from Twitter archive and saves them to a
 local directory.
+
+Progress is kept in a manifest in the output directory: which .js files have
+been read, and which URLs were found, downloaded or failed. A re-run only
+reads .js files that have changed, and only requests what is still missing.
+
+Files are stored by content: a file whose bytes are already in the output
+directory (e.g. from another copy of the archive) is hardlinked to them, and
+files in the archive's tweets_media are hardlinked (or reflinked) rather than
+copied, where the filesystem allows.
 '''
 
-import re
-import shutil
 import argparse
+import threading
 from pathlib import Path
 from urllib.parse import urlsplit
-
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 from collections.abc import Iterator
-from collections.abc import Iterable
 
 import scrapy
 from scrapy.crawler import CrawlerProcess
 
+from media_store import Manifest
+from media_store import MediaStore
+from media_store import TweetsMediaCache
+from media_store import find_urls
+
 
 class TwimgExtractor(scrapy.Spider):
     name = 'TwimgExtractor'
 
-    def __init__(self, archive_dir: Path, output_dir: Path, **kwargs):
+    def __init__(self, archive_dir: Path, output_dir: Path, workers: int | None = None,
+                 retry_failed: bool = False, store_threads: int = 4, **kwargs):
         self.js_files = (archive_dir / 'data').rglob('*.js')
         self.media_dir = archive_dir / 'data/tweets_media'
         self.output_dir = output_dir
+        self.workers = workers
+        self.retry_failed = retry_failed
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest = Manifest(output_dir / '.extract_media.sqlite3')
+        self.store = MediaStore(self.manifest)
+        # Files are stored off the crawler thread, with a few waiting at
+        # most: when the disk is slower than the network, the crawl waits
+        # instead of holding every downloaded body in memory
+        self.store_pool = ThreadPoolExecutor(store_threads)
+        self.store_slots = threading.BoundedSemaphore(store_threads * 2)
         super().__init__(**kwargs)
 
     def start_requests(self) -> Iterator[scrapy.Request]:
-        media_cache = TweetsMediaCache(self.media_dir)
-        for url in self.find_urls(self.js_files):
-            if cached := media_cache.get(url):
-                output = self.url_to_fs_path(url, self.output_dir)
-                output.parent.mkdir(parents=True, exist_ok=True)
-                if output.exists():
-                    self.logger.debug(f'Skipped copying as target exists:: {output}')
-                else:
-                    shutil.copy2(cached, output)
-                    self.logger.debug(f'Copied from local: {cached}')
+        added = find_urls(self.js_files, self.manifest, self.workers)
+        self.logger.info(f'Found {added} new URLs; manifest: {self.manifest.counts()}')
+        media_cache = TweetsMediaCache(self.media_dir, self.manifest)
+        for url in self.manifest.pending(self.retry_failed):
+            output = self.url_to_fs_path(url, self.output_dir)
+            if output.exists() and output.stat().st_size > 0:
+                self.logger.debug(f'Skipped as target exists: {output}')
+                self.manifest.mark(url, 'downloaded')
+            elif cached := media_cache.get(url):
+                self.submit_store(self.store_file, url, cached, output)
             else:
-                yield from self.download_url(url)
-
-    def download_url(self, url: str) -> Iterator[scrapy.Request]:
-        output: Path = self.url_to_fs_path(url, self.output_dir)
-        if output.exists() and output.stat().st_size > 0:
-            self.logger.debug(f'Skipped downloading as target exists: {output}')
+                yield scrapy.Request(
+                    url=url,
+                    callback=self.write_to_disk,
+                    errback=self.download_failed,
+                    # Redirects change request.url: keep the URL of the manifest
+                    cb_kwargs={'url': url, 'output': output},
+                )
+
+    def submit_store(self, fn, *args) -> None:
+        self.store_slots.acquire()
+        future = self.store_pool.submit(fn, *args)
+        future.add_done_callback(lambda _: self.store_slots.release())
+
+    def store_file(self, url: str, cached: Path, output: Path) -> None:
+        try:
+            self.store.add_file(cached, output)
+        except OSError as e:
+            self.logger.error(f'Failed to store {cached}: {e}')
+            self.manifest.mark(url, 'failed', repr(e))
         else:
-            yield scrapy.Request(url=url, callback=self.write_to_disk, cb_kwargs={'output': output})
+            self.logger.debug(f'Stored from local: {cached}')
+            self.manifest.mark(url, 'downloaded')
+
+    def write_to_disk(self, response, url: str, output: Path):
+        self.submit_store(self.store_bytes, url, response.body, output)
+
+    def store_bytes(self, url: str, data: bytes, output: Path) -> None:
+        try:
+            self.store.add_bytes(data, output)
+        except OSError as e:
+            self.logger.error(f'Failed to store {output}: {e}')
+            self.manifest.mark(url, 'failed', repr(e))
+        else:
+            self.manifest.mark(url, 'downloaded')
 
-    def write_to_disk(self, response, output: Path):
-        output.parent.mkdir(parents=True, exist_ok=True)
-        output.write_bytes(response.body)
+    def closed(self, reason):
+        self.store_pool.shutdown(wait=True)
+        self.logger.info(f'Manifest: {self.manifest.counts()}')
 
-    @staticmethod
-    def find_urls(js_files: Iterable[Path]) -> Iterator[str]:
-        twimg_url_re = re.compile(r'(?<=")https://(pbs|video).twimg.com/.*?(?=")')
-        seen = set()
-        for js_file in js_files:
-            with open(js_file, 'r') as f:
-                for line in f:
-                    if matched := twimg_url_re.search(line):
-                        url = matched.group(0)
-                        if url not in seen:
-                            yield url
-                            seen.add(url)
+    def download_failed(self, failure):
+        self.manifest.mark(failure.request.cb_kwargs['url'], 'failed', repr(failure.value))
 
     @staticmethod
     def url_to_fs_path(url: str, parent: Path) -> Path:
@@ -72,26 +110,24 @@ class TwimgExtractor(scrapy.Spider):
         return parent / f'{parts.netloc}{parts.path}'
 
 
-class TweetsMediaCache:
-    def __init__(self, media_dir: Path) -> None:
-        self._dict = dict()
-        for file in media_dir.glob('*'):
-            key = file.name.split('-', 1)[1]
-            self._dict[key] = file
-
-    def get(self, url: str) -> Optional[Path]:
-        key = Path(urlsplit(url).path).name
-        return self._dict.get(key)
-
-
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument('archive_dir', type=Path, help='directory of extracted Twitter archive')
     ap.add_argument('-o', '--output_dir', type=Path, help='directory to save media files into', default=Path('output_dir'))
+    ap.add_argument('-j', '--workers', type=int, help='processes reading .js files (default: number of CPUs)')
+    ap.add_argument('--retry-failed', action='store_true', help='request URLs that failed before again')
+    ap.add_argument('--store-threads', type=int, default=4, help='threads linking and writing files')
     args = ap.parse_args()
 
     process = CrawlerProcess()
-    process.crawl(TwimgExtractor, archive_dir=args.archive_dir, output_dir=args.output_dir)
+    process.crawl(
+        TwimgExtractor,
+        archive_dir=args.archive_dir,
+        output_dir=args.output_dir,
+        workers=args.workers,
+        retry_failed=args.retry_failed,
+        store_threads=args.store_threads,
+    )
     process.start()
 
 
@@ -0,0 +1,246 @@
+'''
+Find twimg URLs in Twitter archives, and keep track of them and of the media
+files stored for them, for main.py. Nothing here needs Scrapy.
+'''
+
+import os
+import re
+import json
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor
+
+from typing import Optional
+from collections.abc import Iterator
+from collections.abc import Iterable
+
+
+twimg_url_re = re.compile(r'https://(?:pbs|video)\.twimg\.com/[^"\s\\]+')
+
+
+def _walk_urls(obj, urls: set) -> None:
+    if isinstance(obj, str):
+        if obj.startswith(('https://pbs.twimg.com/', 'https://video.twimg.com/')):
+            urls.add(obj)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _walk_urls(value, urls)
+    elif isinstance(obj, list):
+        for value in obj:
+            _walk_urls(value, urls)
+
+
+def urls_in_file(js_file: Path) -> list[str]:
+    '''Return all twimg URLs in an archive .js file, video variants included
+
+    The file is parsed as the JSON it wraps, so that URLs are found wherever
+    they are. Files that do not parse are scanned for every URL-like string.
+    '''
+    text = js_file.read_text(encoding='utf-8')
+    urls = set()
+    start = min((i for i in (text.find('['), text.find('{')) if i >= 0), default=-1)
+    try:
+        if start < 0:
+            raise ValueError
+        _walk_urls(json.loads(text[start:]), urls)
+    except ValueError:
+        urls.update(twimg_url_re.findall(text))
+    return sorted(urls)
+
+
+class Manifest:
+    '''What has been found, downloaded or failed, and what is stored where,
+    in a SQLite database shared by the crawler and the storing threads'''
+
+    def __init__(self, path: Path) -> None:
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER);
+            CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, state TEXT NOT NULL, error TEXT);
+            CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, path TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT);
+            CREATE TABLE IF NOT EXISTS archive_media (name TEXT PRIMARY KEY, path TEXT NOT NULL);
+        ''')
+
+    def execute(self, sql: str, params=()) -> list[tuple]:
+        with self.lock, self.conn:
+            return self.conn.execute(sql, params).fetchall()
+
+    def executemany(self, sql: str, rows: Iterable) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany(sql, rows)
+
+    def is_read(self, source: Path) -> bool:
+        '''Whether source (a file or directory) is unchanged since set_read()'''
+        stat = source.stat()
+        rows = self.execute('SELECT size, mtime_ns FROM sources WHERE path = ?', (str(source.resolve()),))
+        return rows == [(stat.st_size, stat.st_mtime_ns)]
+
+    def set_read(self, source: Path) -> None:
+        stat = source.stat()
+        self.execute(
+            'INSERT OR REPLACE INTO sources (path, size, mtime_ns) VALUES (?, ?, ?)',
+            (str(source.resolve()), stat.st_size, stat.st_mtime_ns),
+        )
+
+    def add(self, js_file: Path, urls: Iterable[str]) -> int:
+        '''Record URLs found in js_file. Returns how many are new.'''
+        with self.lock:
+            before = self.conn.total_changes
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO urls (url, state) VALUES (?, 'found')",
+                    ((url,) for url in urls),
+                )
+            added = self.conn.total_changes - before
+            self.set_read(js_file)
+        return added
+
+    def pending(self, retry_failed: bool = False) -> list[str]:
+        states = ('found', 'failed') if retry_failed else ('found',)
+        rows = self.execute(
+            f'SELECT url FROM urls WHERE state IN ({",".join("?" * len(states))}) ORDER BY url', states,
+        )
+        return [url for url, in rows]
+
+    def mark(self, url: str, state: str, error: str | None = None) -> None:
+        self.execute('UPDATE urls SET state = ?, error = ? WHERE url = ?', (state, error, url))
+
+    def counts(self) -> dict[str, int]:
+        return dict(self.execute('SELECT state, count(*) FROM urls GROUP BY state'))
+
+
+def _reflink(src: Path, dest: Path) -> bool:
+    '''Clone src to dest sharing its blocks (Btrfs, XFS), if possible'''
+    try:
+        import fcntl
+        with open(src, 'rb') as s, open(dest, 'wb') as d:
+            fcntl.ioctl(d.fileno(), 0x40049409, s.fileno())  # FICLONE
+        return True
+    except (ImportError, OSError):
+        dest.unlink(missing_ok=True)
+        return False
+
+
+@contextmanager
+def _staged(dest: Path) -> Iterator[Path]:
+    '''Yield a path to put the content of dest at, moved to dest after
+
+    The path is unique: several threads may store the same dest at once, e.g.
+    video variants whose URLs differ only by query string.
+    '''
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix='.tmp-', dir=dest.parent) as tmp_dir:
+        tmp = Path(tmp_dir) / dest.name
+        yield tmp
+        os.replace(tmp, dest)
+
+
+def link_or_copy(src: Path, dest: Path) -> None:
+    '''Make dest have the content of src, without copying bytes if the
+    filesystem allows'''
+    with _staged(dest) as tmp:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            if not _reflink(src, tmp):
+                shutil.copy2(src, tmp)
+
+
+class MediaStore:
+    '''Files of the output directory, indexed by the SHA-256 of their content
+
+    Content that is already stored is linked to rather than written again.
+    Hashes of source files are remembered by path, size and mtime, so files
+    are read once however many runs see them.
+    '''
+
+    def __init__(self, manifest: Manifest) -> None:
+        self.manifest = manifest
+
+    def _hash_file(self, path: Path) -> str:
+        stat = path.stat()
+        key = str(path.resolve())
+        rows = self.manifest.execute('SELECT size, mtime_ns, hash FROM hashes WHERE path = ?', (key,))
+        if rows and rows[0][:2] == (stat.st_size, stat.st_mtime_ns):
+            return rows[0][2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self.manifest.execute(
+            'INSERT OR REPLACE INTO hashes (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)',
+            (key, stat.st_size, stat.st_mtime_ns, digest),
+        )
+        return digest
+
+    def _stored(self, digest: str) -> Path | None:
+        rows = self.manifest.execute('SELECT path FROM blobs WHERE hash = ?', (digest,))
+        if rows and (path := Path(rows[0][0])).exists():
+            return path
+        return None
+
+    def _register(self, digest: str, path: Path) -> None:
+        self.manifest.execute('INSERT OR REPLACE INTO blobs (hash, path) VALUES (?, ?)', (digest, str(path.resolve())))
+
+    def add_file(self, src: Path, dest: Path) -> None:
+        digest = self._hash_file(src)
+        if stored := self._stored(digest):
+            link_or_copy(stored, dest)
+        else:
+            link_or_copy(src, dest)
+            self._register(digest, dest)
+
+    def add_bytes(self, data: bytes, dest: Path) -> None:
+        digest = hashlib.sha256(data).hexdigest()
+        if stored := self._stored(digest):
+            link_or_copy(stored, dest)
+            return
+        with _staged(dest) as tmp:
+            tmp.write_bytes(data)
+        self._register(digest, dest)
+
+
+def find_urls(js_files: Iterable[Path], manifest: Manifest, workers: int | None = None) -> int:
+    '''Read .js files that changed since last time in a process pool, one
+    file per task, and record their URLs. Returns how many URLs are new.'''
+    js_files = [f for f in js_files if not manifest.is_read(f)]
+    added = 0
+    with ProcessPoolExecutor(workers) as pool:
+        for js_file, urls in zip(js_files, pool.map(urls_in_file, js_files)):
+            added += manifest.add(js_file, urls)
+    return added
+
+
+class TweetsMediaCache:
+    '''Files in tweets_media of archives by their twimg file name, kept in
+    the manifest and listed again only when the directory changes'''
+
+    def __init__(self, media_dir: Path, manifest: Manifest) -> None:
+        self.manifest = manifest
+        if media_dir.is_dir() and not manifest.is_read(media_dir):
+            manifest.executemany(
+                'INSERT OR REPLACE INTO archive_media (name, path) VALUES (?, ?)',
+                (
+                    (file.name.split('-', 1)[1], str(file.resolve()))
+                    for file in media_dir.glob('*') if '-' in file.name
+                ),
+            )
+            manifest.set_read(media_dir)
+
+    def get(self, url: str) -> Optional[Path]:
+        key = Path(urlsplit(url).path).name
+        rows = self.manifest.execute('SELECT path FROM archive_media WHERE name = ?', (key,))
+        if rows and (path := Path(rows[0][0])).exists():
+            return path
+        return None
@@ -8,92 +8,202 @@ attributes for tweets ranging from 2009 to 2010. The "created_at" attributes of
 affected tweets (~10000) have correct date portions but their time portions are
 reset to "00:00:00" of that day for an unknown reason.
 
-This script is a quick and dirty way to fix this: it iterates over the
-JavaScript files, finding out problematic tweets and retrieve correct
-"created_at" from Twitter archives downloaded before mid-2013, and finally
-replace the incorrect "created_at" attributes with correct ones.
+This script fixes this: it reads the correct "created_at" of every tweet from
+Twitter archives downloaded before mid-2013 into a compact index (two sorted
+arrays of IDs and epochs), then finds problematic tweets in the JavaScript
+files of newer archives and overwrites their "created_at" in place. A
+corrected timestamp has the same length as the incorrect one, so files are
+patched through mmap and nothing else in them is rewritten.
+
+With --es-host, the same correction is applied to tweets already loaded into
+Elasticsearch, as bulk partial updates.
 '''
 
 import os
 import re
 import glob
-import json
+import mmap
+import bisect
 import argparse
-import itertools
+from array import array
 from datetime import datetime
-
-
-def load_file(filename):
-    with open(filename, 'r') as f:
-        # drop the first line
-        lines = f.readlines()
-        content = ''.join(lines[1:])
-        data = json.loads(content)
-    return data
-
-
-def load_files(filenames):
-    data = itertools.chain.from_iterable(
-        load_file(filename) for filename in filenames
-    )
-    return data
+from datetime import timezone
+from collections.abc import Iterable
+from collections.abc import Iterator
+
+from ash.archive import parse_created_at
+from ash.archive import iter_json_array
+
+
+# Mon Jun 29 15:46:31 +0000 2009
+# 2017-08-17 12:57:51 +0000
+old_ts_format = '%a %b %d %H:%M:%S %z %Y'
+new_ts_format = '%Y-%m-%d %H:%M:%S %z'
+
+# Top-level attributes only, not those of users or retweeted statuses
+created_at_re = re.compile(rb'^  "created_at" : "(\d{4}-\d{2}-\d{2} 00:00:00 \+0000)",', re.M)
+id_re = re.compile(rb'^  "id" : (\d+),', re.M)
+
+# Tweets are objects of the top-level array, and only their braces are not
+# indented: the previous one ends with "}, {" and the last one with "} ]"
+object_start = b'\n}, {'
+object_end = b'\n}'
+
+
+class CreatedAtIndex:
+    '''Tweet ID -> created_at (epoch seconds) in two sorted arrays, about 16
+    bytes per tweet once built'''
+
+    def __init__(self, pairs: Iterable[tuple[int, int]]) -> None:
+        ids = array('Q')
+        epochs = array('q')
+        for tweet_id, epoch in pairs:
+            ids.append(tweet_id)
+            epochs.append(epoch)
+        # The list of indices only lives while sorting
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        self.ids = array('Q', map(ids.__getitem__, order))
+        self.epochs = array('q', map(epochs.__getitem__, order))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def get(self, tweet_id: int) -> int | None:
+        i = bisect.bisect_left(self.ids, tweet_id)
+        if i < len(self.ids) and self.ids[i] == tweet_id:
+            return self.epochs[i]
+        return None
+
+    @classmethod
+    def from_files(cls, filenames: Iterable[str]) -> 'CreatedAtIndex':
+        def pairs():
+            for filename in filenames:
+                with open(filename, encoding='utf-8') as f:
+                    # One tweet at a time
+                    for tweet in iter_json_array(f):
+                        yield int(tweet['id']), int(parse_created_at(tweet['created_at']).timestamp())
+        return cls(pairs())
+
+
+def format_epoch(epoch: int, fmt: str) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime(fmt)
+
+
+def find_fixes(buf, index: CreatedAtIndex, filename: str) -> Iterator[tuple[int, bytes]]:
+    '''Yield (offset, corrected timestamp) of incorrect created_at in buf'''
+    for matched in created_at_re.finditer(buf):
+        # The ID of the tweet that created_at belongs to, and no other
+        start = max(buf.rfind(object_start, 0, matched.start()), 0)
+        if (end := buf.find(object_end, matched.end())) < 0:
+            end = len(buf)
+        ids = list(id_re.finditer(buf, start, end))
+        if len(ids) != 1:
+            raise ValueError(f'Cannot find tweet ID of {filename} @ {matched.start()}')
+        tweet_id = int(ids[0].group(1))
+        if (epoch := index.get(tweet_id)) is None:
+            raise ValueError(f'Cannot retrieve old tweet {tweet_id}.')
+        corrected = format_epoch(epoch, new_ts_format).encode()
+        if corrected != matched.group(1):
+            yield matched.start(1), corrected
+
+
+def fix_file(js: str, index: CreatedAtIndex, dry_run: bool = False) -> int:
+    '''Patch incorrect created_at of js in place. Returns how many there were.'''
+    with open(js, 'r+b') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0) as buf:
+            fixes = list(find_fixes(buf, index, js))
+            if not dry_run:
+                for offset, corrected in fixes:
+                    buf[offset:offset + len(corrected)] = corrected
+                buf.flush()
+    return len(fixes)
+
+
+def fix_es(es_host: str, es_index: str, index: CreatedAtIndex, dry_run: bool = False) -> int:
+    '''Correct created_at (and @timestamp, and the view if any) of tweets in
+    Elasticsearch. Returns how many were corrected.'''
+    from elasticsearch import Elasticsearch
+    from elasticsearch.helpers import streaming_bulk
+    from ash import TweetsDatabase
+
+    if not len(index):
+        return 0
+    es = Elasticsearch(es_host, request_timeout=120)
+    tdb = TweetsDatabase(es, es_index)
+    # Incorrect timestamps are at midnight of the correct day
+    lo = format_epoch(min(index.epochs) - 86400, '%Y-%m-%dT%H:%M:%S+00:00')
+    hi = format_epoch(max(index.epochs), '%Y-%m-%dT%H:%M:%S+00:00')
+
+    def actions():
+        hits = tdb.scan(
+            query={'range': {'@timestamp': {'gte': lo, 'lte': hi}}},
+            source=['created_at', '@view.v'],
+        )
+        for hit in hits:
+            created_at = hit['_source'].get('created_at')
+            try:
+                epoch = index.get(int(hit['_id']))
+            except ValueError:  # not a tweet ID
+                continue
+            if not created_at or epoch is None:
+                continue
+            fmt = new_ts_format if created_at[4] == '-' else old_ts_format
+            corrected = format_epoch(epoch, fmt)
+            if corrected == created_at:
+                continue
+            timestamp = format_epoch(epoch, '%Y-%m-%dT%H:%M:%S+00:00')
+            doc = {
+                'created_at': corrected,
+                '@timestamp': timestamp,
+            }
+            if '@view' in hit['_source']:
+                # Objects are merged, so the rest of the view stays
+                doc['@view'] = {
+                    'created_at': corrected,
+                    '@timestamp': timestamp,
+                    'timestamp': float(epoch),
+                }
+            yield {
+                '_op_type': 'update',
+                '_index': hit['_index'],
+                '_id': hit['_id'],
+                'doc': doc,
+            }
+
+    if dry_run:
+        return sum(1 for _ in actions())
+    count = 0
+    for ok, _ in streaming_bulk(es, actions(), chunk_size=500):
+        count += ok
+    es.indices.refresh(index=es_index)
+    return count
 
 
 def main():
-    # Mon Jun 29 15:46:31 +0000 2009
-    # 2017-08-17 12:57:51 +0000
-    old_ts_format = '%a %b %d %H:%M:%S %z %Y'
-    new_ts_format = '%Y-%m-%d %H:%M:%S %z'
-
     ap = argparse.ArgumentParser()
     ap.add_argument('--old-data', default='./data2')
     ap.add_argument('--new-data', default='./data')
+    ap.add_argument('--es-host', help='also fix tweets in this Elasticsearch cluster')
+    ap.add_argument('--es-index', default='tweets-*', help='indexes to fix tweets in')
+    ap.add_argument('--skip-files', action='store_true', help='do not patch files in --new-data')
+    ap.add_argument('-n', '--dry-run', action='store_true', help='only report what would be fixed')
     args = ap.parse_args()
 
     old_files = glob.glob(os.path.join(args.old_data, 'js/tweets/*.js'))
-    old_data = load_files(old_files)
-    old_db = {i['id']: i for i in old_data}
-
-    new_files = glob.glob(os.path.join(args.new_data, 'js/tweets/*.js'))
-    for js in new_files:
-
-        print('Processing {}'.format(js))
-
-        changed = False
-        new_lines = []
-
-        with open(js, 'r') as f:
-            lines = f.readlines()
-
-        for lineno, line in enumerate(lines):
-            matched = re.match(r'  "created_at" : "(\d{4}-\d{2}-\d{2} 00:00:00 \+0000)",', line)
-            if not matched:
-                new_lines.append(line)
-            else:
-                # possible date mismatches, look behind a few lines for id
-                changed = True
-                before_lines = lines[lineno - 2:lineno]
-                for line in before_lines:
-                    matched_id = re.match(r'  "id" : (\d+),', line)
-                    if matched_id:
-                        break
-                else:
-                    raise ValueError('Cannot find tweet ID in before lines in {} @ L{}:\n{}'.format(js, lineno, before_lines))
-
-                tweet_id = int(matched_id.group(1))
-                try:
-                    old_tweet = old_db[tweet_id]
-                except KeyError:
-                    raise ValueError('Cannot retrieve old tweet {}.'.format(tweet_id)) from None
-                old_ts = datetime.strptime(old_tweet['created_at'], old_ts_format)
-                corrected_ts = old_ts.strftime(new_ts_format)
-                new_line = '  "created_at" : "{}",\n'.format(corrected_ts)
-                new_lines.append(new_line)
-
-        if changed:
-            print('Writing {}'.format(js))
-            with open(js, 'w') as f:
-                f.writelines(new_lines)
+    index = CreatedAtIndex.from_files(old_files)
+    print(f'Indexed {len(index)} tweets from {len(old_files)} files')
+
+    if not args.skip_files:
+        new_files = glob.glob(os.path.join(args.new_data, 'js/tweets/*.js'))
+        for js in new_files:
+            if count := fix_file(js, index, args.dry_run):
+                print(f'{"Would fix" if args.dry_run else "Fixed"} {count} tweets in {js}')
+
+    if args.es_host:
+        count = fix_es(args.es_host, args.es_index, index, args.dry_run)
+        print(f'{"Would fix" if args.dry_run else "Fixed"} {count} tweets in {args.es_index}')
 
 
 if __name__ == '__main__':
@@ -6,24 +6,95 @@ from __future__ import annotations
 
 import os
 import re
+import json
+import time
+import base64
+import sqlite3
 import pprint
+import hashlib
 import itertools
+import contextvars
+import dataclasses
+import mimetypes
+import threading
 from datetime import datetime
+from functools import wraps
 from functools import lru_cache
+from concurrent.futures import wait
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from urllib.parse import urlsplit
 from collections.abc import Mapping
 from collections.abc import Iterator
+from collections.abc import Iterable
+from collections.abc import Sequence
+from collections.abc import Callable
 
 import flask
 import requests
+import werkzeug.utils
+import werkzeug.security
 from flask_httpauth import HTTPBasicAuth
 from elasticsearch import Elasticsearch
+from elasticsearch import NotFoundError
+from elasticsearch import BadRequestError
+from elasticsearch import ApiError
+from elasticsearch.exceptions import HTTP_EXCEPTIONS
+
+from . import metrics
+from .external import TokenError
+from .external import TweetsCache
+from .external import TwitterFetcher
+from .cache import LRUCache
+from .cache import SQLiteCache
+from .cache import TieredCache
+from .singleflight import SingleFlight
+from .derivatives import DerivativeCache
+from .derivatives import can_make as can_make_derivative
+from .media import SOURCES as MEDIA_SOURCES
+from .media import MediaResolver
+from .archive import parse_created_at
 
 
 class DefaultConfig:
+    T_BACKEND = 'elasticsearch'
+    T_SQLITE_PATH = 'tweets.sqlite3'
     T_ES_HOST = 'http://localhost:9200'
     T_ES_INDEX = 'tweets-*,toots-*'
+    T_ES_POOL_CONNECTIONS = 10
+    T_ES_POOL_TIMEOUT = 10
+    T_ES_POOL_RETRIES = 3
+    T_ES_ID_CACHE_SIZE = 65536
+    T_ES_VIEWS = False
+    T_FAN_OUT_THREADS = 8
+    T_SINGLE_FLIGHT = True
+    T_FACETS_TTL = 300
+    T_CACHE_BACKEND = 'memory'
+    T_CACHE_PATH = 'ash-cache.sqlite3'
+    T_CACHE_MAX_BYTES = 256 * 2**20
+    T_CACHE_VERSION = 1
+    T_TEXT_CACHE_SIZE = 4096
+    T_TWEET_CACHE_SIZE = 1024
+    T_TWEET_CACHE_MAX_AGE = 86400
+    T_TWITTER_API = 'https://api.twitter.com'
+    T_EXTERNAL_TWEETS_TIMEOUT = 10
+    T_EXTERNAL_TWEETS_CACHE = 'external_tweets.sqlite3'
+    T_EXTERNAL_TWEETS_TTL = 30 * 86400
+    T_EXTERNAL_TWEETS_NEGATIVE_TTL = 86400
+    T_SEARCH_PAGE_SIZE = 100
+    T_SEARCH_PIT_KEEP_ALIVE = '5m'
     T_MEDIA_FROM = 'direct'
+    T_MEDIA_MANIFEST = None
+    T_MEDIA_MIRROR_MANIFEST = None
+    T_MEDIA_RESCAN_INTERVAL = 60
+    T_MEDIA_DERIVATIVES = False
+    T_MEDIA_CACHE_PATH = './media-cache'
+    T_MEDIA_MAX_AGE = 365 * 86400
+    T_MEDIA_OFFLOAD = None
+    T_MEDIA_ACCEL_PREFIX = '/_media/'
+    T_MEDIA_CACHE_ACCEL_PREFIX = '/_media-cache/'
+    T_SERVER_TIMING = False
+    T_METRICS = False
 
 
 app = flask.Flask(__name__, static_url_path='/tweet/static')
@@ -34,22 +105,8 @@ if not os.environ.get('TESTING'):
     except ImportError:
         pass
 
-
-# Set up external Tweets support
-if app.config.get('T_EXTERNAL_TWEETS'):
-    # https://developer.twitter.com/en/docs/basics/authentication/api-reference/token
-    resp = requests.post(
-        'https://api.twitter.com/oauth2/token',
-        headers={
-            'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8'
-        },
-        auth=(app.config['T_TWITTER_KEY'], app.config['T_TWITTER_SECRET']),
-        data='grant_type=client_credentials'
-    )
-    if not resp.ok:
-        raise RuntimeError(f'Failed to set up external Tweets support. Error from Twitter: {resp.json()}')
-    bearer_token = resp.json()['access_token']
-    app.config['T_TWITTER_TOKEN'] = bearer_token
+# Server-Timing and /metrics
+metrics.init_app(app)
 
 
 # Setup basic auth
@@ -96,6 +153,103 @@ def toot_to_tweet(status: dict) -> dict:
     return status
 
 
+# Version of the views made by make_view. Views of other versions are ignored
+# until they are rebuilt with `ash reindex-views`.
+VIEW_VERSION = 1
+
+
+def extract_media(tweet: dict) -> tuple[list[dict], list[dict]]:
+    '''Return (images, videos) of a tweet with their original URLs
+
+    Videos of toots are marked direct, as they are never mirrored.
+    '''
+    images = []
+    videos = []
+    try:
+        # https://developer.twitter.com/en/docs/tweets/data-dictionary/overview/extended-entities-object
+        entities = tweet['extended_entities']
+    except KeyError:
+        entities = tweet.get('entities') or {}
+    for m in entities.get('media', []):
+        # type is video
+        if m.get('type') == 'video':
+            variants = m['video_info']['variants']
+            hq_variant = max(variants, key=lambda v: int(v.get('bitrate', -1)))
+            videos.append({
+                'url': hq_variant['url'],
+            })
+        elif m.get('type') == 'toot-video':
+            videos.append({
+                'url': m['media_url_https'],
+                'direct': True,
+            })
+        # type is photo (tweet) or image (toot) or None (legacy tweet)
+        elif m.get('type') in ('photo', 'toot-image', None):
+            images.append({
+                'url': m['media_url_https'],
+                'description': m.get('description', '')
+            })
+        # type is unknown
+        else:
+            pass
+    return images, videos
+
+
+def make_view(status: dict) -> dict:
+    '''Precompute everything rendering a tweet or toot needs, to be stored
+    as its @view at ingest time
+
+    A view has the fields the templates read, with the text already rendered
+    as HTML (text_html) and the media already extracted.
+    '''
+    tweet = toot_to_tweet(dict(status))
+    images, videos = extract_media(tweet)
+    view = {
+        'v': VIEW_VERSION,
+        'id': tweet['id'],
+        'created_at': tweet.get('created_at'),
+        '@timestamp': tweet.get('@timestamp'),
+        'timestamp': parse_created_at(tweet.get('@timestamp') or tweet['created_at']).timestamp(),
+        'user': {
+            key: tweet['user'].get(key)
+            for key in ('screen_name', 'name', 'profile_image_url_https')
+        },
+        'text_html': render_entities(tweet),
+        'full_text': tweet.get('content_text') or tweet.get('full_text') or tweet.get('text'),
+        'images': images,
+        'videos': videos,
+    }
+    for key in ('source', 'url', 'spoiler_text', 'media_attachments', 'in_reply_to_status_id',
+                'in_reply_to_screen_name', 'in_reply_to_id', 'in_reply_to_account_id'):
+        if tweet.get(key):
+            view[key] = tweet[key]
+    if account := tweet.get('account'):
+        view['account'] = {'id': account['id']}
+    if retweeted_status := tweet.get('retweeted_status'):
+        view['retweeted_status'] = {'id': retweeted_status['id']}
+    if reblog := tweet.get('reblog'):
+        view['reblog'] = {
+            'url': reblog['url'],
+            'account': {
+                'fqn': reblog['account']['fqn'],
+                'url': reblog['account']['url'],
+            },
+        }
+    return view
+
+
+def hydrate(source: dict, index: str, view: bool = True) -> dict:
+    '''Turn a stored document into a tweet to render, using its @view if it
+    is current (and view is set) or toot_to_tweet otherwise'''
+    stored_view = source.pop('@view', None)
+    if view and stored_view and stored_view.get('v') == VIEW_VERSION:
+        tweet = stored_view
+    else:
+        tweet = toot_to_tweet(source)
+    tweet['@index'] = index
+    return tweet
+
+
 def inject_user_dict(tweet: dict) -> dict:
     if user_dicts := app.config.get('T_USER_DICTS'):
         screen_name = tweet['user']['screen_name']
@@ -104,96 +258,526 @@ def inject_user_dict(tweet: dict) -> dict:
     return tweet
 
 
+def make_shared_cache(namespace: str):
+    '''Return a cache shared by the workers of the host, or None
+
+    T_CACHE_BACKEND is "memory" for none, "sqlite" for a SQLiteCache at
+    T_CACHE_PATH, or a callable taking the namespace and returning an object
+    with the same interface as SQLiteCache. A SQLite file that cannot be
+    opened makes for none too, rather than a worker that cannot start.
+    '''
+    backend = app.config['T_CACHE_BACKEND']
+    if backend == 'memory':
+        return None
+    if backend == 'sqlite':
+        try:
+            return SQLiteCache(
+                app.config['T_CACHE_PATH'],
+                namespace,
+                version=app.config['T_CACHE_VERSION'],
+                max_bytes=app.config['T_CACHE_MAX_BYTES'],
+            )
+        except sqlite3.Error as e:
+            app.logger.warning('Caching %s in this worker only: %s', namespace, e)
+            return None
+    if callable(backend):
+        return backend(namespace)
+    raise ValueError(f'Unknown cache backend: {backend}')
+
+
+def make_cache(namespace: str, local_size: int) -> LRUCache | TieredCache:
+    '''Return a cache of up to local_size entries in this worker, in front of
+    the shared cache if there is one'''
+    local = LRUCache(local_size)
+    if (shared := make_shared_cache(namespace)) is None:
+        return local
+    return TieredCache(local, shared)
+
+
+# Tweet ID -> concrete index name, keyed by (T_ES_INDEX, tweet ID). Once we
+# know which index holds a tweet, it can be fetched with a real-time GET that
+# touches one shard instead of searching every index. Per worker: entries are
+# tiny and misses are batched into one ids query, so a shared write per ID
+# would cost more than it saves.
+_id_index_cache = LRUCache(app.config['T_ES_ID_CACHE_SIZE'])
+
+
+def _hashable(value):
+    if isinstance(value, Mapping):
+        return tuple((k, _hashable(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+def per_process(*config_keys: str):
+    '''Turn a factory taking the values of config_keys (a dict) into a getter
+    of what it makes, made once per worker process and values
+
+    Objects are keyed by PID too, so that one made before gunicorn forks
+    workers (with the app preloaded) is not shared with them.
+    '''
+    def decorator(factory):
+        objs = {}
+        lock = threading.Lock()
+
+        @wraps(factory)
+        def get():
+            config = {k: app.config.get(k) for k in config_keys}
+            key = (os.getpid(), *(_hashable(v) for v in config.values()))
+            if (obj := objs.get(key)) is None:
+                with lock:
+                    if (obj := objs.get(key)) is None:
+                        obj = objs[key] = factory(config)
+            return obj
+        return get
+    return decorator
+
+
+# One Elasticsearch client per worker process, so that keep-alive connections
+# in its pool are reused across requests
+@per_process('T_ES_HOST', 'T_ES_POOL_CONNECTIONS', 'T_ES_POOL_TIMEOUT', 'T_ES_POOL_RETRIES')
+def get_es(config: dict) -> Elasticsearch:
+    return Elasticsearch(
+        config['T_ES_HOST'],
+        connections_per_node=config['T_ES_POOL_CONNECTIONS'],
+        request_timeout=config['T_ES_POOL_TIMEOUT'],
+        max_retries=config['T_ES_POOL_RETRIES'],
+        retry_on_timeout=True,
+        transport_class=metrics.InstrumentedTransport,
+    )
+
+
+# Independent queries of a page run concurrently on a pool shared by the
+# request threads of a worker, so the page waits for the slowest query rather
+# than for all of them in turn
+@per_process('T_FAN_OUT_THREADS')
+def _get_fan_out_pool(config: dict) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(config['T_FAN_OUT_THREADS'], thread_name_prefix='fan-out')
+
+
+def fan_out(*fns: Callable[[], object]) -> list:
+    '''Call fns concurrently, in the context of the current request, and
+    return their results. Exceptions are raised as if fns were called in
+    turn.'''
+    if len(fns) < 2 or not app.config['T_FAN_OUT_THREADS']:
+        return [fn() for fn in fns]
+    pool = _get_fan_out_pool()
+    # Each gets a copy of the context, which shares flask.g with this one
+    futures = [pool.submit(contextvars.copy_context().run, fn) for fn in fns[1:]]
+    try:
+        first = fns[0]()
+    finally:
+        # Not leaving them running past the request
+        wait(futures)
+    return [first, *(future.result() for future in futures)]
+
+
+class SearchRequest:
+    '''A search to run along with others in one _msearch (see
+    TweetsDatabase.msearch), and how to decode its response'''
+
+    def __init__(self, body: dict, decode: Callable[[dict], object], index: str | None = None) -> None:
+        self.body = body
+        self.decode = decode
+        self.index = index
+
+
 class TweetsDatabase(Mapping):
+    '''A per-request view of tweets in es_index, backed by a shared client'''
+
+    # Queries may be made from several threads at once (see fan_out)
+    thread_safe = True
 
-    def __init__(self, es_host: str, es_index: str) -> None:
-        self.es = Elasticsearch(es_host)
+    def __init__(self, es: Elasticsearch, es_index: str, views: bool = False,
+                 single_flight: SingleFlight | None = None) -> None:
+        self.es = es
         self.es_index = es_index
+        # Whether documents carry a @view (see make_view), so that only that
+        # is fetched for rendering
+        self.views = views
+        # Shared by the requests of a worker, so that identical lookups in
+        # flight at the same time are made once
+        self.single_flight = single_flight
+        # Identifies this set of tweets in caches
+        self.name = es_index
+
+    def _source(self, view: bool) -> list[str] | None:
+        return ['@view'] if view and self.views else None
+
+    def _coalesce(self, key: tuple, fn: Callable[[], object]):
+        if self.single_flight is None:
+            return fn()
+        return self.single_flight.do((self.es_index, self.views, *key), fn)
+
+    def _hits_to_tweets(self, hits: list[dict], view: bool = True) -> Iterator[dict]:
+        if view and self.views:
+            # Documents without a current view are fetched in full, in one go
+            stale = {
+                (hit['_index'], hit['_id']): hit
+                for hit in hits
+                if (hit['_source'].get('@view') or {}).get('v') != VIEW_VERSION
+            }
+            if stale:
+                docs = self.es.mget(docs=[
+                    {'_index': index, '_id': tid}
+                    for index, tid in stale
+                ])['docs']
+                for doc in docs:
+                    if doc.get('found'):
+                        stale[(doc['_index'], doc['_id'])]['_source'] = doc['_source']
+        for hit in hits:
+            yield hydrate(hit['_source'], hit['_index'], view)
 
     def _search(self, **kwargs) -> Iterator[dict]:
         if not kwargs.get('index'):
             kwargs['index'] = self.es_index
-        hits = self.es.search(**kwargs)['hits']['hits']
-        for hit in hits:
-            tweet = hit['_source']
-            tweet['@index'] = hit['_index']
-            tweet = toot_to_tweet(tweet)
-            yield tweet
+        hits = self.es.search(source=self._source(True), **kwargs)['hits']['hits']
+        yield from self._hits_to_tweets(hits)
+
+    def _get_hits(self, tweet_ids: Iterable[str | int], source: list[str] | None = None) -> dict[str, dict]:
+        '''Fetch raw hits by ID, keyed by ID. Missing IDs are left out.'''
+        tweet_ids = [str(tid) for tid in tweet_ids]
+        found = {}
+
+        # IDs with a known index: real-time GET, no query phase
+        known = {}
+        for tid in tweet_ids:
+            if index := _id_index_cache.get((self.es_index, tid)):
+                known[tid] = index
+        if known:
+            docs = self.es.mget(docs=[
+                {'_index': index, '_id': tid, **({'_source': source} if source else {})}
+                for tid, index in known.items()
+            ])['docs']
+            for doc in docs:
+                if doc.get('found'):
+                    found[doc['_id']] = doc
+                else:
+                    # Deleted or reindexed elsewhere
+                    _id_index_cache.pop((self.es_index, doc['_id']))
+
+        # Unknown IDs: one ids query across all indexes, remembering where
+        # each one lives
+        if missing := [tid for tid in tweet_ids if tid not in found]:
+            hits = self.es.search(
+                index=self.es_index,
+                query={
+                    'ids': {
+                        'values': missing
+                    }
+                },
+                size=len(missing),
+                source=source,
+            )['hits']['hits']
+            for hit in hits:
+                if hit['_id'] not in found:
+                    _id_index_cache[(self.es_index, hit['_id'])] = hit['_index']
+                    found[hit['_id']] = hit
+
+        return found
+
+    def existing_ids(self, tweet_ids: Iterable[str | int]) -> set[str]:
+        '''Return which of the IDs are in the database, without fetching them'''
+        tweet_ids = {str(tid) for tid in tweet_ids}
+        existing = {tid for tid in tweet_ids if _id_index_cache.get((self.es_index, tid))}
+        if missing := list(tweet_ids - existing):
+            hits = self.es.search(
+                index=self.es_index,
+                query={
+                    'ids': {
+                        'values': missing
+                    }
+                },
+                source=False,
+                size=len(missing),
+            )['hits']['hits']
+            for hit in hits:
+                _id_index_cache[(self.es_index, hit['_id'])] = hit['_index']
+                existing.add(hit['_id'])
+        return existing
 
     def __getitem__(self, tweet_id: str | int) -> dict:
-        resp = self._search(
-            query={
-                'term': {
-                    '_id': tweet_id
-                }
-            })
+        def get():
+            try:
+                hit = self._get_hits([tweet_id], source=self._source(True))[str(tweet_id)]
+            except KeyError:
+                raise KeyError(f'Tweet ID {tweet_id} not found') from None
+            return next(self._hits_to_tweets([hit]))
+        return self._coalesce(('get', str(tweet_id)), get)
+
+    def __iter__(self) -> Iterator[str]:
+        for hit in self.scan(source=False):
+            yield hit['_id']
+
+    def __reversed__(self) -> Iterator[str]:
+        for hit in self.scan(source=False, reverse=True):
+            yield hit['_id']
+
+    def scan(self, *, query=None, index=None, reverse=False, source=True,
+             size=1000, keep_alive='1m') -> Iterator[dict]:
+        '''Iterate over all matching hits by @timestamp, in constant memory
+
+        Hits are read in slices of size from a point-in-time with
+        search_after, which is closed when the iteration ends.
+        '''
+        pit_id = self.es.open_point_in_time(index=index or self.es_index, keep_alive=keep_alive)['id']
+        search_after = None
         try:
-            return next(resp)
-        except StopIteration:
-            raise KeyError(f'Tweet ID {tweet_id} not found') from None
-
-    def __iter__(self) -> Iterator[int]:
-        resp = self._search(
-            sort=['@timestamp'],
-            #size=1000,
-        )
-        for tweet in resp:
-            yield tweet['id']
-
-    def __reversed__(self) -> Iterator[int]:
-        resp = self._search(
-            sort=[{
-                '@timestamp': {'order': 'desc'}
-            }],
-            #size=1000,
-        )
-        for tweet in resp:
-            yield tweet['id']
+            while True:
+                resp = self.es.search(
+                    pit={'id': pit_id, 'keep_alive': keep_alive},
+                    query=query,
+                    sort=[
+                        {'@timestamp': {'order': 'desc' if reverse else 'asc'}},
+                        {'_shard_doc': {'order': 'asc'}},
+                    ],
+                    search_after=search_after,
+                    size=size,
+                    source=source,
+                )
+                hits = resp['hits']['hits']
+                yield from hits
+                if len(hits) < size:
+                    break
+                pit_id = resp.get('pit_id', pit_id)
+                search_after = hits[-1]['sort']
+        finally:
+            self.es.close_point_in_time(id=pit_id)
 
     def __len__(self) -> int:
         return self.es.count(index=self.es_index)['count']
 
-    def search(self, *, keyword=None, user_screen_name=None, index=None, limit=100) -> Iterator[dict]:
-        keyword_query = {
-            'simple_query_string': {
-                'query': keyword,
-                'fields': ['text', 'full_text', 'content_text', 'spoiler_text', 'media_attachments.description'],
-                'default_operator': 'AND',
-            }
+    def msearch(self, requests: Sequence[SearchRequest]) -> list:
+        '''Run searches in one round trip, and return what each decodes to
+
+        A search that fails raises the error it would have raised on its own.
+        '''
+        searches = []
+        for request in requests:
+            # Searches of a point-in-time must not name an index
+            searches.append({} if 'pit' in request.body else {'index': request.index or self.es_index})
+            searches.append(request.body)
+        resp = self.es.msearch(searches=searches)
+        results = []
+        for request, item in zip(requests, resp['responses']):
+            if 'error' in item:
+                status = item.get('status', 500)
+                raise HTTP_EXCEPTIONS.get(status, ApiError)(
+                    message=str(item['error'].get('type', 'search failed')),
+                    meta=dataclasses.replace(resp.meta, status=status),
+                    body=item,
+                )
+            results.append(request.decode(item))
+        return results
+
+    def count_request(self) -> SearchRequest:
+        return SearchRequest(
+            {'size': 0, 'track_total_hits': True},
+            lambda resp: resp['hits']['total']['value'],
+        )
+
+    def latest_request(self, size: int = 10, user_screen_name: str | None = None) -> SearchRequest:
+        body = {
+            'sort': [{
+                '@timestamp': {'order': 'desc'}
+            }],
+            'size': size,
+            'track_total_hits': True,
         }
-        if user_screen_name and '@' in user_screen_name:  # Mastodon
+        if user_screen_name:
+            body['query'] = {
+                'bool': {
+                    'filter': self._user_query(user_screen_name)
+                }
+            }
+        if (source := self._source(True)) is not None:
+            body['_source'] = source
+
+        def decode(resp):
+            return resp['hits']['total']['value'], list(self._hits_to_tweets(resp['hits']['hits']))
+        return SearchRequest(body, decode)
+
+    def latest(self, size: int = 10, user_screen_name: str | None = None) -> tuple[int, list[dict]]:
+        '''Return total number of tweets and the latest tweets (of a user) in
+        one request'''
+        def latest():
+            requests = [self.latest_request(size, user_screen_name)]
+            if user_screen_name:
+                # The total is of all tweets, not only theirs
+                requests.append(self.count_request())
+            (total, tweets), *count = self.msearch(requests)
+            return (count[0] if count else total), tweets
+        return self._coalesce(('latest', size, user_screen_name), latest)
+
+    @staticmethod
+    def _user_query(user_screen_name: str) -> dict:
+        if '@' in user_screen_name:  # Mastodon
             screen_name_field = 'account.fqn.keyword'
         else:  # Twitter
             screen_name_field = 'user.screen_name.keyword'
-        user_query = {
+        return {
             'term': {
                 screen_name_field: user_screen_name
             }
         }
+
+    @classmethod
+    def _search_query(cls, keyword: str | None, user_screen_name: str | None) -> dict:
+        keyword_query = {
+            'simple_query_string': {
+                'query': keyword,
+                'fields': ['text', 'full_text', 'content_text', 'spoiler_text', 'media_attachments.description'],
+                'default_operator': 'AND',
+            }
+        }
         compound_query = {
             'bool': {
                 'must': keyword_query,
             }
         }
         if user_screen_name:
-            compound_query['bool']['filter'] = user_query
-        resp = self._search(
+            compound_query['bool']['filter'] = cls._user_query(user_screen_name)
+        return compound_query
+
+    def search(self, *, keyword=None, user_screen_name=None, index=None, limit=100) -> Iterator[dict]:
+        def search():
+            return list(self._search(
+                index=index,
+                query=self._search_query(keyword, user_screen_name),
+                sort=[{
+                    '@timestamp': {'order': 'desc'}
+                }],
+                size=limit,
+            ))
+        return iter(self._coalesce(('search', keyword, user_screen_name, index, limit), search))
+
+    def search_page(self, *, keyword=None, user_screen_name=None, index=None, cursor=None,
+                    limit=100, keep_alive='5m', view=True) -> tuple[list[dict], str | None]:
+        '''Return a page of search results and the cursor of the next page
+
+        Pages after the first are read from a point-in-time with search_after,
+        so the cost of a page does not grow with its depth, and the
+        point-in-time is closed on the last page. Raises ValueError if cursor is
+        invalid. Unless view is set, tweets are returned in full rather than
+        as their views.
+        '''
+        # Identical searches at the same time share a point-in-time too
+        key = ('page', keyword, user_screen_name, index, cursor, limit, keep_alive, view)
+        return self._coalesce(key, lambda: self._search_page(
+            keyword=keyword,
+            user_screen_name=user_screen_name,
             index=index,
-            query=compound_query,
-            sort=[{
-                '@timestamp': {'order': 'desc'}
-            }],
-            size=limit,
-        )
-        return resp
+            cursor=cursor,
+            limit=limit,
+            keep_alive=keep_alive,
+            view=view,
+        ))
 
-    def get_users(self) -> Iterator[dict]:
+    def _search_page(self, *, keyword, user_screen_name, index, cursor, limit, keep_alive, view):
+        index = index or self.es_index
+        query = self._search_query(keyword, user_screen_name)
+        if cursor:
+            pit_id, search_after = decode_cursor(cursor)
+        else:
+            # Most searches end on their first page, so it is a plain search:
+            # a point-in-time is only opened once the next page is asked for
+            hits = self.es.search(
+                index=index,
+                query=query,
+                sort=[{'@timestamp': {'order': 'desc'}}],
+                size=limit + 1,
+                source=self._source(view),
+            )['hits']['hits']
+            if len(hits) <= limit:
+                return list(self._hits_to_tweets(hits, view)), None
+            # Without a tiebreaker, the page ends before the timestamp of the
+            # first hit left out, and the next one starts with all hits of it
+            boundary = hits[limit]['sort'][0]
+            hits = [hit for hit in hits[:limit] if hit['sort'][0] != boundary]
+            if hits:
+                return list(self._hits_to_tweets(hits, view)), encode_cursor(None, [boundary, -1])
+            # More than a page of hits of one timestamp: page through them in
+            # a point-in-time from the start
+            pit_id, search_after = None, None
+
+        def _search(pit_id):
+            return self.es.search(
+                pit={'id': pit_id, 'keep_alive': keep_alive},
+                query=query,
+                sort=[
+                    {'@timestamp': {'order': 'desc'}},
+                    {'_shard_doc': {'order': 'asc'}},
+                ],
+                search_after=search_after,
+                size=limit + 1,
+                source=self._source(view),
+            )
+
+        try:
+            try:
+                if pit_id is None:
+                    pit_id = self.es.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+                resp = _search(pit_id)
+            except NotFoundError:
+                # The point-in-time has expired: carry on from where we were
+                # in a new one
+                pit_id = self.es.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+                resp = _search(pit_id)
+        except BadRequestError:
+            if cursor:
+                raise ValueError(f'Invalid cursor: {cursor}') from None
+            raise
+
+        hits = resp['hits']['hits']
+        pit_id = resp.get('pit_id', pit_id)
+        if len(hits) > limit:
+            hits = hits[:limit]
+            next_cursor = encode_cursor(pit_id, hits[-1]['sort'])
+        else:
+            # Last page: nothing will read the point-in-time again
+            next_cursor = None
+            try:
+                self.es.close_point_in_time(id=pit_id)
+            except NotFoundError:
+                pass
+        return list(self._hits_to_tweets(hits, view)), next_cursor
+
+    def export(self, *, user_screen_name=None, index=None, since=None, until=None) -> Iterator[dict]:
+        '''Iterate over raw hits, oldest first, optionally filtered'''
+        filters = []
+        if user_screen_name:
+            filters.append(self._user_query(user_screen_name))
+        if since or until:
+            time_range = {}
+            if since:
+                time_range['gte'] = since
+            if until:
+                time_range['lt'] = until
+            filters.append({
+                'range': {
+                    '@timestamp': time_range
+                }
+            })
+        query = {
+            'bool': {
+                'filter': filters
+            }
+        }
+        for hit in self.scan(query=query, index=index):
+            hit['_source'].pop('@view', None)
+            yield {
+                '_index': hit['_index'],
+                '_id': hit['_id'],
+                '_source': hit['_source'],
+            }
+
+    def users_request(self) -> SearchRequest:
         agg_name_twitter = 'user_screen_names'
         agg_name_mastodon = 'account_fqn'
-        resp = self.es.search(
-            index=self.es_index,
-            size=0,
-            aggs={
+        body = {
+            'size': 0,
+            'aggs': {
                 agg_name_twitter: {
                     'terms': {
                         'field': 'user.screen_name.keyword'
@@ -205,116 +789,404 @@ class TweetsDatabase(Mapping):
                     }
                 }
             },
-        )
-        buckets = resp['aggregations'][agg_name_twitter]['buckets'] + resp['aggregations'][agg_name_mastodon]['buckets']
-        for bucket in buckets:
-            user = {
-                'screen_name': bucket['key'],
-                'tweets_count': bucket['doc_count']
-            }
-            yield user
+        }
 
-    def get_indexes(self) -> Iterator[dict]:
+        def decode(resp):
+            buckets = resp['aggregations'][agg_name_twitter]['buckets'] + resp['aggregations'][agg_name_mastodon]['buckets']
+            return [
+                {
+                    'screen_name': bucket['key'],
+                    'tweets_count': bucket['doc_count']
+                }
+                for bucket in buckets
+            ]
+        return SearchRequest(body, decode)
+
+    def indexes_request(self) -> SearchRequest:
         agg_name = 'index_names'
-        resp = self.es.search(
-            index=self.es_index,
-            size=0,
-            aggs={
+        body = {
+            'size': 0,
+            'aggs': {
                 agg_name: {
                     'terms': {
                         'field': '_index'
                     }
                 }
             },
-        )
-        for bucket in resp['aggregations'][agg_name]['buckets']:
-            index = {
-                'name': bucket['key'],
-                'tweets_count': bucket['doc_count']
-            }
-            yield index
+        }
+
+        def decode(resp):
+            return [
+                {
+                    'name': bucket['key'],
+                    'tweets_count': bucket['doc_count']
+                }
+                for bucket in resp['aggregations'][agg_name]['buckets']
+            ]
+        return SearchRequest(body, decode)
+
+    def get_users(self) -> Iterator[dict]:
+        yield from self.msearch([self.users_request()])[0]
+
+    def get_indexes(self) -> Iterator[dict]:
+        yield from self.msearch([self.indexes_request()])[0]
+
+    def generation_request(self) -> SearchRequest:
+        # A search rather than index stats, which need the monitor privilege
+        # and whose counters start over when a node restarts
+        body = {
+            'size': 0,
+            'track_total_hits': True,
+            'aggs': {
+                'latest': {
+                    'max': {
+                        'field': '@timestamp'
+                    }
+                }
+            },
+        }
+
+        def decode(resp):
+            return resp['hits']['total']['value'], resp['aggregations']['latest']['value']
+        return SearchRequest(body, decode)
+
+    def get_facets(self) -> dict:
+        '''Return users and indexes, for the search page, and the generation
+        they are of (see get_generation), in one request'''
+        users, indexes, generation = self.msearch([
+            self.users_request(),
+            self.indexes_request(),
+            self.generation_request(),
+        ])
+        return {'users': users, 'indexes': indexes, 'generation': generation}
+
+    def get_generation(self) -> tuple:
+        '''Return a value that changes whenever tweets are added to or removed
+        from es_index: their number and the latest @timestamp'''
+        return self.msearch([self.generation_request()])[0]
 
     def get_tweet_raw(self, tweet_id: int | str) -> dict:
-        hits = self.es.search(query={
-            'term': {
-                '_id': tweet_id
-            }
-        })['hits']['hits']
-        try:
-            hit = hits[0]
-        except IndexError:
-            raise KeyError(f'Tweet ID {tweet_id} not found') from None
+        def get():
+            try:
+                hit = self._get_hits([tweet_id])[str(tweet_id)]
+            except KeyError:
+                raise KeyError(f'Tweet ID {tweet_id} not found') from None
+            else:
+                hit['_source'].pop('@view', None)
+                return hit['_source']
+        return self._coalesce(('raw', str(tweet_id)), get)
+
+
+def encode_cursor(pit_id: str | None, search_after: list) -> str:
+    payload = json.dumps([pit_id, search_after], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[str | None, list]:
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        pit_id, search_after = json.loads(payload)
+    except (ValueError, TypeError):
+        raise ValueError(f'Invalid cursor: {cursor}') from None
+    if not isinstance(pit_id, (str, type(None))) or not isinstance(search_after, list):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return pit_id, search_after
+
+
+class FacetsCache:
+    '''Users and indexes facets of the search page, per set of tweets
+
+    Facets are served from memory. Once an entry is older than the TTL, it is
+    still served while a background thread checks whether the indexes have
+    changed, and only then re-runs the aggregations. With a shared cache,
+    facets of each generation of the indexes are aggregated by one worker for
+    all.
+    '''
+
+    def __init__(self, shared=None) -> None:
+        self._entries: dict[str, dict] = {}
+        self._refreshing: set[str] = set()
+        self._lock = threading.Lock()
+        self.shared = shared
+
+    def get(self, tdb: TweetsDatabase, ttl: float) -> dict:
+        entry = self._entries.get(tdb.name)
+        if entry is None:
+            entry = self._refresh(tdb, None)
+        elif time.monotonic() - entry['checked_at'] > ttl:
+            with self._lock:
+                if tdb.name in self._refreshing:
+                    return entry
+                self._refreshing.add(tdb.name)
+            threading.Thread(target=self._refresh_in_background, args=(tdb, entry), daemon=True).start()
+        return entry
+
+    def cached(self, tdb: TweetsDatabase) -> bool:
+        '''Whether get() can answer without waiting for a query. Stale
+        entries can, as they are refreshed in the background.'''
+        return tdb.name in self._entries
+
+    def invalidate(self) -> None:
+        self._entries.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def _get_facets(self, tdb: TweetsDatabase, generation: tuple) -> dict:
+        if self.shared is None:
+            return tdb.get_facets()
+        key = hashlib.sha1(repr((tdb.name, generation)).encode()).hexdigest()
+        if (facets := self.shared.get(key)) is None:
+            facets = self.shared[key] = tdb.get_facets()
+        return facets
+
+    def _refresh(self, tdb: TweetsDatabase, entry: dict | None) -> dict:
+        if entry is None and self.shared is None:
+            # Nothing to compare with: the generation comes with the facets
+            entry = tdb.get_facets()
         else:
-            return hit['_source']
+            generation = tdb.get_generation()
+            if entry is None or entry['generation'] != generation:
+                entry = self._get_facets(tdb, generation)
+            entry = dict(entry)
+        entry['checked_at'] = time.monotonic()
+        self._entries[tdb.name] = entry
+        return entry
+
+    def _refresh_in_background(self, tdb: TweetsDatabase, entry: dict) -> None:
+        try:
+            self._refresh(tdb, entry)
+        except Exception:
+            app.logger.exception('Failed to refresh search facets')
+        finally:
+            with self._lock:
+                self._refreshing.discard(tdb.name)
+
+
+facets_cache = FacetsCache(make_shared_cache('facets'))
+
+
+class GenerationCache:
+    '''Generation of each set of tweets (see TweetsDatabase.get_generation),
+    which tweet pages are cached by
+
+    Like facets, a generation older than the TTL is still served while a
+    background thread checks it again, so only the first lookup in a worker
+    waits for a query, and that query is a single cheap search.
+    '''
+
+    def __init__(self) -> None:
+        self._entries: dict[str, tuple[tuple, float]] = {}
+        self._refreshing: set[str] = set()
+        self._lock = threading.Lock()
+
+    def get(self, tdb: TweetsDatabase, ttl: float) -> tuple:
+        entry = self._entries.get(tdb.name)
+        if entry is None:
+            return self._refresh(tdb)
+        generation, checked_at = entry
+        if time.monotonic() - checked_at > ttl:
+            with self._lock:
+                if tdb.name in self._refreshing:
+                    return generation
+                self._refreshing.add(tdb.name)
+            threading.Thread(target=self._refresh_in_background, args=(tdb,), daemon=True).start()
+        return generation
+
+    def invalidate(self) -> None:
+        self._entries.clear()
+
+    def _refresh(self, tdb: TweetsDatabase) -> tuple:
+        generation = tdb.get_generation()
+        self._entries[tdb.name] = (generation, time.monotonic())
+        return generation
+
+    def _refresh_in_background(self, tdb: TweetsDatabase) -> None:
+        try:
+            self._refresh(tdb)
+        except Exception:
+            app.logger.exception('Failed to refresh tweets generation')
+        finally:
+            with self._lock:
+                self._refreshing.discard(tdb.name)
+
+
+generation_cache = GenerationCache()
+
+# Lookups in flight in this worker
+_lookups = SingleFlight()
 
 
 def get_tdb() -> TweetsDatabase:
     if not hasattr(flask.g, 'tdb'):
-        flask.g.tdb = TweetsDatabase(
-            app.config['T_ES_HOST'],
-            app.config['T_ES_INDEX']
-        )
+        if app.config['T_BACKEND'] == 'sqlite':
+            from .sqlite import SQLiteTweetsDatabase
+            flask.g.tdb = SQLiteTweetsDatabase(app.config['T_SQLITE_PATH'])
+        else:
+            flask.g.tdb = TweetsDatabase(
+                get_es(),
+                app.config['T_ES_INDEX'],
+                views=app.config['T_ES_VIEWS'],
+                single_flight=_lookups if app.config['T_SINGLE_FLIGHT'] else None,
+            )
     return flask.g.tdb
 
 
-@lru_cache(maxsize=1024)
+def prefetch_tweet_links(tweets: Iterable[dict]) -> None:
+    '''Find out in one query which tweets linked from tweets are local
+
+    The result is kept in flask.g for get_tweet_link to use while the tweets
+    are being rendered.
+    '''
+    linked = set()
+    for tweet in tweets:
+        if retweeted_status := tweet.get('retweeted_status'):
+            linked.add(str(retweeted_status['id']))
+        if not tweet.get('account') and (reply_to := tweet.get('in_reply_to_status_id')):
+            linked.add(str(reply_to))
+    local_links = flask.g.setdefault('local_links', {})
+    if linked := linked - local_links.keys():
+        existing = get_tdb().existing_ids(linked)
+        for tweet_id in linked:
+            local_links[tweet_id] = tweet_id in existing
+
+
 @app.template_global('get_tweet_link')
 def get_tweet_link(tweet_id: int | str, use_original_link: bool = False) -> str:
     original_link = f'https://twitter.com/_/status/{tweet_id}'
     if use_original_link:
         return original_link
 
-    tdb = flask.g.tdb
-    if tdb.get(tweet_id):
+    local_links = flask.g.setdefault('local_links', {})
+    if (is_local := local_links.get(str(tweet_id))) is None:
+        is_local = local_links[str(tweet_id)] = bool(get_tdb().existing_ids([tweet_id]))
+    if is_local:
         return flask.url_for('get_tweet', tweet_id=tweet_id, ext='html')
     else:
         return original_link
 
 
-@app.template_filter('format_tweet_text')
-def format_tweet_text(tweet: dict) -> str:
+# Matches everything format_tweet_text may linkify, for tweets whose entities
+# do not carry usable indices
+_entities_re = re.compile(r'https?://t\.co/\w+|[#＃](\w+)|@(\w+)')
+
+# Rendered entities by (index, tweet ID). Per worker: rendering is cheaper than
+# a shared write, and whole pages are shared already.
+_tweet_text_cache = LRUCache(app.config['T_TEXT_CACHE_SIZE'])
+
+
+def _url_html(u: dict) -> str:
+    # t.co wraps everything *looks like* a URL, even bare domains. We bring
+    # sanity back.
+    # A bare domain would be prepended a scheme but not a path,
+    # while a real URL would always have a path.
+    # https://docs.python.org/3/library/urllib.parse.html#url-parsing
+    if urlsplit(u['expanded_url']).path:
+        return f'<a href="{u["expanded_url"]}">{u["display_url"]}</a>'
+    else:
+        return u['display_url']
+
+
+def _hashtag_html(hashtag: str) -> str:
+    link = f'https://twitter.com/hashtag/{hashtag[1:]}'
+    return f'<a href="{link}">{hashtag}</a>'
+
+
+def _mention_html(user: dict, at_user: str) -> str:
+    # case-preserving
+    link = f'https://twitter.com/{user["screen_name"]}'
+    return f'<a href="{link}" title="{user["name"]}">{at_user}</a>'
+
+
+def _render_entities_by_indices(text: str, entities: dict) -> str | None:
+    '''Linkify entities in one pass over their indices
+
+    Returns None if any entity has no indices or does not match the text.
+    '''
+    spans = []
+    try:
+        # NOTE: for URL-expansion purpose, there are no difference between
+        # extended_entities.media and entities.media
+        for u in itertools.chain(entities.get('urls', []), entities.get('media', [])):
+            start, end = map(int, u['indices'])
+            if text[start:end] != u['url']:
+                return None
+            spans.append((start, end, _url_html(u)))
+        for h in entities.get('hashtags', []):
+            start, end = map(int, h['indices'])
+            if text[start] not in '#＃' or text[start + 1:end] != h['text']:
+                return None
+            spans.append((start, end, _hashtag_html(text[start:end])))
+        for user in entities.get('user_mentions', []):
+            start, end = map(int, user['indices'])
+            if text[start] != '@' or text[start + 1:end].lower() != user['screen_name'].lower():
+                return None
+            spans.append((start, end, _mention_html(user, text[start:end])))
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+    spans.sort()
+    parts = []
+    pos = 0
+    for start, end, html in spans:
+        if start < pos:
+            return None
+        parts.append(text[pos:start])
+        parts.append(html)
+        pos = end
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
+def _render_entities_by_regex(text: str, entities: dict) -> str:
+    '''Linkify entities in one pass of a precompiled regex'''
+    urls = {
+        u['url']: _url_html(u)
+        for u in itertools.chain(entities.get('urls', []), entities.get('media', []))
+    }
+    hashtags = {h['text'] for h in entities.get('hashtags', [])}
+    users = {u['screen_name'].lower(): u for u in entities.get('user_mentions', [])}
+
+    def repl(m: re.Match) -> str:
+        matched = m.group(0)
+        if hashtag := m.group(1):
+            if hashtag in hashtags:
+                return _hashtag_html(matched)
+        elif screen_name := m.group(2):
+            if user := users.get(screen_name.lower()):
+                return _mention_html(user, matched)
+        elif html := urls.get(matched):
+            return html
+        return matched
+
+    return _entities_re.sub(repl, text)
+
+
+def render_entities(tweet: dict) -> str:
+    '''Return text of the tweet with URLs expanded and hashtags and user mentions linkified'''
     try:
         tweet_text = tweet['full_text']
     except KeyError:
         tweet_text = tweet['text']
+    entities = tweet.get('entities')
+    if not entities:  # e.g. toots
+        return tweet_text
+    rendered = _render_entities_by_indices(tweet_text, entities)
+    if rendered is None:
+        rendered = _render_entities_by_regex(tweet_text, entities)
+    return rendered
 
-    # Replace t.co-wrapped URLs with their original URLs
-    # NOTE: for URL-expansion purpose, there are no difference between
-    # extended_entities.media and entities.media
-    urls = itertools.chain(
-        tweet['entities'].get('urls', []),
-        tweet['entities'].get('media', []),
-    )
-    for u in urls:
-        # t.co wraps everything *looks like* a URL, even bare domains. We bring
-        # sanity back.
-        # A bare domain would be prepended a scheme but not a path,
-        # while a real URL would always have a path.
-        # https://docs.python.org/3/library/urllib.parse.html#url-parsing
-        if urlsplit(u['expanded_url']).path:
-            a = f'<a href="{u["expanded_url"]}">{u["display_url"]}</a>'
+
+@app.template_filter('format_tweet_text')
+@metrics.timed('text')
+def format_tweet_text(tweet: dict) -> str:
+    # Views come with their text rendered
+    if (tweet_text := tweet.get('text_html')) is None:
+        if (tweet_id := tweet.get('id')) is None:
+            tweet_text = render_entities(tweet)
         else:
-            a = u['display_url']
-        tweet_text = tweet_text.replace(u['url'], a)
-
-    # Linkify hashtags
-    hashtags = tweet['entities'].get('hashtags', [])
-    for h in hashtags:
-        hashtag = f'#{h["text"]}'
-        link = f'https://twitter.com/hashtag/{h["text"]}'
-        a = f'<a href="{link}">{hashtag}</a>'
-        tweet_text = tweet_text.replace(hashtag, a)
-
-    # Linkify user mentions
-    users = tweet['entities'].get('user_mentions', [])
-    for user in users:
-        name = user['name']
-        screen_name = user['screen_name']
-        # case-insensitive and case-preserving
-        at_user = rf'(?i)@({screen_name})\b'
-        link = f'https://twitter.com/{screen_name}'
-        a = rf'<a href="{link}" title="{name}">@\1</a>'
-        tweet_text = re.sub(at_user, a, tweet_text)
+            key = (tweet.get('@index'), str(tweet_id))
+            if (tweet_text := _tweet_text_cache.get(key)) is None:
+                tweet_text = _tweet_text_cache[key] = render_entities(tweet)
 
     # Link to retweeted status
     # NOTE: As of 2022-05, only tweets ingested via API has "retweeted" set to
@@ -338,15 +1210,9 @@ def format_tweet_text(tweet: dict) -> str:
 
 
 @app.template_filter('format_created_at')
+@lru_cache(maxsize=4096)
 def format_created_at(timestamp: str, fmt: str) -> str:
-    try:
-        dt = datetime.strptime(timestamp, '%a %b %d %H:%M:%S %z %Y')
-    except ValueError:
-        try:
-            dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S %z')
-        except ValueError:
-            dt = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S%z')
-    return dt.strftime(fmt)
+    return parse_created_at(timestamp).strftime(fmt)
 
 
 @app.template_filter('in_reply_to_link')
@@ -362,22 +1228,49 @@ def in_reply_to_link(tweet: dict) -> str:
         return get_tweet_link(tweet['in_reply_to_status_id'])
 
 
+def media_path(path: str) -> str:
+    '''Return the absolute path of a media directory or manifest setting
+
+    Relative paths are relative to the app, as with flask.send_from_directory,
+    for indexing and serving alike.
+    '''
+    return os.path.join(app.root_path, path)
+
+
+# One resolver (and media index) per worker process
+@per_process('T_MEDIA_FROM', 'T_MEDIA_MIRRORS', 'T_MEDIA_FS_PATH', 'T_MEDIA_MANIFEST',
+             'T_MEDIA_MIRROR_MANIFEST', 'T_MEDIA_RESCAN_INTERVAL')
+def get_media_resolver(config: dict) -> MediaResolver:
+    # Unknown sources hotlink, as they always did
+    chain = config['T_MEDIA_FROM']
+    chain = (chain,) if isinstance(chain, str) else chain
+    chain = tuple(source for source in chain if source in MEDIA_SOURCES) or ('direct',)
+    return MediaResolver(
+        chain,
+        mirrors=dict(config['T_MEDIA_MIRRORS'] or {}),
+        fs_path=config['T_MEDIA_FS_PATH'] and media_path(config['T_MEDIA_FS_PATH']),
+        manifest=config['T_MEDIA_MANIFEST'] and media_path(config['T_MEDIA_MANIFEST']),
+        mirror_manifest=config['T_MEDIA_MIRROR_MANIFEST'] and media_path(config['T_MEDIA_MIRROR_MANIFEST']),
+        rescan_interval=config['T_MEDIA_RESCAN_INTERVAL'],
+    )
+
+
 def replace_media_url(url: str) -> str:
-    if app.config['T_MEDIA_FROM'] == 'direct':
-        return url
-    elif app.config['T_MEDIA_FROM'] == 'mirror':
-        mirrors = app.config.get('T_MEDIA_MIRRORS', {})
-        for orig, repl in mirrors.items():
-            if orig in url:
-                return url.replace(orig, repl)
-        else:
-            return url
-    elif app.config['T_MEDIA_FROM'] == 'filesystem':
-        parts = urlsplit(url)
-        fs_path = f'{parts.netloc}{parts.path}'
-        return flask.url_for('get_media_from_filesystem', fs_path=fs_path)
-    else:
-        return url
+    source, location = get_media_resolver().resolve(url)
+    if source == 'filesystem':
+        return flask.url_for('get_media_from_filesystem', fs_path=location)
+    return location
+
+
+def derivative_url(url: str, variant: str) -> str | None:
+    '''Return the URL of a derivative of a media file, if it is served from
+    the filesystem and one can be made'''
+    if not app.config['T_MEDIA_DERIVATIVES']:
+        return None
+    source, location = get_media_resolver().resolve(url)
+    if source != 'filesystem' or not can_make_derivative(variant, location):
+        return None
+    return flask.url_for('get_media_derivative', variant=variant, fs_path=location)
 
 
 @app.route('/')
@@ -385,16 +1278,28 @@ def root():
     return flask.redirect(flask.url_for('index'))
 
 
+@app.route('/metrics', endpoint='metrics')
+def metrics_endpoint():
+    if not app.config['T_METRICS']:
+        flask.abort(404)
+    try:
+        body = metrics.render(metrics.shared_series(app))
+    except sqlite3.Error as e:
+        # Better no scrape than totals that go backwards
+        app.logger.warning('Failed to read shared metrics: %s', e)
+        flask.abort(503)
+    resp = flask.make_response(body)
+    resp.content_type = 'text/plain; version=0.0.4'
+    return resp
+
+
 @app.route('/tweet/')
 def index():
     tdb = get_tdb()
-    total_tweets = len(tdb)
-    if default_user := app.config.get('T_DEFAULT_USER'):
-        latest_tweets = tdb.search(keyword='*', user_screen_name=default_user, limit=10)
-    else:
-        latest_tweets = [tdb[tid] for tid in itertools.islice(reversed(tdb), 10)]
+    total_tweets, latest_tweets = tdb.latest(10, user_screen_name=app.config.get('T_DEFAULT_USER'))
 
-    latest_tweets = map(inject_user_dict, latest_tweets)
+    latest_tweets = [inject_user_dict(t) for t in latest_tweets]
+    prefetch_tweet_links(latest_tweets)
     rendered = flask.render_template(
         'index.html',
         total_tweets=total_tweets,
@@ -405,24 +1310,63 @@ def index():
     return resp
 
 
-@lru_cache(maxsize=1024)
-def fetch_tweet(tweet_id: int | str) -> dict:
-    token = app.config['T_TWITTER_TOKEN']
-    resp = requests.get(
-        'https://api.twitter.com/1.1/statuses/show.json',
-        headers={
-            'Authorization': f'Bearer {token}'
-        },
-        params={
-            'id': tweet_id,
-            'tweet_mode': 'extended'
-        },
+# Like the Elasticsearch client, one fetcher (and session) per worker process
+@per_process('T_TWITTER_KEY', 'T_TWITTER_SECRET', 'T_TWITTER_API', 'T_EXTERNAL_TWEETS_TIMEOUT',
+             'T_EXTERNAL_TWEETS_CACHE', 'T_EXTERNAL_TWEETS_TTL', 'T_EXTERNAL_TWEETS_NEGATIVE_TTL')
+def get_fetcher(config: dict) -> TwitterFetcher:
+    cache = None
+    if path := config['T_EXTERNAL_TWEETS_CACHE']:
+        try:
+            cache = TweetsCache(
+                path,
+                ttl=config['T_EXTERNAL_TWEETS_TTL'],
+                negative_ttl=config['T_EXTERNAL_TWEETS_NEGATIVE_TTL'],
+            )
+        except sqlite3.Error as e:
+            app.logger.warning('Fetching external tweets without a cache: %s', e)
+    return TwitterFetcher(
+        config['T_TWITTER_KEY'],
+        config['T_TWITTER_SECRET'],
+        api_base=config['T_TWITTER_API'],
+        timeout=config['T_EXTERNAL_TWEETS_TIMEOUT'],
+        cache=cache,
     )
-    if resp.ok:
-        tweet = resp.json()
-        return tweet
-    else:
-        flask.abort(resp.status_code)
+
+
+def fetch_tweet(tweet_id: int | str) -> dict:
+    try:
+        return get_fetcher().fetch(tweet_id)
+    except KeyError:
+        flask.abort(404)
+    except TokenError:
+        # Twitter is down or refuses our credentials, not the Tweet
+        flask.abort(502)
+    except requests.HTTPError:
+        # Missing tweets are handled above. Anything else Twitter answers is
+        # a bad gateway to us, even codes werkzeug knows nothing of (420).
+        flask.abort(502)
+    except requests.RequestException:
+        flask.abort(504)
+
+
+# Rendered tweet pages by (tweet ID, ext, hash of config they depend on,
+# tweets generation, media generation), shared by workers if T_CACHE_BACKEND
+# says so
+_tweet_response_cache = make_cache('tweet-page', app.config['T_TWEET_CACHE_SIZE'])
+
+# Config that changes how a tweet page is rendered
+_TWEET_RESPONSE_CONFIG = (
+    'T_BACKEND',
+    'T_SQLITE_PATH',
+    'T_ES_INDEX',
+    'T_MEDIA_FROM',
+    'T_MEDIA_MIRRORS',
+    'T_MEDIA_FS_PATH',
+    'T_MEDIA_MIRROR_MANIFEST',
+    'T_MEDIA_DERIVATIVES',
+    'T_EXTERNAL_TWEETS',
+    'T_USER_DICTS',
+)
 
 
 @app.route('/tweet/<tweet_id>.<ext>')
@@ -430,6 +1374,43 @@ def get_tweet(tweet_id, ext):
     if ext not in ('txt', 'json', 'html'):
         flask.abort(404)
 
+    # Archived tweets do not change, so rendered pages are cached and
+    # revalidated with strong ETags
+    config = repr([app.config.get(k) for k in _TWEET_RESPONSE_CONFIG])
+    # Pages change as tweets they link to are ingested (see GenerationCache
+    # for how often that is checked), and as media is downloaded
+    generation = generation_cache.get(get_tdb(), app.config['T_FACETS_TTL'])
+    key = (tweet_id, ext, hashlib.sha1(config.encode()).hexdigest(), generation, get_media_resolver().generation)
+    external = False
+    if (cached := _tweet_response_cache.get(key)) is None:
+        resp, external = render_tweet(tweet_id, ext)
+        body = resp.get_data()
+        cached = (body, resp.content_type, hashlib.sha1(body).hexdigest())
+        # Fetched tweets are not archived, and the archived copy may come
+        # with a later ingest
+        if not external:
+            _tweet_response_cache[key] = cached
+    body, content_type, etag = cached
+
+    # If-None-Match compares weakly (RFC 7232), as proxies that compress
+    # responses turn the ETag into W/"..."
+    if flask.request.if_none_match.contains_weak(etag):
+        resp = flask.Response(status=304)
+    else:
+        resp = flask.make_response(body)
+        resp.content_type = content_type
+    resp.set_etag(etag)
+    if external:
+        resp.cache_control.no_cache = True
+    else:
+        resp.cache_control.public = True
+        resp.cache_control.max_age = app.config['T_TWEET_CACHE_MAX_AGE']
+    return resp
+
+
+def render_tweet(tweet_id, ext) -> tuple[flask.Response, bool]:
+    '''Return the page of a tweet, and whether the tweet was fetched from
+    Twitter rather than found in the archive'''
     tdb = get_tdb()
     _is_external_tweet = False
     try:
@@ -449,54 +1430,34 @@ def get_tweet(tweet_id, ext):
         rendered = pprint.pformat(tweet)
         resp = flask.make_response(rendered)
         resp.content_type = 'text/plain'
-        return resp
+        return resp, _is_external_tweet
     elif ext == 'json':
         rendered = flask.json.dumps(tweet, ensure_ascii=False)
         resp = flask.make_response(rendered)
         resp.content_type = 'application/json'
-        return resp
+        return resp, _is_external_tweet
 
     # HTML output
 
-    # Extract media
-    images = []
-    videos = []
-    try:
-        # https://developer.twitter.com/en/docs/tweets/data-dictionary/overview/extended-entities-object
-        entities = tweet['extended_entities']
-    except KeyError:
-        entities = tweet['entities']
-    media = entities.get('media', [])
-    for m in media:
-        # type is video
-        if m.get('type') == 'video':
-            variants = m['video_info']['variants']
-            hq_variant = max(variants, key=lambda v: int(v.get('bitrate', -1)))
-            media_url = hq_variant['url']
-            if not _is_external_tweet:
-                media_url = replace_media_url(media_url)
-            videos.append({
-                'url': media_url,
-            })
-        elif m.get('type') == 'toot-video':
-            videos.append({
-                'url': m['media_url_https']
-            })
-        # type is photo (tweet) or image (toot) or None (legacy tweet)
-        elif m.get('type') in ('photo', 'toot-image', None):
-            media_url = m['media_url_https']
-            if not _is_external_tweet:
-                media_url = replace_media_url(media_url)
-            images.append({
-                'url': media_url,
-                'description': m.get('description', '')
-            })
-        # type is unknown
-        else:
-            pass
+    # Extract media, unless it comes with the view
+    if 'text_html' in tweet:
+        images, videos = tweet['images'], tweet['videos']
+    else:
+        images, videos = extract_media(tweet)
+    if not _is_external_tweet:
+        images = [
+            {**m, 'url': replace_media_url(m['url']), 'thumb_url': derivative_url(m['url'], 'thumb')}
+            for m in images
+        ]
+        videos = [
+            m if m.get('direct') else
+            {**m, 'url': replace_media_url(m['url']), 'poster_url': derivative_url(m['url'], 'poster')}
+            for m in videos
+        ]
 
     # Render HTML
     tweet = inject_user_dict(tweet)
+    prefetch_tweet_links([tweet])
     rendered = flask.render_template(
         'tweet.html',
         tweet=tweet,
@@ -505,12 +1466,96 @@ def get_tweet(tweet_id, ext):
     )
     resp = flask.make_response(rendered)
 
+    return resp, _is_external_tweet
+
+
+def send_media(directory: str, path: str, accel_prefix: str, immutable: bool = True) -> flask.Response:
+    '''Send a file under directory, or have the proxy send it
+
+    Media files never change once downloaded (and derivatives are named
+    after their source), so they are cached for good, unless immutable is
+    unset, in which case they are revalidated on every use.
+    '''
+    max_age = app.config['T_MEDIA_MAX_AGE'] if immutable else None
+    offload = app.config['T_MEDIA_OFFLOAD']
+    if offload == 'x-accel-redirect':
+        # nginx serves accel_prefix from directory in an internal location,
+        # Range requests included
+        if werkzeug.security.safe_join(directory, path) is None:
+            flask.abort(404)
+        resp = flask.Response()
+        resp.headers['X-Accel-Redirect'] = accel_prefix + quote(path)
+        resp.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    else:
+        # Conditional and Range requests are answered by werkzeug, unless the
+        # server sends the file from the X-Sendfile header. Not through
+        # flask.send_from_directory, which would set use_x_sendfile from
+        # USE_X_SENDFILE; directory is absolute (see media_path) instead.
+        resp = werkzeug.utils.send_from_directory(
+            directory,
+            path,
+            flask.request.environ,
+            use_x_sendfile=offload == 'x-sendfile',
+            max_age=max_age,
+        )
+    if immutable:
+        resp.cache_control.public = True
+        resp.cache_control.max_age = max_age
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.no_cache = True
     return resp
 
 
 @app.route('/tweet/media/<path:fs_path>')
 def get_media_from_filesystem(fs_path: str):
-    return flask.send_from_directory(app.config['T_MEDIA_FS_PATH'], fs_path)
+    return send_media(media_path(app.config['T_MEDIA_FS_PATH']), fs_path, app.config['T_MEDIA_ACCEL_PREFIX'])
+
+
+@app.route('/tweet/derivative/<variant>/<path:fs_path>')
+def get_media_derivative(variant: str, fs_path: str):
+    cache_path = media_path(app.config['T_MEDIA_CACHE_PATH'])
+    cache = DerivativeCache(media_path(app.config['T_MEDIA_FS_PATH']), cache_path)
+    if not app.config['T_MEDIA_DERIVATIVES'] or (name := cache.get(variant, fs_path)) is None:
+        # Fall back to the original, but only until the derivative is made
+        return send_media(
+            media_path(app.config['T_MEDIA_FS_PATH']),
+            fs_path,
+            app.config['T_MEDIA_ACCEL_PREFIX'],
+            immutable=False,
+        )
+    return send_media(cache_path, name, app.config['T_MEDIA_CACHE_ACCEL_PREFIX'])
+
+
+@app.route('/tweet/export.ndjson')
+@auth.login_required
+def export_tweets():
+    user = flask.request.args.get('u', '')
+    index = flask.request.args.get('i', '')
+    since = flask.request.args.get('since', '')
+    until = flask.request.args.get('until', '')
+    for date in (since, until):
+        if date:
+            try:
+                datetime.fromisoformat(date)
+            except ValueError:
+                flask.abort(400)
+
+    hits = get_tdb().export(
+        user_screen_name=user,
+        index=index,
+        since=since,
+        until=until,
+    )
+
+    def generate():
+        for hit in hits:
+            yield flask.json.dumps(hit, ensure_ascii=False) + '\n'
+
+    return flask.Response(
+        flask.stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+    )
 
 
 @app.route('/tweet/search.<ext>')
@@ -520,43 +1565,76 @@ def search_tweet(ext: str):
         flask.abort(404)
 
     tdb = get_tdb()
-    users = tdb.get_users()
-    indexes = tdb.get_indexes()
-
     user = flask.request.args.get('u', '')
     index = flask.request.args.get('i', '')
-    if keyword := flask.request.args.get('q', ''):
-        tweets = list(tdb.search(
-            keyword=keyword,
-            user_screen_name=user,
-            index=index,
-        ))
+    cursor = flask.request.args.get('cursor', '')
+    next_url = None
+
+    def search():
+        try:
+            return tdb.search_page(
+                keyword=keyword,
+                user_screen_name=user,
+                index=index,
+                cursor=cursor,
+                limit=app.config['T_SEARCH_PAGE_SIZE'],
+                keep_alive=app.config['T_SEARCH_PIT_KEEP_ALIVE'],
+                view=ext == 'html',
+            )
+        except ValueError:
+            flask.abort(400)
+
+    def get_facets():
+        with metrics.timed('facets'):
+            return facets_cache.get(tdb, app.config['T_FACETS_TTL'])
+
+    keyword = flask.request.args.get('q', '')
+    facets = None
+    if keyword and ext == 'html' and tdb.thread_safe and not facets_cache.cached(tdb):
+        # Facets have to be queried: alongside the search rather than after
+        # it. Otherwise they are at hand, and hopping to the pool would only
+        # queue behind cold queries of other requests.
+        (tweets, next_cursor), facets = fan_out(search, get_facets)
+    elif keyword:
+        tweets, next_cursor = search()
     else:
-        tweets = []
+        tweets, next_cursor = [], None
+    if next_cursor:
+        next_url = flask.url_for('search_tweet', ext=ext, q=keyword, u=user, i=index, cursor=next_cursor)
 
     # Text and JSON output
     if ext == 'txt':
         rendered = pprint.pformat(tweets)
         resp = flask.make_response(rendered)
         resp.content_type = 'text/plain'
+        if next_url:
+            resp.headers['Link'] = f'<{next_url}>; rel="next"'
         return resp
     elif ext == 'json':
         rendered = flask.json.dumps(tweets, ensure_ascii=False)
         resp = flask.make_response(rendered)
         resp.content_type = 'application/json'
+        if next_url:
+            resp.headers['Link'] = f'<{next_url}>; rel="next"'
         return resp
 
     # HTML output
+    if facets is None:
+        facets = get_facets()
     tweets = [inject_user_dict(t) for t in tweets]
+    prefetch_tweet_links(tweets)
     rendered = flask.render_template(
         'search.html',
         keyword=keyword,
         user=user,
-        users=users,
+        users=facets['users'],
         index=index,
-        indexes=indexes,
+        indexes=facets['indexes'],
         tweets=tweets,
+        next_url=next_url,
     )
     resp = flask.make_response(rendered)
+    if next_url:
+        resp.headers['Link'] = f'<{next_url}>; rel="next"'
 
     return resp
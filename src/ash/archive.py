@@ -0,0 +1,118 @@
+'''
+Read timestamps and files of Twitter archives and Mastodon exports, for the
+web app, ingest and the contrib tools alike.
+'''
+
+from __future__ import annotations
+
+import json
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from functools import lru_cache
+from collections.abc import Iterator
+from typing import TextIO
+
+
+_MONTHS = {
+    name: i
+    for i, name in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)
+}
+
+
+@lru_cache(maxsize=64)
+def _parse_utc_offset(offset: str) -> timezone:
+    if offset == 'Z':
+        return timezone.utc
+    sign = -1 if offset[0] == '-' else 1
+    offset = offset[1:].replace(':', '')
+    return timezone(sign * timedelta(hours=int(offset[:2]), minutes=int(offset[2:4])))
+
+
+def parse_created_at(timestamp: str) -> datetime:
+    '''Parse timestamps found in tweets and toots
+
+    The layout is told apart by the shape of the string, and the fields are
+    sliced out directly, which is much faster than trying strptime formats:
+
+    - Mon Jun 29 15:46:31 +0000 2009 (Twitter API and pre-2013 archives)
+    - 2017-08-17 12:57:51 +0000 (post-2013 archives)
+    - 2023-01-17T19:06:46+00:00 (@timestamp and Mastodon, may have fractions)
+    '''
+    try:
+        if timestamp[4] == '-':
+            date, time_ = timestamp[:10], timestamp[11:19]
+            offset = timestamp[19:].lstrip()
+            if offset.startswith('.'):  # fractions of a second
+                offset = offset.lstrip('.0123456789')
+            return datetime(
+                int(date[:4]), int(date[5:7]), int(date[8:10]),
+                int(time_[:2]), int(time_[3:5]), int(time_[6:8]),
+                tzinfo=_parse_utc_offset(offset),
+            )
+        else:
+            _, month, day, time_, offset, year = timestamp.split(' ')
+            return datetime(
+                int(year), _MONTHS[month], int(day),
+                int(time_[:2]), int(time_[3:5]), int(time_[6:8]),
+                tzinfo=_parse_utc_offset(offset),
+            )
+    except (ValueError, KeyError, IndexError):
+        pass
+    for fmt in ('%a %b %d %H:%M:%S %z %Y', '%Y-%m-%d %H:%M:%S %z', '%Y-%m-%dT%H:%M:%S%z'):
+        try:
+            return datetime.strptime(timestamp, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f'Unknown timestamp format: {timestamp}')
+
+
+def iter_json_array(f: TextIO, marker: str = '', chunk_size: int = 1 << 16) -> Iterator[dict]:
+    '''Yield objects of the first JSON array after marker, reading f in chunks
+
+    This also reads archive .js files, which are a JSON array prefixed by a
+    JavaScript assignment.
+    '''
+    decoder = json.JSONDecoder()
+    buf = ''
+    eof = False
+
+    def fill():
+        nonlocal buf, eof
+        if chunk := f.read(chunk_size):
+            buf += chunk
+        else:
+            eof = True
+
+    # Skip to the opening bracket
+    while True:
+        start = buf.find(marker) if marker else 0
+        if start >= 0 and (bracket := buf.find('[', start + len(marker))) >= 0:
+            buf = buf[bracket + 1:]
+            break
+        if eof:
+            raise ValueError(f'No JSON array found in {f.name}')
+        fill()
+
+    pos = 0
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                raise ValueError(f'Unterminated JSON array in {f.name}')
+            fill()
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            obj, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        yield obj
+        if pos > chunk_size:
+            buf = buf[pos:]
+            pos = 0
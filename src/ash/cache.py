@@ -0,0 +1,242 @@
+'''
+Caches of rendered pages and facets, per worker or shared by the workers of a
+host.
+
+Every cache has the same mapping-like interface: get(key, default), item
+assignment, pop(key, default) and clear(). LRUCache keeps values in the memory
+of a worker. SQLiteCache keeps them in a SQLite file that every worker on the
+host reads and writes, bounded in size, with keys scoped by a namespace and a
+version: bumping the version (T_CACHE_VERSION) invalidates everything cached
+before. TieredCache puts a small LRUCache in front of a shared cache, so hot
+keys do not cost a read of the file.
+'''
+
+from __future__ import annotations
+
+import os
+import time
+import pickle
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import Iterator
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    '''A thread-safe mapping that evicts least recently used keys'''
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def __setitem__(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache:
+    '''A cache in a SQLite file shared by processes
+
+    Entries are evicted least recently used first once their values add up
+    to more than max_bytes. Reads mark entries as used at most once every
+    touch_interval seconds, so that hits seldom write, and never wait to.
+
+    The cache degrades rather than fails: when the file cannot be read or
+    written (e.g. other workers hold the write lock for longer than timeout
+    seconds), reads miss and writes are dropped. Only opening it raises
+    sqlite3.Error, for the caller to do without.
+    '''
+
+    def __init__(self, path: str, namespace: str, *, version: int = 0, max_bytes: int = 256 * 2**20,
+                 touch_interval: float = 60, timeout: float = 1) -> None:
+        self.path = path
+        self.prefix = f'{namespace}:{version}:'
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connect().execute('PRAGMA journal_mode=WAL')
+        with self._write() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, used_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_used_at ON cache (used_at)')
+            # Total size of values, kept up to date by every write
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('bytes', 0)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections may not be shared between threads, nor between
+        # processes forked after they were opened
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._local.conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        # Taking the write lock upfront, as the byte count is read and then
+        # updated
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+    @staticmethod
+    def _add_bytes(conn: sqlite3.Connection, n: int) -> int:
+        conn.execute("UPDATE meta SET value = value + ? WHERE name = 'bytes'", (n,))
+        return conn.execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+
+    def get(self, key, default=None):
+        key = self.prefix + str(key)
+        try:
+            conn = self._connect()
+            row = conn.execute('SELECT value, used_at FROM cache WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Cache miss on error: %s', e)
+            return default
+        if row is None:
+            return default
+        value, used_at = row
+        try:
+            value = pickle.loads(value)
+        except (pickle.UnpicklingError, AttributeError, ImportError, EOFError) as e:
+            # Written by another version of the code, or cut short
+            logger.warning('Cache entry dropped as it cannot be read: %s', e)
+            self._delete('key = ?', (key,))
+            return default
+        if (now := time.time()) - used_at > self.touch_interval:
+            self._touch(conn, key, now)
+        return value
+
+    def _touch(self, conn: sqlite3.Connection, key: str, now: float) -> None:
+        # Best effort: in WAL mode reads do not wait for writers, and neither
+        # should a hit, for the sake of eviction order
+        try:
+            conn.execute('PRAGMA busy_timeout = 0')
+            conn.execute('UPDATE cache SET used_at = ? WHERE key = ?', (now, key))
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.execute(f'PRAGMA busy_timeout = {int(self.timeout * 1000)}')
+
+    def __setitem__(self, key, value) -> None:
+        key = self.prefix + str(key)
+        value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            with self._write() as conn:
+                row = conn.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+                conn.execute(
+                    'INSERT OR REPLACE INTO cache (key, value, size, used_at) VALUES (?, ?, ?, ?)',
+                    (key, value, len(value), time.time()),
+                )
+                total = self._add_bytes(conn, len(value) - (row[0] if row else 0))
+                if total > self.max_bytes:
+                    self._evict(conn, total)
+        except sqlite3.Error as e:
+            logger.warning('Cache write dropped on error: %s', e)
+
+    def _evict(self, conn: sqlite3.Connection, total: int) -> None:
+        # Down to 90%, so that eviction does not run on every write
+        target = self.max_bytes * 0.9
+        keys = []
+        freed = 0
+        for key, size in conn.execute('SELECT key, size FROM cache ORDER BY used_at'):
+            if total - freed <= target:
+                break
+            keys.append((key,))
+            freed += size
+        conn.executemany('DELETE FROM cache WHERE key = ?', keys)
+        self._add_bytes(conn, -freed)
+
+    def _delete(self, where: str, params: tuple) -> None:
+        try:
+            with self._write() as conn:
+                freed = conn.execute(f'SELECT total(size) FROM cache WHERE {where}', params).fetchone()[0]
+                conn.execute(f'DELETE FROM cache WHERE {where}', params)
+                self._add_bytes(conn, -int(freed))
+        except sqlite3.Error as e:
+            logger.warning('Cache delete dropped on error: %s', e)
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self._delete('key = ?', (self.prefix + str(key),))
+        return value
+
+    def clear(self) -> None:
+        '''Remove the entries of this namespace and version'''
+        self._delete('substr(key, 1, ?) = ?', (len(self.prefix), self.prefix))
+
+    def __len__(self) -> int:
+        return self._connect().execute(
+            'SELECT count(*) FROM cache WHERE substr(key, 1, ?) = ?', (len(self.prefix), self.prefix),
+        ).fetchone()[0]
+
+    def bytes(self) -> int:
+        '''Total size of the values in the file, of every namespace'''
+        return self._connect().execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+
+
+class TieredCache:
+    '''A per-worker LRUCache in front of a shared cache'''
+
+    def __init__(self, local: LRUCache, shared: SQLiteCache) -> None:
+        self.local = local
+        self.shared = shared
+
+    def get(self, key, default=None):
+        if (value := self.local.get(key)) is not None:
+            return value
+        if (value := self.shared.get(key)) is not None:
+            self.local[key] = value
+            return value
+        return default
+
+    def __setitem__(self, key, value) -> None:
+        self.local[key] = value
+        self.shared[key] = value
+
+    def pop(self, key, default=None):
+        self.local.pop(key)
+        return self.shared.pop(key, default)
+
+    def clear(self) -> None:
+        self.local.clear()
+        self.shared.clear()
+
+    def __len__(self) -> int:
+        return len(self.shared)
@@ -0,0 +1,102 @@
+'''
+Command line tools: `ash <command> --help` for details.
+'''
+
+import os
+import argparse
+from pathlib import Path
+
+from elasticsearch import Elasticsearch
+
+from . import app
+from . import media_path
+
+
+def cmd_ingest(args: argparse.Namespace) -> None:
+    from .ingest import ingest
+    es = Elasticsearch(args.es_host, request_timeout=120, max_retries=3, retry_on_timeout=True)
+    total = ingest(
+        es,
+        args.paths,
+        tweets_index=args.tweets_index,
+        toots_index=args.toots_index,
+        chunk_size=args.chunk_size,
+        threads=args.threads,
+        checkpoint=args.checkpoint,
+    )
+    print(f'Loaded {total} documents')
+
+
+def cmd_reindex_views(args: argparse.Namespace) -> None:
+    from .ingest import reindex_views
+    es = Elasticsearch(args.es_host, request_timeout=120, max_retries=3, retry_on_timeout=True)
+    reindex_views(es, args.index, chunk_size=args.chunk_size, threads=args.threads)
+
+
+def cmd_media_index(args: argparse.Namespace) -> None:
+    from .media import MediaIndex
+    index = MediaIndex(args.fs_path, args.manifest)
+    print(f'Indexed {len(index)} files in {len(index.dirs)} directories into {args.manifest}')
+
+
+def cmd_derivatives(args: argparse.Namespace) -> None:
+    from .derivatives import make_all
+    count = make_all(args.fs_path, args.cache_path, threads=args.threads)
+    print(f'{count} derivatives in {args.cache_path}')
+
+
+def main():
+    ap = argparse.ArgumentParser(prog='ash')
+    sub = ap.add_subparsers(dest='command', required=True)
+
+    ingest_ap = sub.add_parser(
+        'ingest',
+        help='load Twitter archives and Mastodon outboxes into Elasticsearch',
+        description='Load tweets*.js of Twitter archives and outbox.json of Mastodon exports into Elasticsearch.',
+    )
+    ingest_ap.add_argument('paths', nargs='+', type=Path,
+                           help='archive directories, or .js / outbox.json files')
+    ingest_ap.add_argument('--es-host', default=app.config['T_ES_HOST'])
+    ingest_ap.add_argument('--tweets-index', default='tweets-%Y', help='strftime pattern of tweet index names')
+    ingest_ap.add_argument('--toots-index', default='toots-%Y', help='strftime pattern of toot index names')
+    ingest_ap.add_argument('--chunk-size', type=int, default=500, help='documents per bulk request')
+    ingest_ap.add_argument('--threads', type=int, default=4, help='concurrent bulk requests')
+    ingest_ap.add_argument('--checkpoint', type=Path, help='file to record progress in, to resume from')
+    ingest_ap.set_defaults(func=cmd_ingest)
+
+    views_ap = sub.add_parser(
+        'reindex-views',
+        help='add precomputed views to documents, for T_ES_VIEWS',
+        description='Add or update the @view of documents that lack a current one.',
+    )
+    views_ap.add_argument('--es-host', default=app.config['T_ES_HOST'])
+    views_ap.add_argument('--index', default=app.config['T_ES_INDEX'], help='indexes to update')
+    views_ap.add_argument('--chunk-size', type=int, default=500, help='documents per bulk request')
+    views_ap.add_argument('--threads', type=int, default=4, help='concurrent bulk requests')
+    views_ap.set_defaults(func=cmd_reindex_views)
+
+    media_ap = sub.add_parser(
+        'media-index',
+        help='build or update the index of local media files',
+        description='Build or update T_MEDIA_MANIFEST, the index of files in T_MEDIA_FS_PATH.',
+    )
+    media_ap.add_argument('--fs-path', default=media_path(app.config.get('T_MEDIA_FS_PATH', './media')))
+    media_ap.add_argument('--manifest', default=media_path(app.config['T_MEDIA_MANIFEST'] or 'media-manifest.json'))
+    media_ap.set_defaults(func=cmd_media_index)
+
+    derivatives_ap = sub.add_parser(
+        'derivatives',
+        help='make thumbnails and video posters ahead of time',
+        description='Make missing derivatives of files in T_MEDIA_FS_PATH, for T_MEDIA_DERIVATIVES.',
+    )
+    derivatives_ap.add_argument('--fs-path', default=media_path(app.config.get('T_MEDIA_FS_PATH', './media')))
+    derivatives_ap.add_argument('--cache-path', default=media_path(app.config['T_MEDIA_CACHE_PATH']))
+    derivatives_ap.add_argument('--threads', type=int, default=os.cpu_count() or 4)
+    derivatives_ap.set_defaults(func=cmd_derivatives)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+'''
+Smaller derivatives of media files: resized WebP images and video posters.
+
+Derivatives are written to a cache directory under a name derived from the
+source file (path, size and mtime) and the variant, so a changed source gets
+a new derivative and stale ones are never served. They are made on first
+request, or ahead of time with `ash derivatives`.
+
+Images need Pillow (`pip install ash[derivatives]`), and posters need ffmpeg
+on PATH. Without them, no derivative is made and originals are served.
+'''
+
+from __future__ import annotations
+
+import os
+import shutil
+import hashlib
+import subprocess
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Iterator
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+VARIANTS = {
+    # For <img> on tweet pages; the link still goes to the original
+    'thumb': {'kind': 'image', 'width': 960, 'format': 'webp', 'quality': 80},
+    # First frame of a video, for <video poster>
+    'poster': {'kind': 'video', 'width': 960, 'format': 'webp', 'quality': 75},
+}
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.webm', '.m4v')
+
+# Raised by sources that are broken or hostile (e.g. truncated, or too many
+# pixels), whose originals are served instead
+MAKE_ERRORS = (OSError, ValueError, subprocess.SubprocessError)
+if Image is not None:
+    MAKE_ERRORS += (Image.DecompressionBombError,)
+
+
+@lru_cache(maxsize=None)
+def _has_ffmpeg() -> bool:
+    return shutil.which('ffmpeg') is not None
+
+
+def can_make(variant: str, rel_path: str) -> bool:
+    '''Whether a derivative of this kind of file could be made here'''
+    spec = VARIANTS[variant]
+    ext = os.path.splitext(rel_path)[1].lower()
+    if spec['kind'] == 'image':
+        return Image is not None and ext in IMAGE_EXTENSIONS
+    return ext in VIDEO_EXTENSIONS and _has_ffmpeg()
+
+
+class DerivativeCache:
+    '''Derivatives of files under media_root, kept under cache_root'''
+
+    def __init__(self, media_root: str, cache_root: str) -> None:
+        self.media_root = media_root
+        self.cache_root = cache_root
+
+    def source(self, rel_path: str) -> str | None:
+        '''Return the path of a media file, or None if it is not a file
+        under media_root'''
+        root = os.path.realpath(self.media_root)
+        path = os.path.realpath(os.path.join(root, rel_path))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def name(self, variant: str, source: str) -> str:
+        '''Return the path of a derivative relative to cache_root'''
+        spec = VARIANTS[variant]
+        stat = os.stat(source)
+        ident = f'{variant}:{sorted(spec.items())}:{source}:{stat.st_size}:{stat.st_mtime_ns}'
+        digest = hashlib.blake2b(ident.encode(), digest_size=16).hexdigest()
+        return f'{digest[:2]}/{digest}.{spec["format"]}'
+
+    def get(self, variant: str, rel_path: str) -> str | None:
+        '''Return the path of a derivative relative to cache_root, making it
+        if need be. None if it cannot be made.'''
+        if variant not in VARIANTS or not can_make(variant, rel_path):
+            return None
+        if (source := self.source(rel_path)) is None:
+            return None
+        name = self.name(variant, source)
+        dest = os.path.join(self.cache_root, name)
+        if os.path.exists(dest):
+            return name
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # Concurrent makers each write their own file, and the last one wins
+        tmp = f'{dest}.{os.getpid()}.{id(self)}.tmp'
+        try:
+            if VARIANTS[variant]['kind'] == 'image':
+                self._make_image(source, tmp, VARIANTS[variant])
+            else:
+                self._make_poster(source, tmp, VARIANTS[variant])
+            os.replace(tmp, dest)
+        except MAKE_ERRORS:
+            return None
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        return name
+
+    @staticmethod
+    def _make_image(source: str, dest: str, spec: dict) -> None:
+        with Image.open(source) as im:
+            im.seek(0)  # first frame of animated images
+            if im.width > spec['width']:
+                im = im.resize((spec['width'], round(im.height * spec['width'] / im.width)), Image.LANCZOS)
+            if im.mode not in ('RGB', 'RGBA'):
+                im = im.convert('RGBA' if 'transparency' in im.info else 'RGB')
+            im.save(dest, format=spec['format'], quality=spec['quality'])
+
+    @staticmethod
+    def _make_poster(source: str, dest: str, spec: dict) -> None:
+        subprocess.run(
+            [
+                'ffmpeg', '-nostdin', '-loglevel', 'error', '-y',
+                '-i', source,
+                '-frames:v', '1',
+                '-vf', f"scale='min({spec['width']},iw)':-2",
+                '-quality', str(spec['quality']),
+                '-f', spec['format'], dest,
+            ],
+            check=True,
+            timeout=60,
+        )
+
+
+def iter_media(media_root: str) -> Iterator[str]:
+    '''Yield paths of files under media_root, relative to it'''
+    for dirpath, _, filenames in os.walk(media_root):
+        for filename in filenames:
+            yield os.path.relpath(os.path.join(dirpath, filename), media_root)
+
+
+def make_all(media_root: str, cache_root: str, *, threads: int = os.cpu_count() or 4, log=print) -> int:
+    '''Make every derivative that is missing, ahead of time. Returns how
+    many there are.'''
+    cache = DerivativeCache(media_root, cache_root)
+    jobs = (
+        (variant, rel_path)
+        for rel_path in iter_media(media_root)
+        for variant in VARIANTS
+        if can_make(variant, rel_path)
+    )
+    count = 0
+    # Pillow and ffmpeg do their work without the GIL
+    with ThreadPoolExecutor(threads) as pool:
+        for name in pool.map(lambda job: cache.get(*job), jobs):
+            if name:
+                count += 1
+                if count % 1000 == 0:
+                    log(f'{count} derivatives')
+    return count
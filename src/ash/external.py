@@ -0,0 +1,188 @@
+'''
+Fetch Tweets that are not in the database from Twitter API.
+'''
+
+from __future__ import annotations
+
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class TweetsCache:
+    '''Fetched Tweets in a SQLite database shared by all workers
+
+    Misses are cached too, as rows without a body, with their own TTL. Rows
+    are deleted once expired, as others are written. Like
+    ash.cache.SQLiteCache, once opened it degrades rather than fails: reads
+    miss and writes are dropped when the file cannot be read or written
+    within timeout seconds.
+    '''
+
+    def __init__(self, path: str, ttl: float, negative_ttl: float, *, timeout: float = 1) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tweets ('
+                'id TEXT PRIMARY KEY, body TEXT, fetched_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS tweets_fetched_at ON tweets (fetched_at)')
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections may not be shared between threads
+        if (conn := getattr(self._local, 'conn', None)) is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=self.timeout)
+        return conn
+
+    def get(self, tweet_id: str) -> tuple[bool, dict | None]:
+        '''Return (cached, tweet). tweet is None for a cached miss.'''
+        try:
+            row = self._connect().execute(
+                'SELECT body, fetched_at FROM tweets WHERE id = ?', (tweet_id,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Tweets cache miss on error: %s', e)
+            return False, None
+        if row is None:
+            return False, None
+        body, fetched_at = row
+        ttl = self.negative_ttl if body is None else self.ttl
+        if time.time() - fetched_at > ttl:
+            return False, None
+        return True, None if body is None else json.loads(body)
+
+    def set(self, tweet_id: str, tweet: dict | None) -> None:
+        body = None if tweet is None else json.dumps(tweet, ensure_ascii=False)
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO tweets (id, body, fetched_at) VALUES (?, ?, ?)',
+                    (tweet_id, body, now),
+                )
+                conn.execute(
+                    'DELETE FROM tweets WHERE fetched_at < ? AND ('
+                    '(body IS NOT NULL AND fetched_at < ?) OR (body IS NULL AND fetched_at < ?))',
+                    (now - min(self.ttl, self.negative_ttl), now - self.ttl, now - self.negative_ttl),
+                )
+        except sqlite3.Error as e:
+            logger.warning('Tweets cache write dropped on error: %s', e)
+
+
+class TokenError(requests.HTTPError):
+    '''Twitter did not issue a bearer token'''
+
+
+class TwitterFetcher:
+    '''Fetch Tweets from Twitter API over a pooled session
+
+    The bearer token is acquired on first use and re-acquired whenever Twitter
+    rejects it. Concurrent fetches of the same Tweet are made once.
+    '''
+
+    # Statuses that mean the Tweet cannot be fetched, now or later
+    MISSING_STATUSES = (403, 404)
+
+    def __init__(self, key: str, secret: str, *, api_base: str = 'https://api.twitter.com',
+                 timeout: float = 10, pool_size: int = 10, cache: TweetsCache | None = None) -> None:
+        self.key = key
+        self.secret = secret
+        self.api_base = api_base.rstrip('/')
+        self.timeout = timeout
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._token: str | None = None
+        self._token_lock = threading.Lock()
+        self._in_flight = SingleFlight()
+
+    def get_token(self, stale: str | None = None) -> str:
+        '''Return the bearer token, acquiring a new one if there is none or
+        the current one is stale'''
+        with self._token_lock:
+            if self._token is None or self._token == stale:
+                # https://developer.twitter.com/en/docs/basics/authentication/api-reference/token
+                resp = self.session.post(
+                    f'{self.api_base}/oauth2/token',
+                    headers={
+                        'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8'
+                    },
+                    auth=(self.key, self.secret),
+                    data='grant_type=client_credentials',
+                    timeout=self.timeout,
+                )
+                try:
+                    resp.raise_for_status()
+                    self._token = resp.json()['access_token']
+                except (requests.HTTPError, ValueError, KeyError):
+                    raise TokenError(
+                        f'Failed to acquire Twitter API token. Error from Twitter: {resp.text}',
+                        response=resp,
+                    ) from None
+            return self._token
+
+    def _get(self, tweet_id: str) -> requests.Response:
+        token = self.get_token()
+        for _ in range(2):
+            resp = self.session.get(
+                f'{self.api_base}/1.1/statuses/show.json',
+                headers={
+                    'Authorization': f'Bearer {token}'
+                },
+                params={
+                    'id': tweet_id,
+                    'tweet_mode': 'extended'
+                },
+                timeout=self.timeout,
+            )
+            if resp.status_code != 401:
+                break
+            token = self.get_token(stale=token)
+        return resp
+
+    def fetch(self, tweet_id: int | str) -> dict:
+        '''Fetch a Tweet. Raises KeyError if Twitter does not have it,
+        TokenError if no bearer token can be had, requests.HTTPError if
+        Twitter answers with an error or garbage, and
+        requests.RequestException on other failures.'''
+        tweet_id = str(tweet_id)
+        return self._in_flight.do(tweet_id, lambda: self._fetch(tweet_id))
+
+    def _fetch(self, tweet_id: str) -> dict:
+        if self.cache:
+            cached, tweet = self.cache.get(tweet_id)
+            if cached:
+                if tweet is None:
+                    raise KeyError(f'Tweet ID {tweet_id} not found')
+                return tweet
+
+        resp = self._get(tweet_id)
+        if resp.status_code in self.MISSING_STATUSES:
+            if self.cache:
+                self.cache.set(tweet_id, None)
+            raise KeyError(f'Tweet ID {tweet_id} not found')
+        resp.raise_for_status()
+
+        try:
+            tweet = resp.json()
+        except ValueError:
+            raise requests.HTTPError(f'Twitter answered Tweet ID {tweet_id} with invalid JSON', response=resp) from None
+        if self.cache:
+            self.cache.set(tweet_id, tweet)
+        return tweet
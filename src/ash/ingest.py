@@ -0,0 +1,299 @@
+'''
+Load Twitter archives and Mastodon outboxes into Elasticsearch.
+
+Files are parsed as streams and sent with parallel bulk requests, so memory
+stays flat however large the archive is. Documents are indexed by ID, so a
+load can be re-run or resumed from its checkpoint file without duplicates.
+
+Each document is stored with a precomputed @view (see ash.make_view), which
+the server renders from when T_ES_VIEWS is set. Views of documents loaded
+otherwise, or by older versions, are (re)built with reindex_views().
+'''
+
+from __future__ import annotations
+
+import re
+import json
+import html
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+from collections.abc import Iterator
+from collections.abc import Iterable
+
+from elasticsearch import Elasticsearch
+from elasticsearch import NotFoundError
+from elasticsearch import BadRequestError
+from elasticsearch.helpers import parallel_bulk
+
+from . import VIEW_VERSION
+from . import TweetsDatabase
+from . import make_view
+from .archive import parse_created_at
+from .archive import iter_json_array
+
+
+# Settings that slow down bulk loads, and their values while loading
+BULK_SETTINGS = {
+    'index.refresh_interval': '-1',
+    'index.number_of_replicas': '0',
+}
+
+# Views are only ever read back, never searched
+VIEW_MAPPING = {
+    'properties': {
+        '@view': {
+            'type': 'object',
+            'enabled': False,
+        }
+    }
+}
+
+
+def _archive_user(data_dir: Path) -> dict | None:
+    '''Return the user of a new-style archive from its account.js and
+    profile.js, as tweets there do not carry one'''
+    account_file = data_dir / 'account.js'
+    if not account_file.exists():
+        return None
+    with open(account_file, encoding='utf-8') as f:
+        account = next(iter_json_array(f))['account']
+    user = {
+        'id_str': account.get('accountId'),
+        'screen_name': account['username'],
+        'name': account.get('accountDisplayName') or account['username'],
+    }
+    if (profile_file := data_dir / 'profile.js').exists():
+        with open(profile_file, encoding='utf-8') as f:
+            profile = next(iter_json_array(f))['profile']
+        if avatar := profile.get('avatarMediaUrl'):
+            user['profile_image_url_https'] = avatar
+    return user
+
+
+def iter_archive_tweets(js_file: Path) -> Iterator[dict]:
+    '''Yield tweets from a Twitter archive .js file, old (Grailbird) or new'''
+    user = _archive_user(js_file.parent)
+    with open(js_file, encoding='utf-8') as f:
+        for item in iter_json_array(f):
+            tweet = item.get('tweet', item)
+            tweet['@timestamp'] = parse_created_at(tweet['created_at']).isoformat()
+            if user and not tweet.get('user'):
+                tweet['user'] = user
+            yield tweet
+
+
+def _html_to_text(content: str) -> str:
+    content = re.sub(r'<br\s*/?>|</p><p>', '\n', content)
+    return html.unescape(re.sub(r'<[^>]+>', '', content))
+
+
+def activity_to_toot(activity: dict, actor: dict) -> dict | None:
+    '''Convert an ActivityPub Create activity into the shape of a Mastodon API
+    status. Other activities (e.g. boosts, which only link to the boosted
+    status) are skipped by returning None.'''
+    obj = activity.get('object')
+    if activity.get('type') != 'Create' or not isinstance(obj, dict):
+        return None
+    actor_url = actor.get('id') or activity.get('actor', '')
+    account = {
+        'id': actor_url,
+        'url': actor.get('url') or actor_url,
+        'fqn': f'{actor.get("preferredUsername", "")}@{urlsplit(actor_url).netloc}',
+        'display_name': actor.get('name') or actor.get('preferredUsername', ''),
+        'avatar': (actor.get('icon') or {}).get('url', ''),
+    }
+    in_reply_to_id = in_reply_to_account_id = None
+    if in_reply_to := obj.get('inReplyTo'):
+        in_reply_to_id = in_reply_to.rstrip('/').rsplit('/', 1)[-1]
+        if in_reply_to.startswith(f'{actor_url}/'):
+            in_reply_to_account_id = actor_url
+    content = obj.get('content') or ''
+    return {
+        'id': obj['id'].rstrip('/').rsplit('/', 1)[-1],
+        'uri': obj['id'],
+        'url': obj.get('url') or obj['id'],
+        'created_at': obj['published'],
+        '@timestamp': parse_created_at(obj['published']).isoformat(),
+        'content': content,
+        'content_text': _html_to_text(content),
+        'spoiler_text': obj.get('summary') or '',
+        'account': account,
+        'media_attachments': [
+            {
+                'type': (att.get('mediaType') or '').split('/')[0],
+                'url': att.get('url'),
+                'description': att.get('name') or '',
+            }
+            for att in obj.get('attachment') or []
+        ],
+        'in_reply_to_id': in_reply_to_id,
+        'in_reply_to_account_id': in_reply_to_account_id,
+    }
+
+
+def iter_outbox_toots(outbox_file: Path) -> Iterator[dict]:
+    '''Yield toots from outbox.json of a Mastodon export, using actor.json
+    next to it for account details'''
+    actor_file = outbox_file.parent / 'actor.json'
+    actor = json.loads(actor_file.read_text()) if actor_file.exists() else {}
+    with open(outbox_file, encoding='utf-8') as f:
+        for activity in iter_json_array(f, marker='"orderedItems"'):
+            if toot := activity_to_toot(activity, actor):
+                yield toot
+
+
+def find_sources(paths: Iterable[Path]) -> Iterator[tuple[Path, str]]:
+    '''Yield (file, kind) of loadable files in paths, where kind is "tweets"
+    or "toots". Directories are searched for tweets*.js and outbox.json.'''
+    for path in paths:
+        if path.is_dir():
+            for js_file in sorted(path.glob('data/tweets*.js')) + sorted(path.glob('data/js/tweets/*.js')):
+                yield js_file, 'tweets'
+            if (outbox := path / 'outbox.json').exists():
+                yield outbox, 'toots'
+        elif path.name.endswith('.json'):
+            yield path, 'toots'
+        else:
+            yield path, 'tweets'
+
+
+class Checkpoint:
+    '''Number of documents loaded per source file, saved as JSON
+
+    A file that has changed since (size or mtime) starts over.
+    '''
+
+    def __init__(self, path: Path | None) -> None:
+        self.path = path
+        self.done: dict[str, int] = {}
+        if path and path.exists():
+            self.done = json.loads(path.read_text())
+
+    @staticmethod
+    def key(source: Path) -> str:
+        stat = source.stat()
+        return f'{source.resolve()}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    def get(self, source: Path) -> int:
+        return self.done.get(self.key(source), 0)
+
+    def set(self, source: Path, count: int) -> None:
+        self.done[self.key(source)] = count
+        if self.path:
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(self.done, indent=2))
+            tmp.replace(self.path)
+
+
+def put_view_mapping(es: Elasticsearch, index: str) -> None:
+    try:
+        es.indices.put_mapping(index=index, properties=VIEW_MAPPING['properties'])
+    except BadRequestError:
+        # @view was mapped dynamically before: it works all the same, only
+        # it is indexed needlessly
+        pass
+
+
+class BulkSettings:
+    '''Switch off refresh and replicas of indexes while they are loaded, and
+    restore the original settings afterwards'''
+
+    def __init__(self, es: Elasticsearch) -> None:
+        self.es = es
+        self.original: dict[str, dict] = {}
+
+    def prepare(self, index: str) -> None:
+        if index in self.original:
+            return
+        try:
+            settings = self.es.indices.get_settings(index=index, flat_settings=True)[index]['settings']
+        except NotFoundError:
+            self.es.indices.create(index=index, settings=BULK_SETTINGS, mappings=VIEW_MAPPING)
+            settings = {}
+        else:
+            self.es.indices.put_settings(index=index, settings=BULK_SETTINGS)
+            put_view_mapping(self.es, index)
+        # None resets a setting to its default
+        self.original[index] = {k: settings.get(k) for k in BULK_SETTINGS}
+
+    def restore(self) -> None:
+        for index, settings in self.original.items():
+            self.es.indices.put_settings(index=index, settings=settings)
+        if self.original:
+            self.es.indices.refresh(index=','.join(self.original))
+        self.original.clear()
+
+
+def ingest(es: Elasticsearch, paths: Iterable[Path], *, tweets_index: str = 'tweets-%Y',
+           toots_index: str = 'toots-%Y', chunk_size: int = 500, threads: int = 4,
+           checkpoint: Path | None = None, log=print) -> int:
+    '''Load tweets and toots found in paths. Index names are strftime
+    patterns, filled with the time of each document.'''
+    checkpoints = Checkpoint(checkpoint)
+    bulk_settings = BulkSettings(es)
+    total = 0
+    try:
+        for source, kind in find_sources(paths):
+            skip = checkpoints.get(source)
+            docs = iter_archive_tweets(source) if kind == 'tweets' else iter_outbox_toots(source)
+            index_pattern = tweets_index if kind == 'tweets' else toots_index
+
+            def actions(docs=docs, skip=skip, index_pattern=index_pattern):
+                for n, doc in enumerate(docs):
+                    if n < skip:
+                        continue
+                    index = parse_created_at(doc['@timestamp']).strftime(index_pattern)
+                    bulk_settings.prepare(index)
+                    doc['@view'] = make_view(doc)
+                    yield {
+                        '_op_type': 'index',
+                        '_index': index,
+                        '_id': str(doc.get('id_str') or doc['id']),
+                        '_source': doc,
+                    }
+
+            start = time.perf_counter()
+            count = skip
+            results = parallel_bulk(es, actions(), thread_count=threads, chunk_size=chunk_size)
+            for ok, _ in results:
+                count += 1
+                if count % chunk_size == 0:
+                    checkpoints.set(source, count)
+            checkpoints.set(source, count)
+            total += count - skip
+            log(f'{source}: loaded {count - skip} documents in {time.perf_counter() - start:.1f}s'
+                + (f' (skipped {skip} loaded before)' if skip else ''))
+    finally:
+        bulk_settings.restore()
+    return total
+
+
+def reindex_views(es: Elasticsearch, index: str, *, chunk_size: int = 500, threads: int = 4,
+                  log=print) -> int:
+    '''Add or update the @view of documents in index that lack a current one'''
+    put_view_mapping(es, index)
+    tdb = TweetsDatabase(es, index)
+
+    def actions():
+        for hit in tdb.scan(size=chunk_size):
+            source = hit['_source']
+            if (source.get('@view') or {}).get('v') == VIEW_VERSION:
+                continue
+            source.pop('@view', None)
+            yield {
+                '_op_type': 'update',
+                '_index': hit['_index'],
+                '_id': hit['_id'],
+                'doc': {
+                    '@view': make_view(source),
+                },
+            }
+
+    start = time.perf_counter()
+    count = 0
+    for ok, _ in parallel_bulk(es, actions(), thread_count=threads, chunk_size=chunk_size):
+        count += 1
+    es.indices.refresh(index=index)
+    log(f'{index}: updated views of {count} documents in {time.perf_counter() - start:.1f}s')
+    return count
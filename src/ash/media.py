@@ -0,0 +1,269 @@
+'''
+Resolve media URLs to where the media can actually be loaded from.
+
+T_MEDIA_FROM may be a chain of sources, e.g. ('filesystem', 'mirror',
+'direct'), in which case each media item is served from the first source that
+has it. What is on the filesystem is known from an index of T_MEDIA_FS_PATH,
+and what is on the mirror from a manifest listing its URLs, so finding out
+costs no I/O at request time.
+'''
+
+from __future__ import annotations
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from urllib.parse import urlsplit
+from urllib.parse import SplitResult
+
+
+SOURCES = ('filesystem', 'mirror', 'direct')
+
+logger = logging.getLogger(__name__)
+
+
+def media_key(url: str | SplitResult) -> str:
+    '''Return the path of a media URL relative to T_MEDIA_FS_PATH'''
+    parts = urlsplit(url) if isinstance(url, str) else url
+    return f'{parts.netloc}{parts.path}'
+
+
+def _hash(name: str) -> int:
+    # 8 bytes per entry instead of a whole string
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'little')
+
+
+class MediaIndex:
+    '''Files under a media directory, as hashes of their names grouped by
+    directory
+
+    refresh() lists again only directories whose mtime has changed, so new
+    downloads are picked up at the cost of a stat() per directory. With a
+    manifest path, the index is saved there and loaded from there, so that
+    workers do not each walk the whole directory when they start.
+    '''
+
+    def __init__(self, root: str, manifest: str | None = None) -> None:
+        self.root = root
+        self.manifest = manifest
+        self.dirs: dict[str, tuple[int, frozenset[int]]] = {}
+        self.generation = 0
+        # Like generation, but the same in every process that sees the same
+        # directories
+        self.fingerprint = ''
+        self._lock = threading.Lock()
+        if manifest and os.path.exists(manifest):
+            self._load()
+        self.refresh()
+
+    def __contains__(self, key: str) -> bool:
+        dirname, _, name = key.rpartition('/')
+        entry = self.dirs.get(dirname)
+        return entry is not None and _hash(name) in entry[1]
+
+    def __len__(self) -> int:
+        return sum(len(names) for _, names in self.dirs.values())
+
+    def refresh(self) -> bool:
+        '''Re-list changed directories. Returns whether anything changed.'''
+        with self._lock:
+            changed = False
+            # A new directory changes the mtime of its parent, so stat()ing
+            # the known ones finds every change
+            pending = list(self.dirs) or ['']
+            seen = set()
+            while pending:
+                rel = pending.pop()
+                if rel in seen:
+                    continue
+                seen.add(rel)
+                path = os.path.join(self.root, rel)
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    changed |= self.dirs.pop(rel, None) is not None
+                    continue
+                if (entry := self.dirs.get(rel)) and entry[0] == mtime:
+                    continue
+                names = set()
+                with os.scandir(path) as it:
+                    for e in it:
+                        if e.is_dir():
+                            pending.append(f'{rel}/{e.name}' if rel else e.name)
+                        else:
+                            names.add(_hash(e.name))
+                self.dirs[rel] = (mtime, frozenset(names))
+                changed = True
+            if changed or not self.fingerprint:
+                state = repr(sorted((rel, mtime) for rel, (mtime, _) in self.dirs.items()))
+                self.fingerprint = hashlib.blake2b(state.encode(), digest_size=8).hexdigest()
+            if changed:
+                self.generation += 1
+                if self.manifest:
+                    self._save()
+            return changed
+
+    def _load(self) -> None:
+        # A manifest that cannot be read is rebuilt by walking the directory
+        try:
+            with open(self.manifest) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring media manifest %s: %s', self.manifest, e)
+            return
+        if manifest.get('root') == os.path.abspath(self.root):
+            self.dirs = {
+                rel: (mtime, frozenset(names))
+                for rel, (mtime, names) in manifest['dirs'].items()
+            }
+
+    def _save(self) -> None:
+        manifest = {
+            'root': os.path.abspath(self.root),
+            'dirs': {
+                rel: [mtime, sorted(names)]
+                for rel, (mtime, names) in self.dirs.items()
+            },
+        }
+        tmp = f'{self.manifest}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f, separators=(',', ':'))
+            os.replace(tmp, self.manifest)
+        except OSError as e:
+            # The index in memory is still good, workers just build their own
+            logger.warning('Media manifest not saved to %s: %s', self.manifest, e)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+
+class MirrorManifest:
+    '''URLs known to be on the mirror, read from a file with one URL (or
+    path relative to T_MEDIA_FS_PATH) per line, and read again when the file
+    changes'''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.keys: frozenset[int] = frozenset()
+        self.mtime = None
+        self.generation = 0
+        self.refresh()
+
+    def __contains__(self, key: str) -> bool:
+        return _hash(key) in self.keys
+
+    def refresh(self) -> bool:
+        # Without a readable file, nothing is known to be on the mirror
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return False
+            with open(self.path) as f:
+                keys = frozenset(
+                    _hash(media_key(line) if '://' in line else line)
+                    for line in map(str.strip, f) if line
+                )
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring mirror manifest %s: %s', self.path, e)
+            if self.mtime is None and self.generation:
+                return False
+            keys, mtime = frozenset(), None
+        self.keys = keys
+        self.mtime = mtime
+        self.generation += 1
+        return True
+
+
+class MediaResolver:
+    '''Pick where to load each media item from, trying sources in order
+
+    A source is skipped if it is known not to have the item, except the last
+    one, which is used regardless, so a single source behaves as it always
+    did.
+    '''
+
+    def __init__(self, chain: str | tuple[str, ...] | list[str], *, mirrors: dict[str, str] | None = None,
+                 fs_path: str | None = None, manifest: str | None = None,
+                 mirror_manifest: str | None = None, rescan_interval: float = 60) -> None:
+        self.chain = (chain,) if isinstance(chain, str) else tuple(chain)
+        if unknown := set(self.chain) - set(SOURCES):
+            raise ValueError(f'Unknown media sources: {", ".join(sorted(unknown))}')
+        # Mirrors of whole hosts are looked up by host, anything else is
+        # substituted as before
+        mirrors = mirrors or {}
+        self.mirror_hosts = {orig: repl for orig, repl in mirrors.items() if '/' not in orig}
+        self.mirror_others = [(orig, repl) for orig, repl in mirrors.items() if '/' in orig]
+        self.fs_index = None
+        self.mirror_manifest = None
+        if 'filesystem' in self.chain[:-1] and fs_path:
+            self.fs_index = MediaIndex(fs_path, manifest)
+        if 'mirror' in self.chain[:-1] and mirror_manifest:
+            self.mirror_manifest = MirrorManifest(mirror_manifest)
+        self.rescan_interval = rescan_interval
+        self._checked = time.monotonic()
+        self._refreshing = threading.Lock()
+
+    @property
+    def generation(self) -> tuple[str, int]:
+        '''Changes whenever what is known to exist changes, and is the same
+        in every worker that knows the same'''
+        return (
+            self.fs_index.fingerprint if self.fs_index else '',
+            self.mirror_manifest.mtime if self.mirror_manifest else 0,
+        )
+
+    def _mirror_url(self, url: str, parts: SplitResult) -> str | None:
+        if (repl := self.mirror_hosts.get(parts.netloc)) is not None:
+            return url.replace(parts.netloc, repl, 1)
+        for orig, repl in self.mirror_others:
+            if orig in url:
+                return url.replace(orig, repl)
+        return None
+
+    def resolve(self, url: str) -> tuple[str, str]:
+        '''Return (source, location) of a media URL, where location is a path
+        relative to T_MEDIA_FS_PATH for "filesystem" and a URL otherwise'''
+        self._refresh_in_background()
+        parts = urlsplit(url)
+        key = media_key(parts)
+        last = len(self.chain) - 1
+        for n, source in enumerate(self.chain):
+            if source == 'filesystem':
+                if n == last or (self.fs_index is not None and key in self.fs_index):
+                    return source, key
+            elif source == 'mirror':
+                if (mirrored := self._mirror_url(url, parts)) is None:
+                    continue
+                if n == last or self.mirror_manifest is None or key in self.mirror_manifest:
+                    return source, mirrored
+            else:
+                return source, url
+        return 'direct', url
+
+    def refresh(self) -> None:
+        if self.fs_index is not None:
+            self.fs_index.refresh()
+        if self.mirror_manifest is not None:
+            self.mirror_manifest.refresh()
+
+    def _refresh_in_background(self) -> None:
+        if self.fs_index is None and self.mirror_manifest is None:
+            return
+        if time.monotonic() - self._checked < self.rescan_interval:
+            return
+        if not self._refreshing.acquire(blocking=False):
+            return
+        self._checked = time.monotonic()
+
+        def refresh():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing.release()
+
+        threading.Thread(target=refresh, daemon=True).start()
@@ -0,0 +1,367 @@
+'''
+Where request time goes: Elasticsearch round trips, tweet text, templates.
+
+Each request gets a RequestStats in flask.g, which the Elasticsearch
+transport and timed() blocks add to. When the request is done, the stats are
+sent as a Server-Timing header (T_SERVER_TIMING) and/or recorded in
+Prometheus histograms labelled by view, served at /metrics (T_METRICS).
+
+Each worker process keeps its own metrics. When the workers share a cache
+file (T_CACHE_BACKEND = 'sqlite'), they also write them there, so that
+/metrics serves the sum of all of them whichever worker is scraped.
+Otherwise, every series is labelled by the PID of the worker, for Prometheus
+to add up.
+'''
+
+from __future__ import annotations
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections.abc import Iterator
+from collections.abc import Iterable
+
+import flask
+from elastic_transport import Transport
+
+
+SECONDS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21)
+
+
+class RequestStats:
+    '''Accounting of a single request'''
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.es_queries = 0
+        self.es_seconds = 0.0
+        self.es_sent = 0
+        self.es_received = 0
+        self.phases: dict[str, float] = {}
+        self._render_start = None
+        # Queries of a request may run concurrently (see ash.fan_out)
+        self.lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float) -> None:
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def server_timing(self, total: float) -> str:
+        entries = [
+            f'es;dur={self.es_seconds * 1000:.2f};desc="{self.es_queries} queries, {self.es_received} bytes"',
+        ]
+        entries.extend(f'{phase};dur={seconds * 1000:.2f}' for phase, seconds in self.phases.items())
+        entries.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(entries)
+
+
+def current() -> RequestStats | None:
+    '''Return the stats of the current request, if it is being accounted'''
+    if not flask.has_app_context():
+        return None
+    return flask.g.get('request_stats')
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    '''Add the time spent in a block (or function, as a decorator) to a phase
+    of the current request'''
+    if (stats := current()) is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add(phase, time.perf_counter() - start)
+
+
+class _CountingSerializers:
+    '''Counts the bytes going through the serializers of a transport, which
+    see every request and response body'''
+
+    def __init__(self, serializers) -> None:
+        self._serializers = serializers
+
+    def dumps(self, data, mimetype=None) -> bytes:
+        body = self._serializers.dumps(data, mimetype)
+        if (stats := current()) is not None:
+            with stats.lock:
+                stats.es_sent += len(body)
+        return body
+
+    def loads(self, data: bytes, mimetype=None):
+        if (stats := current()) is not None:
+            with stats.lock:
+                stats.es_received += len(data)
+        return self._serializers.loads(data, mimetype)
+
+    def __getattr__(self, name):
+        return getattr(self._serializers, name)
+
+
+class InstrumentedTransport(Transport):
+    '''An Elasticsearch transport that accounts every call to the current
+    request (retries included)'''
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.serializers = _CountingSerializers(self.serializers)
+
+    def perform_request(self, *args, **kwargs):
+        if (stats := current()) is None:
+            return super().perform_request(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().perform_request(*args, **kwargs)
+        finally:
+            with stats.lock:
+                stats.es_queries += 1
+                stats.es_seconds += time.perf_counter() - start
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...]) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # label values -> numbers, which add up across workers as they are
+        self.series: dict[tuple[str, ...], list[float]] = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> dict[tuple[str, ...], list[float]]:
+        with self._lock:
+            return {labels: list(values) for labels, values in self.series.items()}
+
+    def render(self, series: dict[tuple[str, ...], list[float]], pid: str | None = None) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        names = self.labels + ('pid',) if pid else self.labels
+        for labels, values in sorted(series.items()):
+            yield from self._render(names, labels + (pid,) if pid else labels, values)
+
+    def _render(self, names: tuple[str, ...], labels: tuple[str, ...], values: list[float]) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...], buckets: tuple[float, ...]) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, labels: tuple[str, ...], value: float) -> None:
+        with self._lock:
+            # Counts per bucket, sum, count
+            if (series := self.series.get(labels)) is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def _render(self, names, labels, values):
+        *counts, total, count = values
+        for bound, n in zip(self.buckets, counts):
+            le = f'le="{bound}"'
+            yield f'{self.name}_bucket{_labels(names, labels, le)} {n}'
+        le = 'le="+Inf"'
+        yield f'{self.name}_bucket{_labels(names, labels, le)} {count}'
+        yield f'{self.name}_sum{_labels(names, labels)} {total}'
+        yield f'{self.name}_count{_labels(names, labels)} {count}'
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, labels: tuple[str, ...], value: float = 1) -> None:
+        with self._lock:
+            series = self.series.setdefault(labels, [0])
+            series[0] += value
+
+    def _render(self, names, labels, values):
+        yield f'{self.name}{_labels(names, labels)} {values[0]}'
+
+
+class SharedSeries:
+    '''Series of every worker of the host, added up through a SQLite file
+
+    Each worker writes the totals of its own series under an ID of its own,
+    at most every interval seconds after a request and whenever it serves
+    /metrics. Whichever worker is scraped then answers for all of them, up to
+    interval seconds late. Totals of workers gone are kept, lest counters go
+    backwards.
+    '''
+
+    def __init__(self, path: str, interval: float = 5, timeout: float = 1) -> None:
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self._worker: tuple[int, str] | None = None
+        self._flushed_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def worker(self) -> str:
+        # Per process, and unique across restarts as PIDs get reused
+        if self._worker is None or self._worker[0] != os.getpid():
+            self._worker = (os.getpid(), f'{os.getpid()}-{uuid.uuid4().hex[:8]}')
+        return self._worker[1]
+
+    @contextmanager
+    def _connect(self, timeout: float) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=timeout)
+        try:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS metrics (worker TEXT PRIMARY KEY, series TEXT NOT NULL)')
+                yield conn
+        finally:
+            conn.close()
+
+    def flush(self, metrics: Iterable[_Metric], force: bool = False) -> None:
+        '''Write the series of this worker, if not done in the last interval
+        seconds or if forced. Unless forced, never waits for the file.'''
+        if not force and time.monotonic() - self._flushed_at < self.interval:
+            return
+        if not self._lock.acquire(blocking=force):
+            return
+        try:
+            self._flushed_at = time.monotonic()
+            series = {m.name: [[labels, values] for labels, values in m.snapshot().items()] for m in metrics}
+            with self._connect(self.timeout if force else 0) as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO metrics (worker, series) VALUES (?, ?)',
+                    (self.worker, json.dumps(series)),
+                )
+        finally:
+            self._lock.release()
+
+    def load(self, metrics: Iterable[_Metric]) -> dict[str, dict[tuple[str, ...], list[float]]]:
+        '''Return the series of every worker, added up, by metric name'''
+        totals = {m.name: {} for m in metrics}
+        with self._connect(self.timeout) as conn:
+            rows = conn.execute('SELECT series FROM metrics').fetchall()
+        for (row,) in rows:
+            for name, series in json.loads(row).items():
+                if (into := totals.get(name)) is None:
+                    continue
+                for labels, values in series:
+                    if (total := into.get(labels := tuple(labels))) is None:
+                        into[labels] = values
+                    else:
+                        into[labels] = [a + b for a, b in zip(total, values)]
+        return totals
+
+
+REQUEST_SECONDS = Histogram(
+    'ash_request_duration_seconds', 'Time to handle a request', ('view',), SECONDS_BUCKETS)
+ES_QUERIES = Histogram(
+    'ash_es_queries', 'Elasticsearch calls made by a request', ('view',), COUNT_BUCKETS)
+ES_SECONDS = Histogram(
+    'ash_es_duration_seconds', 'Time a request spent waiting for Elasticsearch', ('view',), SECONDS_BUCKETS)
+ES_BYTES = Counter(
+    'ash_es_bytes_total', 'Bytes sent to and received from Elasticsearch', ('view', 'direction'))
+PHASE_SECONDS = Histogram(
+    'ash_phase_duration_seconds', 'Time a request spent in a phase, e.g. text or render',
+    ('view', 'phase'), SECONDS_BUCKETS)
+
+METRICS = (REQUEST_SECONDS, ES_QUERIES, ES_SECONDS, ES_BYTES, PHASE_SECONDS)
+
+
+def record(view: str, stats: RequestStats, total: float) -> None:
+    REQUEST_SECONDS.observe((view,), total)
+    ES_QUERIES.observe((view,), stats.es_queries)
+    ES_SECONDS.observe((view,), stats.es_seconds)
+    ES_BYTES.inc((view, 'sent'), stats.es_sent)
+    ES_BYTES.inc((view, 'received'), stats.es_received)
+    for phase, seconds in stats.phases.items():
+        PHASE_SECONDS.observe((view, phase), seconds)
+
+
+_shared: dict[str, SharedSeries] = {}
+
+
+def shared_series(app: flask.Flask) -> SharedSeries | None:
+    '''Return the series shared by the workers of app, which share the
+    cache file if T_CACHE_BACKEND is "sqlite"'''
+    if app.config['T_CACHE_BACKEND'] != 'sqlite':
+        return None
+    path = app.config['T_CACHE_PATH']
+    if (shared := _shared.get(path)) is None:
+        shared = _shared.setdefault(path, SharedSeries(path))
+    return shared
+
+
+def render(shared: SharedSeries | None = None) -> str:
+    '''All metrics in the Prometheus text format
+
+    Those of every worker added up if shared, else those of this worker
+    labelled by its PID. Raises sqlite3.Error if shared cannot be read.
+    '''
+    if shared is not None:
+        shared.flush(METRICS, force=True)
+        series = shared.load(METRICS)
+        lines = (line for metric in METRICS for line in metric.render(series[metric.name]))
+    else:
+        pid = str(os.getpid())
+        lines = (line for metric in METRICS for line in metric.render(metric.snapshot(), pid))
+    return '\n'.join(lines) + '\n'
+
+
+def _before_render(sender, template, context, **extra) -> None:
+    if (stats := current()) is not None:
+        stats._render_start = time.perf_counter()
+
+
+def _rendered(sender, template, context, **extra) -> None:
+    if (stats := current()) is not None and stats._render_start is not None:
+        stats.add('render', time.perf_counter() - stats._render_start)
+        stats._render_start = None
+
+
+def init_app(app: flask.Flask) -> None:
+    '''Account requests to app when T_SERVER_TIMING or T_METRICS is set'''
+    flask.before_render_template.connect(_before_render, app)
+    flask.template_rendered.connect(_rendered, app)
+
+    @app.before_request
+    def start_stats():
+        if app.config['T_SERVER_TIMING'] or app.config['T_METRICS']:
+            flask.g.request_stats = RequestStats()
+
+    @app.after_request
+    def finish_stats(resp: flask.Response) -> flask.Response:
+        if (stats := flask.g.pop('request_stats', None)) is None:
+            return resp
+        total = time.perf_counter() - stats.start
+        if app.config['T_SERVER_TIMING']:
+            resp.headers['Server-Timing'] = stats.server_timing(total)
+        endpoint = flask.request.endpoint
+        if app.config['T_METRICS'] and endpoint not in (None, 'static', 'metrics'):
+            record(endpoint, stats, total)
+            if (shared := shared_series(app)) is not None:
+                try:
+                    shared.flush(METRICS)
+                except sqlite3.Error as e:
+                    app.logger.warning('Failed to share metrics: %s', e)
+        return resp
@@ -0,0 +1,64 @@
+'''
+Coalesce identical concurrent calls within a worker.
+
+When a link to a tweet is shared widely, many requests for it arrive at once.
+With SingleFlight, the first caller of a key makes the call, and callers of
+the same key arriving while it is in flight wait for it and share its result
+instead of each making their own.
+'''
+
+from __future__ import annotations
+
+import copy
+import threading
+from collections.abc import Callable
+from collections.abc import Hashable
+
+
+class _Call:
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    '''In-flight calls by key'''
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        # How many calls were saved, for benchmarks
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], object]):
+        '''Return fn(), or a copy of the result of the call of key in flight'''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            # Callers may modify what they get
+            return copy.deepcopy(call.result)
+        try:
+            result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        else:
+            call.result = result
+        finally:
+            with self._lock:
+                del self._calls[key]
+                waiters = call.waiters
+            call.done.set()
+        return copy.deepcopy(result) if waiters else result
@@ -0,0 +1,360 @@
+'''
+An embedded SQLite backend with FTS5 full-text search, for small archives that
+do not need an Elasticsearch cluster.
+
+Load an Elasticsearch dump (or the output of /tweet/export.ndjson) with:
+
+    python -m ash.sqlite load tweets.sqlite3 dump.ndjson
+
+and set T_BACKEND = 'sqlite' and T_SQLITE_PATH = 'tweets.sqlite3'.
+'''
+
+from __future__ import annotations
+
+import re
+import sys
+import json
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+from datetime import timezone
+from collections.abc import Mapping
+from collections.abc import Iterator
+from collections.abc import Iterable
+
+from . import hydrate
+from . import make_view
+from . import parse_created_at
+from . import encode_cursor
+from . import decode_cursor
+
+
+# Fields searched by keyword, as in TweetsDatabase._search_query
+FTS_FIELDS = ('text', 'full_text', 'content_text', 'spoiler_text', 'media_description')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tweets (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    idx TEXT NOT NULL,
+    screen_name TEXT,
+    timestamp REAL NOT NULL,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tweets_timestamp ON tweets (timestamp, rowid);
+CREATE INDEX IF NOT EXISTS tweets_screen_name ON tweets (screen_name, timestamp);
+CREATE INDEX IF NOT EXISTS tweets_idx ON tweets (idx, timestamp);
+CREATE VIRTUAL TABLE IF NOT EXISTS tweets_fts USING fts5 (
+    text, full_text, content_text, spoiler_text, media_description,
+    tokenize = '{tokenize}'
+);
+'''
+
+_connections = threading.local()
+
+
+def connect(path: str, readonly: bool = True) -> sqlite3.Connection:
+    '''Return a connection to path, reused within the thread'''
+    conns = _connections.__dict__
+    if (conn := conns.get((path, readonly))) is None:
+        if readonly:
+            conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        else:
+            conn = sqlite3.connect(path)
+        conns[(path, readonly)] = conn
+    return conn
+
+
+def fts_query(keyword: str) -> tuple[str | None, list[str]]:
+    '''Translate simple_query_string syntax into an FTS5 query
+
+    Supports terms (ANDed), "phrases", prefix*, | (OR) and -negation.
+    Returns the FTS5 query of the positive terms (None to match everything)
+    and the negated terms, each a FTS5 query of its own.
+    '''
+    positive = []
+    negative = []
+    for token in re.findall(r'-?"[^"]*"|\S+', keyword):
+        if token == '|':
+            if positive:
+                positive.append('OR')
+            continue
+        negate = token.startswith('-') and len(token) > 1
+        token = token.lstrip('-')
+        prefix = token.endswith('*') and not token.startswith('"')
+        token = token.strip('"').rstrip('*')
+        if not token:
+            continue
+        term = '"' + token.replace('"', '""') + '"' + ('*' if prefix else '')
+        if negate:
+            negative.append(term)
+        else:
+            if positive and positive[-1] != 'OR':
+                positive.append('AND')
+            positive.append(term)
+    if positive and positive[-1] == 'OR':
+        positive.pop()
+    return (' '.join(positive) or None), negative
+
+
+def _screen_name(source: dict) -> str | None:
+    if user := source.get('user'):
+        return user.get('screen_name')
+    if account := source.get('account'):
+        return account.get('fqn')
+    return None
+
+
+def _parse_date(date: str) -> float:
+    dt = datetime.fromisoformat(date)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def _timestamp(source: dict) -> float:
+    timestamp = source.get('@timestamp') or source['created_at']
+    return parse_created_at(timestamp).timestamp()
+
+
+class SQLiteTweetsDatabase(Mapping):
+    '''TweetsDatabase interface over a SQLite database made by load()'''
+
+    # Each thread queries over a connection of its own, e.g. the thread
+    # refreshing facets in the background (see FacetsCache)
+    thread_safe = True
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.name = path
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        return connect(self.path)
+
+    @staticmethod
+    def _rows_to_tweets(rows: Iterable[tuple], view: bool = True) -> Iterator[dict]:
+        for index, source in rows:
+            yield hydrate(json.loads(source), index, view)
+
+    def _where(self, *, keyword=None, user_screen_name=None, index=None, since=None, until=None) -> tuple[str, list]:
+        clauses = []
+        params = []
+        if keyword:
+            match, negative = fts_query(keyword)
+            if match:
+                clauses.append('rowid IN (SELECT rowid FROM tweets_fts WHERE tweets_fts MATCH ?)')
+                params.append(match)
+            for term in negative:
+                clauses.append('rowid NOT IN (SELECT rowid FROM tweets_fts WHERE tweets_fts MATCH ?)')
+                params.append(term)
+        if user_screen_name:
+            clauses.append('screen_name = ?')
+            params.append(user_screen_name)
+        if index:
+            # Index names may be comma-separated wildcards, as in Elasticsearch:
+            # only * is one, and case matters
+            patterns = [p.replace('[', '[[]').replace('?', '[?]') for p in index.split(',')]
+            clauses.append('(' + ' OR '.join('idx GLOB ?' for _ in patterns) + ')')
+            params.extend(patterns)
+        if since:
+            clauses.append('timestamp >= ?')
+            params.append(_parse_date(since))
+        if until:
+            clauses.append('timestamp < ?')
+            params.append(_parse_date(until))
+        return (' AND '.join(clauses) or '1'), params
+
+    def __getitem__(self, tweet_id: str | int) -> dict:
+        row = self.db.execute('SELECT idx, source FROM tweets WHERE id = ?', (str(tweet_id),)).fetchone()
+        if row is None:
+            raise KeyError(f'Tweet ID {tweet_id} not found')
+        return next(self._rows_to_tweets([row]))
+
+    def get_tweet_raw(self, tweet_id: int | str) -> dict:
+        row = self.db.execute('SELECT source FROM tweets WHERE id = ?', (str(tweet_id),)).fetchone()
+        if row is None:
+            raise KeyError(f'Tweet ID {tweet_id} not found')
+        source = json.loads(row[0])
+        source.pop('@view', None)
+        return source
+
+    def existing_ids(self, tweet_ids: Iterable[str | int]) -> set[str]:
+        tweet_ids = [str(tid) for tid in tweet_ids]
+        if not tweet_ids:
+            return set()
+        placeholders = ','.join('?' * len(tweet_ids))
+        rows = self.db.execute(f'SELECT id FROM tweets WHERE id IN ({placeholders})', tweet_ids)
+        return {row[0] for row in rows}
+
+    def __iter__(self) -> Iterator[str]:
+        for (tweet_id,) in self.db.execute('SELECT id FROM tweets ORDER BY timestamp, rowid'):
+            yield tweet_id
+
+    def __reversed__(self) -> Iterator[str]:
+        for (tweet_id,) in self.db.execute('SELECT id FROM tweets ORDER BY timestamp DESC, rowid DESC'):
+            yield tweet_id
+
+    def __len__(self) -> int:
+        return self.db.execute('SELECT count(*) FROM tweets').fetchone()[0]
+
+    def latest(self, size: int = 10, user_screen_name: str | None = None) -> tuple[int, list[dict]]:
+        where, params = self._where(user_screen_name=user_screen_name)
+        rows = self.db.execute(
+            f'SELECT idx, source FROM tweets WHERE {where} ORDER BY timestamp DESC, rowid DESC LIMIT ?',
+            params + [size],
+        )
+        return len(self), list(self._rows_to_tweets(rows))
+
+    def search(self, *, keyword=None, user_screen_name=None, index=None, limit=100) -> Iterator[dict]:
+        tweets, _ = self.search_page(keyword=keyword, user_screen_name=user_screen_name, index=index, limit=limit)
+        return iter(tweets)
+
+    def search_page(self, *, keyword=None, user_screen_name=None, index=None, cursor=None,
+                    limit=100, keep_alive=None, view=True) -> tuple[list[dict], str | None]:
+        where, params = self._where(keyword=keyword, user_screen_name=user_screen_name, index=index)
+        if cursor:
+            _, search_after = decode_cursor(cursor)
+            try:
+                timestamp, rowid = float(search_after[0]), int(search_after[1])
+            except (IndexError, TypeError, ValueError):
+                raise ValueError(f'Invalid cursor: {cursor}') from None
+            where += ' AND (timestamp, rowid) < (?, ?)'
+            params += [timestamp, rowid]
+        rows = self.db.execute(
+            f'SELECT idx, source, timestamp, rowid FROM tweets WHERE {where} '
+            'ORDER BY timestamp DESC, rowid DESC LIMIT ?',
+            params + [limit + 1],
+        ).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor('', [rows[-1][2], rows[-1][3]])
+        return list(self._rows_to_tweets((row[:2] for row in rows), view)), next_cursor
+
+    def export(self, *, user_screen_name=None, index=None, since=None, until=None) -> Iterator[dict]:
+        where, params = self._where(user_screen_name=user_screen_name, index=index, since=since, until=until)
+        # A cursor of its own, so that the rows are streamed
+        rows = connect(self.path).cursor().execute(
+            f'SELECT idx, id, source FROM tweets WHERE {where} ORDER BY timestamp, rowid', params,
+        )
+        for index_, tweet_id, source in rows:
+            source = json.loads(source)
+            source.pop('@view', None)
+            yield {
+                '_index': index_,
+                '_id': tweet_id,
+                '_source': source,
+            }
+
+    def get_users(self) -> Iterator[dict]:
+        # Top 10 of each, like the terms aggregations of TweetsDatabase
+        for pattern in ('NOT LIKE', 'LIKE'):
+            rows = self.db.execute(
+                f"SELECT screen_name, count(*) AS n FROM tweets WHERE screen_name {pattern} '%@%' "
+                'GROUP BY screen_name ORDER BY n DESC, screen_name LIMIT 10'
+            )
+            for screen_name, n in rows:
+                yield {
+                    'screen_name': screen_name,
+                    'tweets_count': n
+                }
+
+    def get_indexes(self) -> Iterator[dict]:
+        rows = self.db.execute('SELECT idx, count(*) AS n FROM tweets GROUP BY idx ORDER BY n DESC, idx LIMIT 10')
+        for name, n in rows:
+            yield {
+                'name': name,
+                'tweets_count': n
+            }
+
+    def get_facets(self) -> dict:
+        return {'users': list(self.get_users()), 'indexes': list(self.get_indexes()), 'generation': self.get_generation()}
+
+    def get_generation(self) -> tuple:
+        return tuple(self.db.execute('SELECT idx, count(*), max(rowid) FROM tweets GROUP BY idx ORDER BY idx'))
+
+
+def _fts_row(source: dict) -> tuple:
+    media = source.get('media_attachments') or []
+    return (
+        source.get('text'),
+        source.get('full_text'),
+        source.get('content_text'),
+        source.get('spoiler_text'),
+        ' '.join(m.get('description') or '' for m in media),
+    )
+
+
+def load(path: str, lines: Iterable[str], *, index: str | None = None,
+         tokenize: str = 'unicode61 remove_diacritics 2', batch_size: int = 1000) -> int:
+    '''Load documents into the database at path, replacing ones with the same ID
+
+    Each line is either an Elasticsearch hit ({"_index", "_id", "_source"}),
+    as dumped by Elasticsearch tools or /tweet/export.ndjson, or a bare
+    document, in which case index must be given.
+    '''
+    conn = connect(path, readonly=False)
+    conn.executescript(SCHEMA.format(tokenize=tokenize))
+    count = 0
+
+    def flush(batch):
+        with conn:
+            for doc_index, doc_id, source in batch:
+                source['@view'] = make_view(source)
+                row = conn.execute('SELECT rowid FROM tweets WHERE id = ?', (doc_id,)).fetchone()
+                if row:
+                    conn.execute('DELETE FROM tweets_fts WHERE rowid = ?', row)
+                    conn.execute('DELETE FROM tweets WHERE rowid = ?', row)
+                cur = conn.execute(
+                    'INSERT INTO tweets (id, idx, screen_name, timestamp, source) VALUES (?, ?, ?, ?, ?)',
+                    (doc_id, doc_index, _screen_name(source), _timestamp(source), json.dumps(source, ensure_ascii=False)),
+                )
+                conn.execute(
+                    f'INSERT INTO tweets_fts (rowid, {", ".join(FTS_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?)',
+                    (cur.lastrowid, *_fts_row(source)),
+                )
+
+    batch = []
+    for line in lines:
+        if not line.strip():
+            continue
+        doc = json.loads(line)
+        if '_source' in doc:
+            batch.append((doc.get('_index') or index, str(doc['_id']), doc['_source']))
+        elif index:
+            batch.append((index, str(doc['id']), doc))
+        else:
+            raise ValueError('Bare documents need an index name')
+        if len(batch) >= batch_size:
+            flush(batch)
+            count += len(batch)
+            batch = []
+    flush(batch)
+    count += len(batch)
+    with conn:
+        conn.execute("INSERT INTO tweets_fts (tweets_fts) VALUES ('optimize')")
+    return count
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Manage a SQLite database for T_BACKEND = "sqlite"')
+    sub = ap.add_subparsers(dest='command', required=True)
+    load_ap = sub.add_parser('load', help='load NDJSON documents')
+    load_ap.add_argument('db', help='path of the SQLite database')
+    load_ap.add_argument('files', nargs='*', help='NDJSON files to load (default: stdin)')
+    load_ap.add_argument('-i', '--index', help='index name of bare documents')
+    load_ap.add_argument('--tokenize', default='unicode61 remove_diacritics 2',
+                         help='FTS5 tokenizer of a new database, e.g. "trigram" for CJK text')
+    args = ap.parse_args()
+
+    files = [open(f) for f in args.files] or [sys.stdin]
+    for f in files:
+        with f:
+            count = load(args.db, f, index=args.index, tokenize=args.tokenize)
+            print(f'Loaded {count} documents from {f.name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import time
+import sqlite3
+
+import pytest
+
+from ash.cache import LRUCache
+from ash.cache import SQLiteCache
+from ash.cache import TieredCache
+
+
+class TestSQLiteCache:
+
+    def test_shared(self, tmp_path):
+        path = str(tmp_path / 'cache.sqlite3')
+        # As if in two workers
+        a = SQLiteCache(path, 'tweet-page')
+        b = SQLiteCache(path, 'tweet-page')
+        a[('20', 'html')] = (b'<html>', 'text/html', 'etag')
+        assert b.get(('20', 'html')) == (b'<html>', 'text/html', 'etag')
+        assert b.get('missing', 'default') == 'default'
+        assert b.pop(('20', 'html')) == (b'<html>', 'text/html', 'etag')
+        assert a.get(('20', 'html')) is None
+        assert a.bytes() == 0
+
+    def test_namespace_and_version(self, tmp_path):
+        path = str(tmp_path / 'cache.sqlite3')
+        pages = SQLiteCache(path, 'tweet-page', version=1)
+        facets = SQLiteCache(path, 'facets', version=1)
+        pages['k'] = 'page'
+        facets['k'] = 'facets'
+        assert SQLiteCache(path, 'tweet-page', version=2).get('k') is None
+        pages.clear()
+        assert pages.get('k') is None
+        assert facets.get('k') == 'facets'
+        assert len(facets) == 1
+
+    def test_eviction(self, tmp_path):
+        cache = SQLiteCache(str(tmp_path / 'cache.sqlite3'), 'ns', max_bytes=100_000, touch_interval=0)
+        cache[0] = b'x' * 1000
+        for i in range(1, 500):
+            cache[i] = b'x' * 1000
+            # Keep the first one in use
+            assert cache.get(0) is not None
+        assert cache.bytes() <= 100_000
+        assert cache.get(1) is None
+        assert cache.get(499) is not None
+        assert cache.get(0) is not None
+
+    def test_errors_degrade(self, tmp_path, monkeypatch):
+        cache = SQLiteCache(str(tmp_path / 'cache.sqlite3'), 'ns')
+        cache['k'] = 'v'
+
+        def broken():
+            raise sqlite3.OperationalError('database is locked')
+        monkeypatch.setattr(cache, '_connect', broken)
+        assert cache.get('k', 'default') == 'default'
+        cache['k'] = 'w'
+        assert cache.pop('k') is None
+        monkeypatch.undo()
+        assert cache.get('k') == 'v'
+
+    def test_unreadable_entries(self, tmp_path):
+        cache = SQLiteCache(str(tmp_path / 'cache.sqlite3'), 'ns')
+        cache['truncated'] = 'v' * 100
+        cache['moved'] = 'v'
+        conn = cache._connect()
+        conn.execute("UPDATE cache SET value = substr(value, 1, 10) WHERE key LIKE '%truncated'")
+        # Of a class that no longer exists
+        conn.execute(
+            "UPDATE cache SET value = ? WHERE key LIKE '%moved'",
+            (b'\x80\x02cash.cache\nGone\n)\x81.',),
+        )
+        for key in ('truncated', 'moved'):
+            assert cache.get(key, 'default') == 'default'
+        # Dropped, not read again
+        assert len(cache) == 0
+
+    def test_hit_while_locked(self, tmp_path):
+        path = str(tmp_path / 'cache.sqlite3')
+        cache = SQLiteCache(path, 'ns', touch_interval=0, timeout=0.5)
+        cache['k'] = 'v'
+        # Another worker in the middle of a write
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        try:
+            start = time.monotonic()
+            assert cache.get('k') == 'v'
+            assert time.monotonic() - start < 0.25
+            cache['k2'] = 'v2'
+        finally:
+            other.execute('ROLLBACK')
+            other.close()
+        assert cache.get('k2') is None
+        cache['k2'] = 'v2'
+        assert cache.get('k2') == 'v2'
+
+    def test_clear_while_locked(self, tmp_path):
+        path = str(tmp_path / 'cache.sqlite3')
+        cache = SQLiteCache(path, 'ns', timeout=0.1)
+        cache['k'] = 'v'
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        try:
+            cache.clear()
+        finally:
+            other.execute('ROLLBACK')
+            other.close()
+        cache.clear()
+        assert cache.get('k') is None
+
+    def test_unopenable(self, tmp_path):
+        # A directory where the file should be
+        with pytest.raises(sqlite3.Error):
+            SQLiteCache(str(tmp_path), 'ns')
+
+
+class TestTieredCache:
+
+    def test_tiers(self, tmp_path):
+        path = str(tmp_path / 'cache.sqlite3')
+        a = TieredCache(LRUCache(10), SQLiteCache(path, 'ns'))
+        b = TieredCache(LRUCache(10), SQLiteCache(path, 'ns'))
+        a['k'] = 'v'
+        assert b.local.get('k') is None
+        assert b.get('k') == 'v'
+        assert b.local.get('k') == 'v'
+        b.clear()
+        assert a.shared.get('k') is None
+
+
+class TestMakeCache:
+
+    def test_backends(self, client, tmp_path):
+        from ash import make_cache
+        config = client.application.config
+        assert isinstance(make_cache('ns', 10), LRUCache)
+        config['T_CACHE_BACKEND'] = 'sqlite'
+        config['T_CACHE_PATH'] = str(tmp_path / 'cache.sqlite3')
+        try:
+            assert isinstance(make_cache('ns', 10).shared, SQLiteCache)
+            # Cannot be opened: cached in this worker only
+            config['T_CACHE_PATH'] = str(tmp_path)
+            assert isinstance(make_cache('ns', 10), LRUCache)
+            config['T_CACHE_BACKEND'] = lambda namespace: {}
+            assert make_cache('ns', 10).shared == {}
+            config['T_CACHE_BACKEND'] = 'redis'
+            with pytest.raises(ValueError):
+                make_cache('ns', 10)
+        finally:
+            config['T_CACHE_BACKEND'] = 'memory'
@@ -0,0 +1,194 @@
+import json
+import time
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+import requests
+
+from ash.external import TokenError
+from ash.external import TweetsCache
+from ash.external import TwitterFetcher
+
+
+class StubTwitterAPI(BaseHTTPRequestHandler):
+    tweets = {
+        '20': {'id': 20, 'full_text': 'just setting up my twttr'},
+    }
+    # Tweet IDs answered with an error status
+    errors = {
+        '23': 420,
+    }
+    # Tweet IDs answered with a body that is not JSON
+    garbage = {'24'}
+    tokens_issued = 0
+    valid_token = 'token-1'
+    token_status = 200
+    requests = []
+
+    def do_POST(self):
+        cls = type(self)
+        cls.requests.append(self.path)
+        if cls.token_status != 200:
+            return self._reply(cls.token_status, {'errors': [{'code': 131}]})
+        cls.tokens_issued += 1
+        cls.valid_token = f'token-{cls.tokens_issued}'
+        self._reply(200, {'token_type': 'bearer', 'access_token': cls.valid_token})
+
+    def do_GET(self):
+        cls = type(self)
+        cls.requests.append(self.path)
+        if self.headers['Authorization'] != f'Bearer {cls.valid_token}':
+            return self._reply(401, {'errors': [{'code': 89}]})
+        tweet_id = parse_qs(urlsplit(self.path).query)['id'][0]
+        if status := cls.errors.get(tweet_id):
+            self._reply(status, {'errors': [{'code': 88}]})
+        elif tweet_id in cls.garbage:
+            self._reply(200, '<html>Over capacity</html>', raw=True)
+        elif tweet := cls.tweets.get(tweet_id):
+            self._reply(200, tweet)
+        else:
+            self._reply(404, {'errors': [{'code': 144}]})
+
+    def _reply(self, status, body, raw=False):
+        data = (body if raw else json.dumps(body)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api_base():
+    StubTwitterAPI.tokens_issued = 0
+    StubTwitterAPI.token_status = 200
+    StubTwitterAPI.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubTwitterAPI)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+@pytest.fixture
+def fetcher(api_base, tmp_path):
+    cache = TweetsCache(str(tmp_path / 'cache.sqlite3'), ttl=3600, negative_ttl=3600)
+    return TwitterFetcher('key', 'secret', api_base=api_base, cache=cache)
+
+
+class TestTwitterFetcher:
+
+    def test_token_is_lazy(self, fetcher):
+        assert StubTwitterAPI.requests == []
+        assert fetcher.fetch(20)['full_text'] == 'just setting up my twttr'
+        assert StubTwitterAPI.tokens_issued == 1
+
+    def test_cache(self, fetcher, tmp_path):
+        fetcher.fetch(20)
+        with pytest.raises(KeyError):
+            fetcher.fetch(21)
+        n_requests = len(StubTwitterAPI.requests)
+        # Both the hit and the miss are served from disk, also by other
+        # fetchers using the same cache file
+        other = TwitterFetcher('key', 'secret', api_base='http://127.0.0.1:1', cache=TweetsCache(
+            str(tmp_path / 'cache.sqlite3'), ttl=3600, negative_ttl=3600,
+        ))
+        for f in (fetcher, other):
+            assert f.fetch(20)['id'] == 20
+            with pytest.raises(KeyError):
+                f.fetch(21)
+        assert len(StubTwitterAPI.requests) == n_requests
+
+    def test_cache_errors(self, fetcher, monkeypatch):
+        def locked():
+            raise sqlite3.OperationalError('database is locked')
+        monkeypatch.setattr(fetcher.cache, '_connect', locked)
+        # Fetched as if there were no cache
+        assert fetcher.fetch(20)['id'] == 20
+        with pytest.raises(KeyError):
+            fetcher.fetch(21)
+        assert len(StubTwitterAPI.requests) == 3
+
+    def test_cache_expiry(self, tmp_path, monkeypatch):
+        cache = TweetsCache(str(tmp_path / 'cache.sqlite3'), ttl=100, negative_ttl=10)
+        now = time.time()
+        monkeypatch.setattr(time, 'time', lambda: now - 50)
+        cache.set('20', {'id': 20})
+        cache.set('21', None)
+        monkeypatch.setattr(time, 'time', lambda: now)
+        cache.set('22', {'id': 22})
+        rows = cache._connect().execute('SELECT id FROM tweets ORDER BY id').fetchall()
+        # The expired miss is gone, the hit that is still fresh stays
+        assert rows == [('20',), ('22',)]
+
+    def test_invalid_json(self, fetcher):
+        with pytest.raises(requests.HTTPError):
+            fetcher.fetch(24)
+
+    def test_token_refresh(self, fetcher, monkeypatch):
+        fetcher.fetch(20)
+        StubTwitterAPI.valid_token = 'rotated'
+        monkeypatch.setitem(StubTwitterAPI.tweets, '22', {'id': 22})
+        assert fetcher.fetch(22)['id'] == 22
+        assert StubTwitterAPI.tokens_issued == 2
+
+    def test_token_failure(self, fetcher, api_base):
+        StubTwitterAPI.token_status = 503
+        with pytest.raises(TokenError):
+            fetcher.fetch(20)
+
+    def test_token_failure_view(self, client, api_base):
+        StubTwitterAPI.token_status = 503
+        client.application.config.update({
+            'T_EXTERNAL_TWEETS': True,
+            'T_TWITTER_KEY': 'key',
+            'T_TWITTER_SECRET': 'secret',
+            'T_TWITTER_API': api_base,
+            'T_EXTERNAL_TWEETS_CACHE': None,
+        })
+        try:
+            resp = client.get('/tweet/20.json')
+            assert resp.status_code == 502
+        finally:
+            client.application.config['T_EXTERNAL_TWEETS'] = False
+
+    @pytest.mark.parametrize('tweet_id', ['23', '24'])
+    def test_upstream_error_view(self, client, api_base, tweet_id):
+        client.application.config.update({
+            'T_EXTERNAL_TWEETS': True,
+            'T_TWITTER_KEY': 'key',
+            'T_TWITTER_SECRET': 'secret',
+            'T_TWITTER_API': api_base,
+            'T_EXTERNAL_TWEETS_CACHE': None,
+        })
+        try:
+            resp = client.get(f'/tweet/{tweet_id}.json')
+            assert resp.status_code == 502
+        finally:
+            client.application.config['T_EXTERNAL_TWEETS'] = False
+
+    def test_fetched_page_not_cached(self, client, api_base):
+        client.application.config.update({
+            'T_EXTERNAL_TWEETS': True,
+            'T_TWITTER_KEY': 'key',
+            'T_TWITTER_SECRET': 'secret',
+            'T_TWITTER_API': api_base,
+            'T_EXTERNAL_TWEETS_CACHE': None,
+        })
+        try:
+            resp = client.get('/tweet/20.json')
+            assert resp.status_code == 200
+            assert 'no-cache' in resp.headers['Cache-Control']
+            assert 'max-age' not in resp.headers['Cache-Control']
+            client.get('/tweet/20.json')
+            # Fetched again rather than served from the page cache
+            assert StubTwitterAPI.requests.count(StubTwitterAPI.requests[-1]) == 2
+        finally:
+            client.application.config['T_EXTERNAL_TWEETS'] = False
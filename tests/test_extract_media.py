@@ -0,0 +1,86 @@
+import os
+import time
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def media_store():
+    # What main.py crawls with, without Scrapy
+    path = Path(__file__).parent.parent / 'contrib/extract_media/media_store.py'
+    spec = importlib.util.spec_from_file_location('media_store', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def manifest(media_store, tmp_path):
+    return media_store.Manifest(tmp_path / 'manifest.sqlite3')
+
+
+class TestManifest:
+    urls = ['https://pbs.twimg.com/media/a.jpg', 'https://video.twimg.com/v.mp4?tag=12']
+
+    def test_urls_in_file(self, media_store, tmp_path):
+        js = tmp_path / 'tweets.js'
+        js.write_text('window.YTD.tweets.part0 = [{"media_url_https": "%s", "variants": [{"url": "%s"}]}]' % tuple(self.urls))
+        assert media_store.urls_in_file(js) == self.urls
+
+    def test_resume(self, media_store, manifest, tmp_path):
+        js = tmp_path / 'tweets.js'
+        js.write_text('[]')
+        assert not manifest.is_read(js)
+        assert manifest.add(js, self.urls) == 2
+        assert manifest.is_read(js)
+        # Known URLs are not added again
+        assert manifest.add(js, self.urls[:1]) == 0
+        manifest.mark(self.urls[0], 'downloaded')
+        manifest.mark(self.urls[1], 'failed', 'timeout')
+        assert manifest.pending() == []
+        assert manifest.pending(retry_failed=True) == self.urls[1:]
+        assert manifest.counts() == {'downloaded': 1, 'failed': 1}
+        # Read again once changed, also by another run
+        js.write_text('[{}]')
+        assert not media_store.Manifest(tmp_path / 'manifest.sqlite3').is_read(js)
+
+
+class TestMediaStore:
+
+    def test_dedup(self, media_store, manifest, tmp_path):
+        store = media_store.MediaStore(manifest)
+        src = tmp_path / 'archive/tweets_media/1-a.jpg'
+        src.parent.mkdir(parents=True)
+        src.write_bytes(b'jpeg')
+        out = tmp_path / 'out'
+        store.add_file(src, out / 'pbs.twimg.com/media/a.jpg')
+        # Same bytes under another name: linked to what is stored
+        store.add_bytes(b'jpeg', out / 'pbs.twimg.com/media/b.jpg')
+        store.add_bytes(b'png', out / 'pbs.twimg.com/media/c.png')
+        a, b, c = (os.stat(out / 'pbs.twimg.com/media' / name) for name in ('a.jpg', 'b.jpg', 'c.png'))
+        assert a.st_ino == b.st_ino == os.stat(src).st_ino
+        assert c.st_ino != a.st_ino
+        assert (out / 'pbs.twimg.com/media/c.png').read_bytes() == b'png'
+        assert sorted(p.name for p in (out / 'pbs.twimg.com/media').iterdir()) == ['a.jpg', 'b.jpg', 'c.png']
+
+    def test_same_dest_at_once(self, media_store, tmp_path, monkeypatch):
+        # Like video variants differing only by query string, with time for
+        # other threads to get in between linking and renaming
+        link = os.link
+
+        def slow_link(src, dst):
+            link(src, dst)
+            time.sleep(0.01)
+        monkeypatch.setattr(media_store.os, 'link', slow_link)
+        srcs = []
+        for n in range(8):
+            srcs.append(tmp_path / f'src-{n}')
+            srcs[-1].write_bytes(b'video')
+        dest = tmp_path / 'out/video.twimg.com/v.mp4'
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(lambda src: media_store.link_or_copy(src, dest), srcs * 4))
+        assert dest.read_bytes() == b'video'
+        assert [p.name for p in dest.parent.iterdir()] == ['v.mp4']
@@ -0,0 +1,126 @@
+import json
+import random
+import importlib.util
+from pathlib import Path
+
+import pytest
+from elasticsearch import Elasticsearch
+
+
+@pytest.fixture(scope='module')
+def script():
+    path = Path(__file__).parent.parent / 'contrib/fix_created_at/main.py'
+    spec = importlib.util.spec_from_file_location('fix_created_at', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# An archive from before mid-2013, with correct timestamps
+OLD_JS = '''Grailbird.data.tweets_2009_06 =
+ [ {
+  "source" : "web",
+  "id" : 2001,
+  "created_at" : "Mon Jun 29 15:46:31 +0000 2009",
+  "text" : "first"
+}, {
+  "source" : "web",
+  "id" : 2002,
+  "created_at" : "Tue Jun 30 08:01:02 +0000 2009",
+  "text" : "second"
+} ]'''
+
+# The same tweets in a later archive: the first at midnight of its day, the
+# second correct already. Users are not top-level and left alone.
+NEW_JS = '''Grailbird.data.tweets_2009_06 =
+ [ {
+  "source" : "web",
+  "id" : 2001,
+  "created_at" : "2009-06-29 00:00:00 +0000",
+  "user" : {
+    "id" : 1,
+    "created_at" : "2009-06-01 00:00:00 +0000"
+  },
+  "text" : "first"
+}, {
+  "source" : "web",
+  "id" : 2002,
+  "created_at" : "2009-06-30 08:01:02 +0000",
+  "text" : "second"
+} ]'''
+
+
+@pytest.fixture
+def archives(tmp_path):
+    old = tmp_path / 'old/js/tweets/2009_06.js'
+    new = tmp_path / 'new/js/tweets/2009_06.js'
+    for path, content in ((old, OLD_JS), (new, NEW_JS)):
+        path.parent.mkdir(parents=True)
+        path.write_text(content)
+    return old, new
+
+
+class TestFixCreatedAt:
+
+    def test_index(self, script, archives):
+        index = script.CreatedAtIndex.from_files([str(archives[0])])
+        assert len(index) == 2
+        assert index.get(2001) == 1246290391
+        assert index.get(2003) is None
+
+    def test_index_order(self, script):
+        pairs = [(tweet_id, tweet_id * 10) for tweet_id in random.Random(0).sample(range(10**6), 1000)]
+        index = script.CreatedAtIndex(pairs)
+        assert list(index.ids) == sorted(index.ids)
+        assert all(index.get(tweet_id) == epoch for tweet_id, epoch in pairs)
+
+    def test_fix_file(self, script, archives):
+        old, new = archives
+        index = script.CreatedAtIndex.from_files([str(old)])
+        assert script.fix_file(str(new), index, dry_run=True) == 1
+        assert new.read_text() == NEW_JS
+        assert script.fix_file(str(new), index) == 1
+        # Patched in place, nothing else touched
+        assert new.read_text() == NEW_JS.replace(
+            '"created_at" : "2009-06-29 00:00:00 +0000"', '"created_at" : "2009-06-29 15:46:31 +0000"', 1)
+        patched = new.read_bytes()
+        assert script.fix_file(str(new), index) == 0
+        assert new.read_bytes() == patched
+
+    def test_unknown_tweet(self, script, archives):
+        index = script.CreatedAtIndex([])
+        with pytest.raises(ValueError):
+            script.fix_file(str(archives[1]), index)
+
+    def test_id_of_same_tweet(self, script, archives):
+        old, new = archives
+        index = script.CreatedAtIndex.from_files([str(old)])
+        # However far the ID is from created_at
+        long_js = NEW_JS.replace('"source" : "web",\n  "id" : 2001,', '"id" : 2001,\n  "source" : "%s",' % ('x' * 1000))
+        new.write_text(long_js)
+        assert script.fix_file(str(new), index) == 1
+        # Not the ID of the previous tweet
+        new.write_text(NEW_JS.replace(
+            '"id" : 2002,\n  "created_at" : "2009-06-30 08:01:02 +0000"', '"created_at" : "2009-06-30 00:00:00 +0000"'))
+        with pytest.raises(ValueError):
+            script.fix_file(str(new), index)
+
+    def test_fix_es(self, script, archives, es_host):
+        es = Elasticsearch(es_host)
+        index_name = 'pytest-fix-created-at'
+        tweets = json.loads(NEW_JS[NEW_JS.index('['):])
+        tweets[0]['@timestamp'] = '2009-06-29T00:00:00+00:00'
+        tweets[1]['@timestamp'] = '2009-06-30T08:01:02+00:00'
+        for tweet in tweets:
+            es.index(index=index_name, id=tweet['id'], document=tweet)
+        es.indices.refresh(index=index_name)
+        try:
+            index = script.CreatedAtIndex.from_files([str(archives[0])])
+            assert script.fix_es(es_host, index_name, index, dry_run=True) == 1
+            assert script.fix_es(es_host, index_name, index) == 1
+            fixed = es.get(index=index_name, id='2001')['_source']
+            assert fixed['created_at'] == '2009-06-29 15:46:31 +0000'
+            assert fixed['@timestamp'] == '2009-06-29T15:46:31+00:00'
+            assert script.fix_es(es_host, index_name, index) == 0
+        finally:
+            es.indices.delete(index=index_name)
@@ -0,0 +1,81 @@
+import io
+import json
+
+from elasticsearch import Elasticsearch
+
+from ash.ingest import ingest
+from ash.ingest import iter_json_array
+from ash.ingest import activity_to_toot
+
+
+class TestIterJsonArray:
+
+    def test_archive_js(self):
+        items = [{'tweet': {'id': str(i), 'full_text': 'a ] b [ "c" }'}} for i in range(50)]
+        f = io.StringIO('window.YTD.tweets.part0 = ' + json.dumps(items, indent=2))
+        # A tiny chunk size makes objects span many reads
+        assert list(iter_json_array(f, chunk_size=7)) == items
+
+    def test_marker(self):
+        outbox = {'@context': ['a', 'b'], 'orderedItems': [{'type': 'Create'}]}
+        f = io.StringIO(json.dumps(outbox))
+        assert list(iter_json_array(f, marker='"orderedItems"')) == [{'type': 'Create'}]
+
+
+class TestActivityToToot:
+    actor = {
+        'id': 'https://example.social/users/me',
+        'preferredUsername': 'me',
+        'name': 'Me',
+        'icon': {'url': 'https://example.social/avatar.png'},
+    }
+
+    def test_create(self):
+        activity = {
+            'type': 'Create',
+            'object': {
+                'id': 'https://example.social/users/me/statuses/2',
+                'published': '2023-01-17T19:06:46Z',
+                'content': '<p>Hello &amp; bye</p>',
+                'inReplyTo': 'https://example.social/users/me/statuses/1',
+                'attachment': [{'mediaType': 'image/png', 'url': '/a.png', 'name': 'alt'}],
+            },
+        }
+        toot = activity_to_toot(activity, self.actor)
+        assert toot['id'] == '2'
+        assert toot['content_text'] == 'Hello & bye'
+        assert toot['account']['fqn'] == 'me@example.social'
+        assert toot['in_reply_to_id'] == '1'
+        assert toot['in_reply_to_account_id'] == toot['account']['id']
+        assert toot['media_attachments'] == [{'type': 'image', 'url': '/a.png', 'description': 'alt'}]
+
+    def test_announce(self):
+        assert activity_to_toot({'type': 'Announce', 'object': 'https://x/1'}, self.actor) is None
+
+
+class TestIngest:
+
+    def test_ingest(self, es_host, tmp_path):
+        (tmp_path / 'data').mkdir()
+        tweets = [
+            {'tweet': {'id': str(i), 'full_text': f'tweet {i}', 'created_at': 'Mon Jun 29 15:46:31 +0000 2009'}}
+            for i in range(10)
+        ]
+        (tmp_path / 'data/tweets.js').write_text('window.YTD.tweets.part0 = ' + json.dumps(tweets))
+        account = [{'account': {'accountId': '1', 'username': 'me', 'accountDisplayName': 'Me'}}]
+        (tmp_path / 'data/account.js').write_text('window.YTD.account.part0 = ' + json.dumps(account))
+        es = Elasticsearch(es_host)
+        index = f'pytest-ingest-{tmp_path.name}'.lower()
+        checkpoint = tmp_path / 'checkpoint.json'
+        try:
+            assert ingest(es, [tmp_path], tweets_index=index, chunk_size=3, checkpoint=checkpoint, log=print) == 10
+            assert es.count(index=index)['count'] == 10
+            source = es.get(index=index, id='3')['_source']
+            assert source['user']['screen_name'] == 'me'
+            assert source['@view']['text_html'] == 'tweet 3'
+            # Resuming from the checkpoint sends nothing
+            assert ingest(es, [tmp_path], tweets_index=index, chunk_size=3, checkpoint=checkpoint, log=print) == 0
+            settings = es.indices.get_settings(index=index, flat_settings=True)[index]['settings']
+            assert settings.get('index.refresh_interval') != '-1'
+        finally:
+            es.indices.delete(index=index, ignore_unavailable=True)
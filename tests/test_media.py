@@ -0,0 +1,172 @@
+import os
+
+import pytest
+
+from ash.media import MediaIndex
+from ash.media import MediaResolver
+
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'')
+
+
+class TestMediaIndex:
+
+    def test_incremental_refresh(self, tmp_path):
+        touch(tmp_path / 'pbs.twimg.com/media/a.jpg')
+        index = MediaIndex(str(tmp_path))
+        assert 'pbs.twimg.com/media/a.jpg' in index
+        assert 'pbs.twimg.com/media/b.jpg' not in index
+        assert not index.refresh()
+
+        touch(tmp_path / 'pbs.twimg.com/media/b.jpg')
+        touch(tmp_path / 'video.twimg.com/ext_tw_video/1/pu/vid/720x1280/c.mp4')
+        # Bump mtimes past filesystem timestamp granularity
+        for d in ('pbs.twimg.com/media', ''):
+            os.utime(tmp_path / d, ns=(0, os.stat(tmp_path / d).st_mtime_ns + 10**9))
+        assert index.refresh()
+        assert 'pbs.twimg.com/media/b.jpg' in index
+        assert 'video.twimg.com/ext_tw_video/1/pu/vid/720x1280/c.mp4' in index
+        assert len(index) == 3
+
+    def test_manifest(self, tmp_path):
+        touch(tmp_path / 'media/pbs.twimg.com/media/a.jpg')
+        manifest = str(tmp_path / 'manifest.json')
+        MediaIndex(str(tmp_path / 'media'), manifest)
+        index = MediaIndex(str(tmp_path / 'media'), manifest)
+        # Loaded from the manifest, with nothing changed since
+        assert index.generation == 0
+        assert 'pbs.twimg.com/media/a.jpg' in index
+
+    def test_bad_manifest(self, tmp_path):
+        touch(tmp_path / 'media/pbs.twimg.com/media/a.jpg')
+        (tmp_path / 'manifest.json').write_text('{')
+        index = MediaIndex(str(tmp_path / 'media'), str(tmp_path / 'manifest.json'))
+        assert 'pbs.twimg.com/media/a.jpg' in index
+        # Nowhere to save it to
+        index = MediaIndex(str(tmp_path / 'media'), str(tmp_path / 'missing/manifest.json'))
+        assert 'pbs.twimg.com/media/a.jpg' in index
+
+
+class TestMediaResolver:
+    mirrors = {'pbs.twimg.com': 'mirror.example.com/pbs.twimg.com'}
+
+    def test_chain(self, tmp_path):
+        touch(tmp_path / 'media/pbs.twimg.com/media/local.jpg')
+        (tmp_path / 'mirrored.txt').write_text('https://pbs.twimg.com/media/mirrored.jpg\n')
+        resolver = MediaResolver(
+            ('filesystem', 'mirror', 'direct'),
+            mirrors=self.mirrors,
+            fs_path=str(tmp_path / 'media'),
+            mirror_manifest=str(tmp_path / 'mirrored.txt'),
+        )
+        assert resolver.resolve('https://pbs.twimg.com/media/local.jpg') == (
+            'filesystem', 'pbs.twimg.com/media/local.jpg')
+        assert resolver.resolve('https://pbs.twimg.com/media/mirrored.jpg') == (
+            'mirror', 'https://mirror.example.com/pbs.twimg.com/media/mirrored.jpg')
+        assert resolver.resolve('https://pbs.twimg.com/media/gone.jpg') == (
+            'direct', 'https://pbs.twimg.com/media/gone.jpg')
+
+    def test_missing_mirror_manifest(self, tmp_path):
+        resolver = MediaResolver(
+            ('mirror', 'direct'),
+            mirrors=self.mirrors,
+            mirror_manifest=str(tmp_path / 'missing.txt'),
+        )
+        assert resolver.resolve('https://pbs.twimg.com/media/a.jpg')[0] == 'direct'
+        resolver.refresh()
+        (tmp_path / 'missing.txt').write_text('https://pbs.twimg.com/media/a.jpg\n')
+        resolver.refresh()
+        assert resolver.resolve('https://pbs.twimg.com/media/a.jpg')[0] == 'mirror'
+
+    def test_last_source_is_unconditional(self, tmp_path):
+        resolver = MediaResolver('filesystem', fs_path=str(tmp_path))
+        assert resolver.resolve('https://pbs.twimg.com/media/a.jpg') == ('filesystem', 'pbs.twimg.com/media/a.jpg')
+        resolver = MediaResolver(('filesystem', 'mirror'), mirrors=self.mirrors, fs_path=str(tmp_path))
+        assert resolver.resolve('https://pbs.twimg.com/media/a.jpg')[0] == 'mirror'
+
+
+class TestMediaServing:
+    path = 'pbs.twimg.com/media/a.jpg'
+
+    def setup_media(self, client, tmp_path):
+        (tmp_path / 'pbs.twimg.com/media').mkdir(parents=True)
+        (tmp_path / self.path).write_bytes(b'0123456789')
+        client.application.config['T_MEDIA_FS_PATH'] = str(tmp_path)
+        client.application.config['T_MEDIA_CACHE_PATH'] = str(tmp_path / 'cache')
+
+    def test_cache_headers_and_range(self, client, tmp_path):
+        self.setup_media(client, tmp_path)
+        resp = client.get(f'/tweet/media/{self.path}')
+        assert resp.data == b'0123456789'
+        assert 'immutable' in resp.headers['Cache-Control']
+        resp = client.get(f'/tweet/media/{self.path}', headers={'Range': 'bytes=2-4'})
+        assert resp.status_code == 206
+        assert resp.data == b'234'
+
+    def test_relative_fs_path(self, client, tmp_path, monkeypatch):
+        from ash import replace_media_url
+        self.setup_media(client, tmp_path)
+        elsewhere = tmp_path / 'a/b/c/d/e/f'
+        elsewhere.mkdir(parents=True)
+        monkeypatch.chdir(elsewhere)
+        # Relative to the app, for the index as for serving
+        client.application.config['T_MEDIA_FS_PATH'] = os.path.relpath(tmp_path, client.application.root_path)
+        client.application.config['T_MEDIA_FROM'] = ('filesystem', 'direct')
+        try:
+            with client.application.test_request_context():
+                assert replace_media_url(f'https://{self.path}') == f'/tweet/media/{self.path}'
+            assert client.get(f'/tweet/media/{self.path}').data == b'0123456789'
+        finally:
+            client.application.config['T_MEDIA_FROM'] = 'direct'
+
+    def test_accel_redirect(self, client, tmp_path):
+        self.setup_media(client, tmp_path)
+        client.application.config['T_MEDIA_OFFLOAD'] = 'x-accel-redirect'
+        try:
+            resp = client.get(f'/tweet/media/{self.path}')
+            assert resp.headers['X-Accel-Redirect'] == f'/_media/{self.path}'
+            assert resp.data == b''
+            assert client.get('/tweet/media/../secret').status_code == 404
+        finally:
+            client.application.config['T_MEDIA_OFFLOAD'] = None
+
+    def test_derivative_falls_back_to_original(self, client, tmp_path):
+        # Not an image, so there is no thumbnail of it
+        self.setup_media(client, tmp_path)
+        client.application.config['T_MEDIA_DERIVATIVES'] = True
+        try:
+            resp = client.get(f'/tweet/derivative/thumb/{self.path}')
+            assert resp.data == b'0123456789'
+            # Not for good, as the thumbnail may be made later
+            assert 'immutable' not in resp.headers['Cache-Control']
+            assert 'no-cache' in resp.headers['Cache-Control']
+        finally:
+            client.application.config['T_MEDIA_DERIVATIVES'] = False
+
+    def test_thumbnail(self, tmp_path):
+        Image = pytest.importorskip('PIL.Image')
+        from ash.derivatives import DerivativeCache
+        (tmp_path / 'media').mkdir()
+        Image.new('RGB', (2000, 1000)).save(tmp_path / 'media/a.jpg')
+        cache = DerivativeCache(str(tmp_path / 'media'), str(tmp_path / 'cache'))
+        name = cache.get('thumb', 'a.jpg')
+        with Image.open(tmp_path / 'cache' / name) as im:
+            assert (im.format, im.size) == ('WEBP', (960, 480))
+        assert cache.get('thumb', 'a.jpg') == name
+        assert cache.get('thumb', '../media/b.jpg') is None
+
+    def test_thumbnail_of_bad_image(self, tmp_path, monkeypatch):
+        Image = pytest.importorskip('PIL.Image')
+        from ash.derivatives import DerivativeCache
+        (tmp_path / 'media').mkdir()
+        Image.new('RGB', (2000, 1000)).save(tmp_path / 'media/a.jpg')
+        jpeg = (tmp_path / 'media/a.jpg').read_bytes()
+        (tmp_path / 'media/truncated.jpg').write_bytes(jpeg[:len(jpeg) // 2])
+        cache = DerivativeCache(str(tmp_path / 'media'), str(tmp_path / 'cache'))
+        assert cache.get('thumb', 'truncated.jpg') is None
+        # Far more pixels than allowed
+        monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000)
+        assert cache.get('thumb', 'a.jpg') is None
+        assert not any(p.is_file() for p in (tmp_path / 'cache').rglob('*'))
@@ -0,0 +1,94 @@
+import os
+import re
+
+from ash import metrics
+
+
+class TestMetrics:
+
+    def test_server_timing(self, client):
+        client.application.config['T_SERVER_TIMING'] = True
+        try:
+            resp = client.get('/tweet/')
+        finally:
+            client.application.config['T_SERVER_TIMING'] = False
+        timing = resp.headers['Server-Timing']
+        assert timing.startswith('es;dur=')
+        assert re.search(r'desc="[1-9]\d* queries, [1-9]\d* bytes"', timing)
+        assert 'render;dur=' in timing
+        assert 'text;dur=' in timing
+        assert 'Server-Timing' not in client.get('/tweet/').headers
+
+    def test_metrics_endpoint(self, client):
+        assert client.get('/metrics').status_code == 404
+        client.application.config['T_METRICS'] = True
+        try:
+            client.get('/tweet/')
+            client.get('/tweet/search.json', query_string={'q': '*'})
+            resp = client.get('/metrics')
+        finally:
+            client.application.config['T_METRICS'] = False
+        assert resp.status_code == 200
+        assert resp.content_type.startswith('text/plain')
+        lines = resp.text.splitlines()
+        assert '# TYPE ash_request_duration_seconds histogram' in lines
+        # Per worker: labelled by PID
+        pid = f'pid="{os.getpid()}"'
+        assert any(line.startswith(f'ash_es_queries_bucket{{view="index",{pid},le="1"}} ') for line in lines)
+        assert any(line.startswith(f'ash_request_duration_seconds_count{{view="search_tweet",{pid}}} ')
+                   for line in lines)
+        assert any(line.startswith(f'ash_phase_duration_seconds_count{{view="index",phase="render",{pid}}} ')
+                   for line in lines)
+        assert not any('view="metrics"' in line for line in lines)
+
+    def test_shared_endpoint(self, client, tmp_path):
+        config = client.application.config
+        config.update({'T_METRICS': True, 'T_CACHE_BACKEND': 'sqlite', 'T_CACHE_PATH': str(tmp_path / 'cache.sqlite3')})
+        try:
+            client.get('/tweet/')
+            resp = client.get('/metrics')
+            assert resp.status_code == 200
+            assert 'pid=' not in resp.text
+            assert any(line.startswith('ash_request_duration_seconds_count{view="index"} ')
+                       for line in resp.text.splitlines())
+            # Unreadable: no scrape rather than wrong totals
+            config['T_CACHE_PATH'] = str(tmp_path)
+            assert client.get('/metrics').status_code == 503
+        finally:
+            config.update({'T_METRICS': False, 'T_CACHE_BACKEND': 'memory'})
+
+
+class TestSharedSeries:
+
+    def test_workers_add_up(self, tmp_path):
+        path = str(tmp_path / 'cache.sqlite3')
+        hist = metrics.Histogram('ash_test_seconds', 'Test', ('view',), (1, 2))
+        a, b = metrics.SharedSeries(path), metrics.SharedSeries(path)
+        # As if in two workers
+        a._worker = (os.getpid(), 'a')
+        b._worker = (os.getpid(), 'b')
+        hist.observe(('index',), 0.5)
+        a.flush([hist], force=True)
+        hist.observe(('index',), 1.5)
+        b.flush([hist], force=True)
+        # a: 1 observation, b: 2
+        assert a.load([hist])['ash_test_seconds'] == {('index',): [2, 3, 2.5, 3]}
+        # Not again within the interval, unless forced
+        hist.observe(('index',), 3)
+        b.flush([hist])
+        assert a.load([hist])['ash_test_seconds'][('index',)][-1] == 3
+        b.flush([hist], force=True)
+        assert a.load([hist])['ash_test_seconds'][('index',)][-1] == 4
+
+    def test_worker_restarted(self, tmp_path):
+        path = str(tmp_path / 'cache.sqlite3')
+        counter = metrics.Counter('ash_test_total', 'Test', ('view',))
+        shared = metrics.SharedSeries(path)
+        counter.inc(('index',), 5)
+        shared.flush([counter], force=True)
+        # Same PID in a new process: totals of the old one stay
+        shared._worker = (-1, 'gone')
+        counter.series.clear()
+        counter.inc(('index',), 1)
+        shared.flush([counter], force=True)
+        assert shared.load([counter])['ash_test_total'] == {('index',): [6]}
@@ -0,0 +1,70 @@
+import time
+import threading
+
+import pytest
+
+from ash.singleflight import SingleFlight
+
+
+def run_concurrently(sf, n, fn):
+    '''Call sf.do('key', fn) from n threads, the first one first'''
+    results = [None] * n
+    errors = [None] * n
+
+    def call(i):
+        try:
+            results[i] = sf.do('key', fn)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+    threads[0].start()
+    while 'key' not in sf._calls:
+        time.sleep(0.001)
+    for t in threads[1:]:
+        t.start()
+    while sf._calls['key'].waiters < n - 1:
+        time.sleep(0.001)
+    return threads, results, errors
+
+
+class TestSingleFlight:
+
+    def test_coalesce(self):
+        sf = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait()
+            return {'id': 1}
+
+        threads, results, errors = run_concurrently(sf, 5, fn)
+        release.set()
+        for t in threads:
+            t.join()
+        assert len(calls) == 1
+        assert sf.coalesced == 4
+        assert results == [{'id': 1}] * 5
+        # Each caller has its own copy
+        assert len({id(r) for r in results}) == 5
+        # Nothing in flight, so the next call is made again
+        assert sf.do('key', fn) == {'id': 1}
+        assert len(calls) == 2
+
+    def test_error(self):
+        sf = SingleFlight()
+        release = threading.Event()
+
+        def fn():
+            release.wait()
+            raise KeyError('not found')
+
+        threads, results, errors = run_concurrently(sf, 3, fn)
+        release.set()
+        for t in threads:
+            t.join()
+        assert all(isinstance(e, KeyError) for e in errors)
+        with pytest.raises(KeyError):
+            sf.do('key', fn)
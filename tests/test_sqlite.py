@@ -0,0 +1,111 @@
+import os
+import json
+import time
+from pathlib import Path
+
+import pytest
+
+from ash.sqlite import load
+from ash.sqlite import fts_query
+from ash.sqlite import SQLiteTweetsDatabase
+
+
+@pytest.fixture(scope='module')
+def sqlite_path(tmp_path_factory) -> str:
+    path = str(tmp_path_factory.mktemp('sqlite') / 'tweets.sqlite3')
+    here = Path(os.path.abspath(__file__)).parent
+    lines = []
+    for tweet_file in sorted((here / 'fixtures').glob('*.json')):
+        tweet = json.loads(tweet_file.read_text())
+        lines.append(json.dumps({'_index': 'tweets-pytest', '_id': tweet['id'], '_source': tweet}))
+    load(path, lines)
+    return path
+
+
+@pytest.fixture
+def sqlite_client(sqlite_path):
+    os.environ['TESTING'] = 'True'
+    from ash import app
+    app.config.update({
+        'TESTING': True,
+        'T_BACKEND': 'sqlite',
+        'T_SQLITE_PATH': sqlite_path,
+    })
+    yield app.test_client()
+    app.config['T_BACKEND'] = 'elasticsearch'
+
+
+class TestSQLiteTweetsDatabase:
+
+    def test_mapping(self, sqlite_path):
+        tdb = SQLiteTweetsDatabase(sqlite_path)
+        assert len(tdb) == 3
+        assert tdb['1615425412921987074']['@index'] == 'tweets-pytest'
+        assert list(reversed(tdb))[0] == '1676023376631197696'
+        with pytest.raises(KeyError):
+            tdb['1']
+
+    def test_search(self, sqlite_path):
+        tdb = SQLiteTweetsDatabase(sqlite_path)
+        assert len(list(tdb.search(keyword='*'))) == 3
+        assert len(list(tdb.search(keyword='keyboard'))) == 1
+        assert len(list(tdb.search(keyword='keyboard -please'))) == 0
+        assert len(list(tdb.search(keyword='*', user_screen_name='wzyboy'))) == 1
+        assert len(list(tdb.search(keyword='*', index='tweets-*'))) == 3
+        assert len(list(tdb.search(keyword='*', index='toots-*,tweets-pytest'))) == 3
+        for index in ('tweets_pytest', 'TWEETS-pytest', 'tweets-?ytest', 'tweets%'):
+            assert len(list(tdb.search(keyword='*', index=index))) == 0
+        tweets, cursor = tdb.search_page(keyword='*', limit=2)
+        assert len(tweets) == 2
+        tweets, cursor = tdb.search_page(keyword='*', limit=2, cursor=cursor)
+        assert len(tweets) == 1
+        assert cursor is None
+
+    def test_facets_refresh(self, sqlite_path):
+        from ash import FacetsCache
+        facets_cache = FacetsCache()
+        tdb = SQLiteTweetsDatabase(sqlite_path)
+        entry = facets_cache.get(tdb, ttl=300)
+        # Expired: refreshed in a background thread, over its own connection
+        assert facets_cache.get(tdb, ttl=0) is entry
+        for _ in range(100):
+            if not facets_cache._refreshing:
+                break
+            time.sleep(0.01)
+        refreshed = facets_cache.get(tdb, ttl=300)
+        assert refreshed['checked_at'] > entry['checked_at']
+        assert refreshed['users'] == entry['users']
+
+    def test_facets_shared(self, sqlite_path, tmp_path):
+        from ash import FacetsCache
+        from ash.cache import SQLiteCache
+        path = str(tmp_path / 'cache.sqlite3')
+        tdb = SQLiteTweetsDatabase(sqlite_path)
+        # As if in two workers, each with nothing cached yet
+        entry = FacetsCache(SQLiteCache(path, 'facets')).get(tdb, ttl=300)
+        assert entry['users']
+        other = FacetsCache(SQLiteCache(path, 'facets'))
+        assert other.get(tdb, ttl=300)['users'] == entry['users']
+        assert len(other.shared) == 1
+
+    def test_fts_query(self):
+        assert fts_query('foo "bar baz"') == ('"foo" AND "bar baz"', [])
+        assert fts_query('foo | ba* -qux') == ('"foo" OR "ba"*', ['"qux"'])
+        assert fts_query('*') == (None, [])
+
+
+class TestSQLiteViews:
+
+    def test_index(self, sqlite_client):
+        resp = sqlite_client.get('/tweet/')
+        assert '<p>Number of Tweets: <code>3</code>' in resp.text
+
+    def test_search(self, sqlite_client):
+        sqlite_client.application.config.pop('T_SEARCH_BASIC_AUTH', None)
+        resp = sqlite_client.get('/tweet/search.html', query_string={'q': 'keyboard'})
+        assert 'please connect a keyboard' in resp.text
+        assert '<option value="wzyboy">' in resp.text
+
+    def test_tweet(self, sqlite_client):
+        resp = sqlite_client.get('/tweet/1615425412921987074.json')
+        assert resp.json['id'] == 1615425412921987074
@@ -1,3 +1,9 @@
+import json
+from pathlib import Path
+
+import pytest
+
+
 class TestIndexView:
     def test_index(self, client):
         resp = client.get('/tweet/')
@@ -34,6 +40,161 @@ class TestSearchView:
         resp = client.get('/tweet/search.html', auth=(db['username'], db['password']))
         assert '<option value="wzyboy">' in resp.text
 
+    def test_search_pagination(self, client):
+        client.application.config.pop('T_SEARCH_BASIC_AUTH', None)
+        client.application.config['T_SEARCH_PAGE_SIZE'] = 2
+        resp = client.get('/tweet/search.json', query_string={'q': '*'})
+        assert len(resp.json) == 2
+        next_url = resp.headers['Link'].split(';')[0].strip('<>')
+        resp = client.get(next_url)
+        assert len(resp.json) == 1
+        assert 'Link' not in resp.headers
+        client.application.config['T_SEARCH_PAGE_SIZE'] = 100
+
+    def test_search_pagination_point_in_time(self, client):
+        from unittest import mock
+        from ash import get_es
+        client.application.config.pop('T_SEARCH_BASIC_AUTH', None)
+        client.application.config['T_SEARCH_PAGE_SIZE'] = 1
+        with client.application.app_context():
+            es = get_es()
+        with mock.patch.object(es, 'open_point_in_time', wraps=es.open_point_in_time) as open_pit, \
+                mock.patch.object(es, 'close_point_in_time', wraps=es.close_point_in_time) as close_pit:
+            # The first page is a plain search
+            resp = client.get('/tweet/search.json', query_string={'q': '*'})
+            assert open_pit.call_count == 0
+            tweets = resp.json
+            while 'Link' in resp.headers:
+                resp = client.get(resp.headers['Link'].split(';')[0].strip('<>'))
+                tweets += resp.json
+            assert open_pit.call_count == 1
+            # Closed as soon as the last page is read
+            assert close_pit.call_count == 1
+        assert len({t['id'] for t in tweets}) == len(tweets) == 3
+        client.application.config['T_SEARCH_PAGE_SIZE'] = 100
+
+    def test_search_invalid_cursor(self, client):
+        client.application.config.pop('T_SEARCH_BASIC_AUTH', None)
+        resp = client.get('/tweet/search.json', query_string={'q': '*', 'cursor': 'foo'})
+        assert resp.status_code == 400
+
+    def test_search_invalid_cursor_of_expired_pit(self, client, monkeypatch):
+        from elasticsearch import NotFoundError, BadRequestError
+        from ash import encode_cursor, get_tdb
+
+        def search(pit, **kwargs):
+            if pit['id'] == 'expired':
+                raise NotFoundError('No search context found', None, {})
+            raise BadRequestError('Failed to parse search_after', None, {})
+        with client.application.test_request_context():
+            tdb = get_tdb()
+            monkeypatch.setattr(tdb.es, 'search', search)
+            monkeypatch.setattr(tdb.es, 'open_point_in_time', lambda **kwargs: {'id': 'reopened'})
+            with pytest.raises(ValueError):
+                tdb.search_page(keyword='*', cursor=encode_cursor('expired', ['not a timestamp']))
+
+    def test_facets_cache(self, client):
+        from ash import facets_cache, get_tdb
+        with client.application.test_request_context():
+            tdb = get_tdb()
+            facets = facets_cache.get(tdb, ttl=300)
+            assert facets_cache.get(tdb, ttl=300) is facets
+            assert {'screen_name': 'wzyboy', 'tweets_count': 1} in facets['users']
+            facets_cache.invalidate()
+            assert facets_cache.get(tdb, ttl=300) is not facets
+
+
+class TestMultiSearch:
+
+    def test_facets(self, client):
+        from ash import get_tdb
+        with client.application.test_request_context():
+            tdb = get_tdb()
+            assert tdb.get_facets() == {
+                'users': list(tdb.get_users()),
+                'indexes': list(tdb.get_indexes()),
+                'generation': tdb.get_generation(),
+            }
+            assert tdb.get_generation()[0] == 3
+
+    def test_latest_of_user(self, client):
+        from ash import get_tdb
+        with client.application.test_request_context():
+            tdb = get_tdb()
+            total, tweets = tdb.latest(10, user_screen_name='wzyboy')
+            assert total == len(tdb) == 3
+            assert [t['user']['screen_name'] for t in tweets] == ['wzyboy']
+
+    def test_error(self, client):
+        from elasticsearch import NotFoundError
+        from ash import SearchRequest, get_tdb
+        with client.application.test_request_context():
+            tdb = get_tdb()
+            expired = SearchRequest({'pit': {'id': 'expired'}}, lambda resp: resp)
+            with pytest.raises(NotFoundError):
+                tdb.msearch([tdb.count_request(), expired])
+
+
+class TestFanOut:
+
+    def test_fan_out(self, client):
+        import flask
+        from ash import fan_out
+        with client.application.test_request_context():
+            flask.g.seen = []
+
+            def f(n):
+                flask.g.seen.append(n)
+                return n
+
+            assert fan_out(*(lambda n=n: f(n) for n in range(4))) == [0, 1, 2, 3]
+            assert sorted(flask.g.seen) == [0, 1, 2, 3]
+
+            def fail():
+                raise KeyError('foo')
+
+            with pytest.raises(KeyError):
+                fan_out(lambda: 1, fail)
+
+    def test_search_with_facets(self, client):
+        from ash import facets_cache
+        client.application.config.pop('T_SEARCH_BASIC_AUTH', None)
+        facets_cache.invalidate()
+        resp = client.get('/tweet/search.html', query_string={'q': '*'})
+        assert '<option value="wzyboy">' in resp.text
+        assert 'please connect a keyboard' in resp.text
+
+    def test_search_with_cached_facets(self, client, monkeypatch):
+        client.application.config.pop('T_SEARCH_BASIC_AUTH', None)
+        client.get('/tweet/search.html', query_string={'q': '*'})
+
+        def fan_out(*fns):
+            raise AssertionError('fanned out with facets cached')
+        monkeypatch.setattr('ash.fan_out', fan_out)
+        resp = client.get('/tweet/search.html', query_string={'q': '*'})
+        assert '<option value="wzyboy">' in resp.text
+
+
+class TestExport:
+
+    def test_export(self, client):
+        client.application.config.pop('T_SEARCH_BASIC_AUTH', None)
+        resp = client.get('/tweet/export.ndjson')
+        lines = resp.text.splitlines()
+        assert len(lines) == 3
+        assert {json.loads(line)['_id'] for line in lines} == {
+            '1615425412921987074', '1599171888076722176', '1676023376631197696',
+        }
+
+    def test_export_filters(self, client):
+        client.application.config.pop('T_SEARCH_BASIC_AUTH', None)
+        resp = client.get('/tweet/export.ndjson', query_string={'u': 'wzyboy'})
+        assert len(resp.text.splitlines()) == 1
+        resp = client.get('/tweet/export.ndjson', query_string={'since': '2023-01-01'})
+        assert len(resp.text.splitlines()) == 2
+        resp = client.get('/tweet/export.ndjson', query_string={'since': 'yesterday'})
+        assert resp.status_code == 400
+
 
 class TestMediaReplacement:
     tweet_id = '1615425412921987074'
@@ -60,6 +221,15 @@ class TestMediaReplacement:
         resp = client.get(f'/tweet/{self.tweet_id}.html')
         assert f'/tweet/media/pbs.twimg.com/media/{self.media_filename}' in resp.text
 
+    def test_media_chain(self, client, tmp_path):
+        client.application.config['T_MEDIA_FROM'] = ('filesystem', 'mirror', 'direct')
+        client.application.config['T_MEDIA_FS_PATH'] = str(tmp_path)
+        client.application.config['T_MEDIA_MIRRORS'] = {'pbs.twimg.com': f'{self.cf_domain}/pbs.twimg.com'}
+        # Not downloaded: falls back to the mirror
+        resp = client.get(f'/tweet/{self.tweet_id}.html')
+        assert f'https://{self.cf_domain}/pbs.twimg.com/media/{self.media_filename}' in resp.text
+        client.application.config['T_MEDIA_FROM'] = 'direct'
+
 
 class TestUserDictInjection:
     tweet_id = '1676023376631197696'
@@ -78,3 +248,161 @@ class TestUserDictInjection:
         assert f'<div class="screen-name">@{self.screen_name}</div>' in resp.text
         assert f'<div class="name">{self.name}</div>' in resp.text
         assert f'<img src="{self.profile_image_url_https}"' in resp.text
+
+
+class TestConnectionPool:
+
+    def test_client_reused_across_requests(self, client):
+        from ash import get_es
+        with client.application.app_context():
+            es = get_es()
+        client.get('/tweet/')
+        with client.application.app_context():
+            assert get_es() is es
+
+    def test_per_process(self, client, monkeypatch):
+        from ash import per_process
+        made = []
+        get = per_process('T_ES_HOST')(lambda config: made.append(config) or len(made))
+        with client.application.app_context():
+            assert get() == get() == 1
+            assert made == [{'T_ES_HOST': client.application.config['T_ES_HOST']}]
+            # A forked worker makes its own
+            monkeypatch.setattr('os.getpid', lambda: -1)
+            assert get() == 2
+
+
+class TestTweetLookup:
+    tweet_id = '1615425412921987074'
+
+    def test_repeated_lookup(self, client):
+        for ext in ('html', 'json', 'html'):
+            resp = client.get(f'/tweet/{self.tweet_id}.{ext}')
+            assert resp.status_code == 200
+            assert 'please connect a keyboard' in resp.text
+
+    def test_not_found(self, client):
+        resp = client.get('/tweet/1.json')
+        assert resp.status_code == 404
+
+    def test_conditional_get(self, client):
+        resp = client.get(f'/tweet/{self.tweet_id}.html')
+        etag = resp.headers['ETag']
+        assert 'max-age' in resp.headers['Cache-Control']
+        resp = client.get(f'/tweet/{self.tweet_id}.html', headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert resp.headers['ETag'] == etag
+        resp = client.get(f'/tweet/{self.tweet_id}.html', headers={'If-None-Match': f'W/{etag}'})
+        assert resp.status_code == 304
+
+
+    def test_page_cache_without_facets(self, client, monkeypatch):
+        import ash
+        ash.facets_cache.invalidate()
+        ash.generation_cache.invalidate()
+        monkeypatch.setattr(ash.TweetsDatabase, 'get_facets', lambda self: pytest.fail('facets aggregated'))
+        resp = client.get(f'/tweet/{self.tweet_id}.html')
+        assert resp.status_code == 200
+        resp = client.get(f'/tweet/{self.tweet_id}.html', headers={'If-None-Match': resp.headers['ETag']})
+        assert resp.status_code == 304
+
+
+class TestTweetLinks:
+
+    def test_prefetch_tweet_links(self, client):
+        import flask
+        from ash import prefetch_tweet_links, get_tweet_link
+        tweets = [
+            {'id': 1, 'in_reply_to_status_id': 1615425412921987074},
+            {'id': 2, 'retweeted_status': {'id': 1}},
+        ]
+        with client.application.test_request_context('/tweet/'):
+            prefetch_tweet_links(tweets)
+            assert flask.g.local_links == {'1615425412921987074': True, '1': False}
+            assert get_tweet_link(1615425412921987074) == '/tweet/1615425412921987074.html'
+            assert get_tweet_link(1) == 'https://twitter.com/_/status/1'
+
+
+class TestFormatTweetText:
+    tweet = {
+        'id': 1,
+        'full_text': '#foo #foobar @JACK https://t.co/abc',
+        'entities': {
+            'hashtags': [
+                {'text': 'foo', 'indices': [0, 4]},
+                {'text': 'foobar', 'indices': [5, 12]},
+            ],
+            'user_mentions': [
+                {'screen_name': 'jack', 'name': 'Jack', 'indices': [13, 18]},
+            ],
+            'urls': [
+                {'url': 'https://t.co/abc', 'expanded_url': 'https://example.com/a', 'display_url': 'example.com/a', 'indices': [19, 35]},
+            ],
+        },
+    }
+    expected = (
+        '<a href="https://twitter.com/hashtag/foo">#foo</a> '
+        '<a href="https://twitter.com/hashtag/foobar">#foobar</a> '
+        '<a href="https://twitter.com/jack" title="Jack">@JACK</a> '
+        '<a href="https://example.com/a">example.com/a</a>'
+    )
+
+    def test_render_by_indices(self, client):
+        from ash import render_entities
+        assert render_entities(self.tweet) == self.expected
+
+    def test_render_without_indices(self, client):
+        from ash import render_entities
+        tweet = json.loads(json.dumps(self.tweet))
+        for entities in tweet['entities'].values():
+            for entity in entities:
+                del entity['indices']
+        assert render_entities(tweet) == self.expected
+
+
+class TestViews:
+    fixtures = Path(__file__).parent / 'fixtures'
+
+    def test_view_renders_like_source(self, client):
+        from ash import VIEW_VERSION, make_view, hydrate, extract_media, format_tweet_text
+        for fixture in self.fixtures.glob('*.json'):
+            # As stored in and read back from Elasticsearch
+            view = json.loads(json.dumps(make_view(json.loads(fixture.read_text()))))
+            from_view = hydrate({'@view': view}, 'pytest')
+            from_source = hydrate(json.loads(fixture.read_text()), 'pytest')
+            assert from_view['v'] == VIEW_VERSION
+            assert from_view['user'] == {
+                k: from_source['user'].get(k) for k in ('screen_name', 'name', 'profile_image_url_https')
+            }
+            assert (from_view['images'], from_view['videos']) == extract_media(from_source)
+            with client.application.test_request_context('/tweet/'):
+                assert format_tweet_text(from_view) == format_tweet_text(from_source)
+
+    def test_outdated_view(self, client):
+        from ash import hydrate
+        tweet = hydrate({'id': 1, 'user': {'screen_name': 'a'}, '@view': {'v': 0}}, 'pytest')
+        assert 'v' not in tweet
+        assert tweet['user'] == {'screen_name': 'a'}
+
+    def test_documents_without_views(self, client):
+        client.application.config.pop('T_SEARCH_BASIC_AUTH', None)
+        client.application.config['T_ES_VIEWS'] = True
+        try:
+            resp = client.get('/tweet/search.html', query_string={'q': '*'})
+            assert 'please connect a keyboard' in resp.text
+        finally:
+            client.application.config['T_ES_VIEWS'] = False
+
+
+class TestFormatCreatedAt:
+
+    def test_formats(self, client):
+        from ash import format_created_at
+        timestamps = (
+            'Tue Jan 17 19:06:46 +0000 2023',
+            '2023-01-17 19:06:46 +0000',
+            '2023-01-17T19:06:46+00:00',
+            '2023-01-17T19:06:46.000Z',
+        )
+        for ts in timestamps:
+            assert format_created_at(ts, '%Y-%m-%d %H:%M:%S %z') == '2023-01-17 19:06:46 +0000'